@@ -0,0 +1,558 @@
+#!/usr/bin/env python3
+# CS472 - Homework #2
+# Alex M Brown
+# FTPAsync.py
+#
+# This module contains an asyncio version of the FTP protocol layer. One event loop
+# can drive many sessions and transfers at once. SyncFTPSession wraps it for callers
+# that are not async themselves. Requires Python 3.6 or newer; FTPClient.py remains
+# the synchronous client and is where the shared helpers live.
+
+import asyncio
+import re
+import threading
+import time
+
+from FTPClient import (CRLF, DATA_BUFFER_SIZE, FTPError, decode, encode, get_socket_address,
+                       log, parse_pwd, parse_response)
+
+
+"""
+Reads one complete FTP reply from a control connection stream
+Multi-line replies ("123-" ... "123 ") are returned whole.
+Input:
+    reader: The asyncio StreamReader for the control connection
+Output:
+    The reply from the server
+"""
+async def read_reply(reader):
+    line = await reader.readline()
+    if not line.endswith(b"\n"):
+        raise FTPError("Control connection lost.")
+    lines = [line]
+    if line[3:4] == b"-":
+        last = line[:3] + b" "
+        while not line.startswith(last):
+            line = await reader.readline()
+            if not line.endswith(b"\n"):
+                raise FTPError("Control connection lost.")
+            lines.append(line)
+    reply = decode(b"".join(lines))
+    log("Received: " + reply[:-2])
+    return reply
+
+
+"""
+Drops a data connection that will not be used because the server refused the transfer
+Input:
+    data: The awaitable returned by AsyncFTPSession.open_data
+"""
+def discard(data):
+    if data.done() and not data.cancelled() and not data.exception():
+        data.result()[1].close()
+    else:
+        data.cancel()
+
+
+"""
+One connection to an FTP server, driven by asyncio
+Mirrors FTPSession: the control stream, the data connection mode and the
+transfer commands, but every network operation is a coroutine.
+
+Input:
+    host: The IP Address or Name of the FTP server
+    port: Optional. The port number of the FTP server (default 21)
+    timeout: Optional. Seconds to wait for a connection or a reply
+"""
+class AsyncFTPSession(object):
+    def __init__(self, host, port = 21, timeout = 5):
+        self.host = host
+        self.control_port = port
+        self.timeout = timeout
+        self.reader = None                          #Control Connection streams
+        self.writer = None
+        self.user = None
+        self.password = None
+        self.lock = asyncio.Lock()                  #One command at a time on the control connection
+        self.server_type = None                     #The TYPE the server is in (None = not set yet)
+
+
+    """
+    Opens the control connection and reads the greeting
+    Output:
+        tuple : (Response Code, Response Message) of the greeting
+    """
+    async def connect(self):
+        log("Establishing connection at " + str((self.host, self.control_port)))
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.control_port), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise FTPError("Failed to establish control connection: " + str(e))
+        return parse_response(await self.read_reply())
+
+
+    """
+    Logs the user into the FTP server
+    Input:
+        user : Username of the user to be logged in
+        password : Optional. Password, sent if the server asks for one
+    Output:
+        tuple : (Response Code, Response Message) of the last reply
+    """
+    async def login(self, user, password = None):
+        self.user = user
+        self.password = password
+        resp = await self.command("USER " + user)
+        if resp[0] == '331' and password is not None:
+            resp = await self.command("PASS " + password)
+        return resp
+
+
+    """
+    Reads one complete reply from the control connection
+    Output:
+        The reply from the server
+    """
+    async def read_reply(self):
+        try:
+            return await asyncio.wait_for(read_reply(self.reader), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise FTPError("Control connection lost: " + str(e))
+
+
+    """
+    Sends an FTP command and waits for its reply
+    Input:
+        msg : The command, without the CRLF
+    Output:
+        tuple : (Response Code, Response Message)
+    """
+    async def command(self, msg):
+        log("Sent: " + msg)
+        if not self.writer:
+            raise FTPError("No Control Connection")
+        self.writer.write(encode(msg + CRLF))
+        return parse_response(await self.read_reply())
+
+
+    """
+    Sends several FTP commands in a single write and reads their replies in order
+    Input:
+        msgs : The commands, without the CRLF
+    Output:
+        list : (Response Code, Response Message) for each command
+    """
+    async def pipeline(self, msgs):
+        for msg in msgs:
+            log("Sent: " + msg)
+        self.writer.write(b"".join([encode(msg + CRLF) for msg in msgs]))
+        return [parse_response(await self.read_reply()) for msg in msgs]
+
+
+    """
+    Sends TYPE if the server is not already in type_code
+    Input:
+        type_code : "I" for binary or "A" for ASCII
+    """
+    async def select_type(self, type_code):
+        if type_code == self.server_type:
+            return
+        resp = await self.command("TYPE " + type_code)
+        if not resp[0] == '200':
+            raise FTPError("TYPE " + type_code + " refused: " + resp[1])
+        self.server_type = type_code
+
+
+    #DATA CONNECTION
+
+    """
+    Enters passive mode and connects to the port the server opened
+    Output:
+        awaitable : resolves to (StreamReader, StreamWriter) for the data connection
+    """
+    async def pasv(self):
+        resp = await self.command("PASV")
+        if not resp[0] == '227':
+            raise FTPError("PASV refused: " + resp[1])
+        address = get_socket_address(re.search(r'\((.*)\)', resp[1]).group(1))
+        return await self.open_data_connection(address[0], address[1])
+
+
+    """
+    Enters extended passive mode and connects to the port the server opened
+    Output:
+        awaitable : resolves to (StreamReader, StreamWriter) for the data connection
+    """
+    async def epsv(self):
+        resp = await self.command("EPSV 1")
+        if not resp[0] == '229':
+            raise FTPError("EPSV refused: " + resp[1])
+        port = int(re.search(r'\|\|\|(\d+)\|', resp[1]).group(1))
+        return await self.open_data_connection(self.writer.get_extra_info('peername')[0], port)
+
+
+    """
+    Enters active mode (PORT) and waits for the server to connect
+    The returned awaitable finishes once the server has connected, which only
+    happens after the transfer command has been sent.
+    Output:
+        awaitable : resolves to (StreamReader, StreamWriter) for the data connection
+    """
+    async def port(self):
+        return await self.listen(extended = False)
+
+
+    """
+    Enters extended active mode (EPRT) and waits for the server to connect
+    Output:
+        awaitable : resolves to (StreamReader, StreamWriter) for the data connection
+    """
+    async def eprt(self):
+        return await self.listen(extended = True)
+
+
+    async def open_data_connection(self, address, port):
+        log("Establishing connection at " + str((address, port)))
+        try:
+            streams = await asyncio.wait_for(asyncio.open_connection(address, port), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise FTPError("Error establishing data connection: " + str(e))
+        future = asyncio.get_event_loop().create_future()
+        future.set_result(streams)
+        return future
+
+
+    async def listen(self, extended):
+        loop = asyncio.get_event_loop()
+        accepted = loop.create_future()
+
+        def on_connect(reader, writer):
+            if not accepted.done():
+                log("Accepted data connection from Server")
+                accepted.set_result((reader, writer))
+            else:
+                writer.close()
+
+        my_ip = self.writer.get_extra_info('sockname')[0]
+        server = await asyncio.start_server(on_connect, my_ip, 0)
+        my_port = server.sockets[0].getsockname()[1]
+        if extended:
+            resp = await self.command("EPRT |1|" + my_ip + "|" + str(my_port) + "|")
+        else:
+            resp = await self.command("PORT " + ','.join(my_ip.split('.')) + ',' + str(my_port // 256) + ',' + str(my_port % 256))
+        if not resp[0] == '200':
+            server.close()
+            raise FTPError("Active mode refused: " + resp[1])
+
+        async def wait():
+            try:
+                return await asyncio.wait_for(accepted, self.timeout)
+            finally:
+                server.close()
+        return asyncio.ensure_future(wait())
+
+
+    """
+    Opens a data connection in the given mode
+    Input:
+        mode : "epsv", "pasv", "port" or "eprt"
+    Output:
+        awaitable : resolves to (StreamReader, StreamWriter) for the data connection
+    """
+    async def open_data(self, mode = "pasv"):
+        return await getattr(self, mode)()
+
+
+    #TRANSFERS
+
+    """
+    Aborts the transfer in progress and reads both its reply and the reply to ABOR
+    Output:
+        tuple : (Response Code, Response Message) of the reply to ABOR
+    """
+    async def abort(self):
+        log("Sent: ABOR")
+        self.writer.write(encode("ABOR" + CRLF))
+        await self.read_reply()                     #The transfer's own reply: 426, or 226 if it had already ended
+        return parse_response(await self.read_reply())
+
+
+    """
+    Starts a transfer command and yields the data stream's chunks until the server closes it
+    The session stays locked until the generator ends. A caller that stops early
+    must aclose() it, which aborts the transfer so the next command gets its own reply.
+    Input:
+        msg : The transfer command (RETR, LIST, ...), without the CRLF
+        mode : Optional. Data connection mode
+        chunk_size : Optional. Most bytes read at a time
+        type_code : Optional. The TYPE the transfer needs
+    Output:
+        async generator : the bytes read from the data connection
+    """
+    async def retrieve(self, msg, mode = "pasv", chunk_size = DATA_BUFFER_SIZE, type_code = None):
+        async with self.lock:
+            if type_code:
+                await self.select_type(type_code)
+            data = await self.open_data(mode)
+            resp = await self.command(msg)
+            if not (resp[0] == '150' or resp[0] == '125'):
+                discard(data)
+                raise FTPError(resp[1])
+            reader, writer = await data
+            ended = False
+            try:
+                while True:
+                    chunk = await reader.read(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+                ended = True
+            finally:
+                writer.close()
+                if not ended:
+                    try:
+                        await self.abort()
+                    except FTPError as e:
+                        log("Could not abort " + msg + ": " + str(e))
+                        self.close()
+            resp = parse_response(await self.read_reply())
+            if not resp[0] == '226':
+                raise FTPError(resp[1])
+
+
+    """
+    Downloads a file
+    Input:
+        filename : The name of the file on the server
+        savename : The name to save the file under
+        mode : Optional. Data connection mode
+    Output:
+        tuple : (Bytes Written, Elapsed Seconds)
+    """
+    async def get(self, filename, savename, mode = "pasv"):
+        start = time.time()
+        written = 0
+        chunks = self.retrieve("RETR " + filename, mode, type_code = "I")
+        try:
+            with open(savename, "wb") as newFile:
+                async for chunk in chunks:
+                    newFile.write(chunk)
+                    written += len(chunk)
+        finally:
+            await chunks.aclose()                   #Aborts the transfer if writing the file failed
+        elapsed = time.time() - start
+        log("Received " + str(written) + " bytes in " + str(round(elapsed, 3)) + " seconds")
+        return (written, elapsed)
+
+
+    """
+    Uploads a file
+    Input:
+        filename : The name of the local file
+        remotename : Optional. The name to store the file under (default filename)
+        mode : Optional. Data connection mode
+        chunk_size : Optional. Most bytes read from the file at a time
+    Output:
+        tuple : (Bytes Sent, Elapsed Seconds)
+    """
+    async def put(self, filename, remotename = None, mode = "pasv", chunk_size = DATA_BUFFER_SIZE):
+        start = time.time()
+        sent = 0
+        async with self.lock:
+            await self.select_type("I")
+            data = await self.open_data(mode)
+            resp = await self.command("STOR " + (remotename or filename))
+            if not (resp[0] == '150' or resp[0] == '125'):
+                discard(data)
+                raise FTPError(resp[1])
+            reader, writer = await data
+            try:
+                with open(filename, "rb") as sendFile:
+                    while True:
+                        chunk = sendFile.read(chunk_size)
+                        if not chunk:
+                            break
+                        writer.write(chunk)
+                        await writer.drain()
+                        sent += len(chunk)
+            finally:
+                writer.close()
+            resp = parse_response(await self.read_reply())
+            if not resp[0] == '226':
+                raise FTPError(resp[1])
+        elapsed = time.time() - start
+        log("Sent " + str(sent) + " bytes in " + str(round(elapsed, 3)) + " seconds")
+        return (sent, elapsed)
+
+
+    """
+    Lists a directory or file
+    Input:
+        pathname : Optional. Name of a directory or file to list information about
+        mode : Optional. Data connection mode
+    Output:
+        str : The listing
+    """
+    async def ls(self, pathname = None, mode = "pasv"):
+        chunks = []
+        listing = self.retrieve("LIST " + pathname if pathname else "LIST", mode)
+        try:
+            async for chunk in listing:
+                chunks.append(chunk)
+        finally:
+            await listing.aclose()
+        return decode(b"".join(chunks))
+
+
+    """
+    Asks the server for its current working directory
+    Output:
+        str : The directory
+    """
+    async def pwd(self):
+        async with self.lock:
+            return parse_pwd((await self.command("PWD"))[1])
+
+
+    """
+    Changes the working directory
+    Input:
+        pathname : The directory to change to
+    Output:
+        tuple : (Response Code, Response Message)
+    """
+    async def cwd(self, pathname):
+        async with self.lock:
+            return await self.command("CWD " + pathname)
+
+
+    """
+    Sends QUIT and closes the control connection
+    Output:
+        tuple : (Response Code, Response Message)
+    """
+    async def quit(self):
+        try:
+            async with self.lock:
+                return await self.command("QUIT")
+        finally:
+            self.close()
+
+
+    """
+    Closes the control connection
+    """
+    def close(self):
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+            self.reader = None
+        self.server_type = None
+
+
+"""
+Opens a logged in AsyncFTPSession
+Input:
+    host, port : The FTP server
+    user, password : Credentials
+Output:
+    AsyncFTPSession : The connected session
+"""
+async def open_session(host, port, user, password):
+    session = AsyncFTPSession(host, port)
+    await session.connect()
+    resp = await session.login(user, password)
+    if not resp[0] == '230':
+        session.close()
+        raise FTPError("Login failed: " + resp[1])
+    return session
+
+
+"""
+Downloads many files at once over a number of sessions on one event loop
+Input:
+    host, port : The FTP server
+    user, password : Credentials
+    jobs : (Remote Name, Local Name) for each file
+    connections : Optional. How many sessions to open
+Output:
+    list : (Bytes Written, Elapsed Seconds) per file, or the FTPError it failed with
+"""
+async def get_many(host, port, user, password, jobs, connections = 16):
+    sessions = await asyncio.gather(*[open_session(host, port, user, password)
+                                      for i in range(min(connections, len(jobs)))])
+    pending = asyncio.Queue()
+    for index, job in enumerate(jobs):
+        pending.put_nowait((index, job))
+    results = [None] * len(jobs)
+
+    async def worker(session):
+        while not pending.empty():
+            index, (remote, local) = pending.get_nowait()
+            try:
+                results[index] = await session.get(remote, local)
+            except FTPError as e:
+                results[index] = e
+
+    try:
+        await asyncio.gather(*[worker(session) for session in sessions])
+    finally:
+        for session in sessions:
+            try:
+                await session.quit()
+            except FTPError:
+                session.close()
+    return results
+
+
+"""
+Synchronous wrapper around AsyncFTPSession
+Runs an event loop on a background thread and blocks on each coroutine, so code
+written against a blocking API can share the async core.
+
+Input:
+    host: The IP Address or Name of the FTP server
+    port: Optional. The port number of the FTP server (default 21)
+"""
+class SyncFTPSession(object):
+    def __init__(self, host, port = 21):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target = self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.session = self.run(self.create(host, port))
+
+    async def create(self, host, port):
+        return AsyncFTPSession(host, port)
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def connect(self):
+        return self.run(self.session.connect())
+
+    def login(self, user, password = None):
+        return self.run(self.session.login(user, password))
+
+    def get(self, filename, savename, mode = "pasv"):
+        return self.run(self.session.get(filename, savename, mode))
+
+    def put(self, filename, remotename = None, mode = "pasv"):
+        return self.run(self.session.put(filename, remotename, mode))
+
+    def ls(self, pathname = None, mode = "pasv"):
+        return self.run(self.session.ls(pathname, mode))
+
+    def pwd(self):
+        return self.run(self.session.pwd())
+
+    def cwd(self, pathname):
+        return self.run(self.session.cwd(pathname))
+
+    def quit(self):
+        try:
+            return self.run(self.session.quit())
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
@@ -0,0 +1,652 @@
+#!/usr/bin/env python
+# CS472 - Homework #2
+# Alex M Brown
+# FTPBenchmark.py
+#
+# This module measures the performance of FTPClient.py. It starts a small FTP server
+# on the loopback interface inside the same process, optionally slowed down with
+# added latency and a bandwidth limit, and times get/put/ls through FTPSession for
+# each file size, data connection mode and number of concurrent sessions.
+# Results are written as JSON lines so two runs can be compared.
+
+from socket import *
+from socket import error as socket_error
+import argparse
+import json
+import mmap
+import os
+import platform
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import FTPClient
+from FTPClient import FTPSession, FTPError, CRLF, encode, decode
+
+
+
+#GLOBAL VARIABLES
+CHUNK_SIZE = 262144                                 #Size of each write the server makes on a data connection
+LIST_ENTRIES = 1000                                 #Number of entries in the listing the server sends
+DEFAULT_SIZES = "1K,64K,1M,16M,128M"                #File sizes measured when --sizes is not given
+DEFAULT_MODES = "auto,pasv,epsv,port,eprt"           #auto lets the client open the data connection itself
+DEFAULT_OPS = "get,put,ls"
+DEFAULT_CONCURRENCY = "1,4"
+UNITS = {'': 1, 'K': 1024, 'M': 1048576, 'G': 1073741824}
+RSS_INTERVAL = 0.01                                 #Seconds between samples of the memory in use during a scenario
+
+
+
+#LOOPBACK SERVER
+
+"""
+Limits how fast bytes may be moved over one connection
+Input:
+    rate: Bytes per second, or 0 for no limit
+"""
+class Throttle(object):
+    def __init__(self, rate):
+        self.rate = rate
+        self.start = time.time()
+        self.moved = 0
+
+    """
+    Sleeps until count more bytes may be moved
+    Input:
+        count: The number of bytes about to be moved
+    """
+    def wait(self, count):
+        if not self.rate:
+            return
+        self.moved += count
+        delay = self.moved / float(self.rate) - (time.time() - self.start)
+        if delay > 0:
+            time.sleep(delay)
+
+
+"""
+Serves one control connection of the benchmark server
+Files are not read from disk: RETR of "<bytes>.bin" streams that many bytes, STOR
+reads and discards the upload, and LIST/MLSD describe LIST_ENTRIES made up files.
+
+Input:
+    server: The BenchmarkServer the connection was accepted by
+    connection: The control connection socket
+"""
+class ServerSession(threading.Thread):
+    def __init__(self, server, connection):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.server = server
+        self.connection = connection
+        self.buffer = b""
+        self.arrived = 0                            #When the last data arrived on the control connection
+        self.received = 0                           #When the command being answered arrived
+        self.listener = None                        #Socket waiting for the client in passive mode
+        self.target = None                          #Address to connect to in active mode
+
+    #Replies go out latency seconds after their command arrived, like a round trip over
+    #a slow network. Commands that arrived together are answered together.
+    def reply(self, text):
+        delay = self.received + self.server.latency - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        self.connection.sendall(encode(text + CRLF))
+
+    def read_command(self):
+        while b"\n" not in self.buffer:
+            data = self.connection.recv(4096)
+            if not data:
+                return None
+            self.arrived = time.time()
+            self.buffer += data
+        self.received = self.arrived
+        line, self.buffer = self.buffer.split(b"\n", 1)
+        return decode(line).rstrip("\r")
+
+    def run(self):
+        try:
+            self.reply("220 FTPBenchmark loopback server")
+            while True:
+                line = self.read_command()
+                if line is None:
+                    break
+                command, _, argument = line.partition(" ")
+                command = command.upper()
+                getattr(self, "do_" + command, self.unknown)(argument)
+                if command == "QUIT":
+                    break
+        except socket_error:
+            pass
+        finally:
+            self.connection.close()
+            if self.listener:
+                self.listener.close()
+
+    def unknown(self, argument):
+        self.reply("502 Command not implemented.")
+
+    def do_USER(self, argument):
+        self.reply("331 Any password will do.")
+
+    def do_PASS(self, argument):
+        self.reply("230 Logged in.")
+
+    def do_SYST(self, argument):
+        self.reply("215 UNIX Type: L8")
+
+    def do_FEAT(self, argument):
+        self.reply("211-Features:" + CRLF + " EPSV" + CRLF + " MLST type*;size*;modify*;" + CRLF + " SIZE" + CRLF + "211 End")
+
+    def do_TYPE(self, argument):
+        self.reply("200 Type set to " + argument + ".")
+
+    def do_NOOP(self, argument):
+        self.reply("200 NOOP ok.")
+
+    def do_PWD(self, argument):
+        self.reply('257 "/" is the current directory')
+
+    def do_CWD(self, argument):
+        self.reply("250 Directory successfully changed.")
+
+    def do_QUIT(self, argument):
+        self.reply("221 Goodbye.")
+
+    def do_SIZE(self, argument):
+        size = file_size(argument)
+        if size is None:
+            self.reply("550 Could not get file size.")
+        else:
+            self.reply("213 " + str(size))
+
+    def do_PASV(self, argument):
+        self.open_listener()
+        address = self.listener.getsockname()
+        port = address[1]
+        self.reply("227 Entering Passive Mode (%s,%d,%d)." % (address[0].replace('.', ','), port // 256, port % 256))
+
+    def do_EPSV(self, argument):
+        self.open_listener()
+        self.reply("229 Entering Extended Passive Mode (|||%d|)" % self.listener.getsockname()[1])
+
+    def do_PORT(self, argument):
+        fields = argument.split(',')
+        self.target = ('.'.join(fields[:4]), int(fields[4]) * 256 + int(fields[5]))
+        self.reply("200 PORT command successful.")
+
+    def do_EPRT(self, argument):
+        fields = argument.split(argument[0])
+        self.target = (fields[2], int(fields[3]))
+        self.reply("200 EPRT command successful.")
+
+    def do_RETR(self, argument):
+        size = file_size(argument)
+        if size is None:
+            self.reply("550 Failed to open file.")
+            return
+        if not self.data_ready():
+            return
+        self.reply("150 Opening BINARY mode data connection for %s (%d bytes)." % (argument, size))
+        data = self.open_data()
+        throttle = Throttle(self.server.bandwidth)
+        block = self.server.block
+        try:
+            remaining = size
+            while remaining:
+                chunk = block[:min(remaining, len(block))]
+                throttle.wait(len(chunk))
+                data.sendall(chunk)
+                remaining -= len(chunk)
+        except socket_error:
+            data.close()
+            self.reply("426 Connection closed; transfer aborted.")
+            return
+        data.close()
+        self.reply("226 Transfer complete.")
+
+    def do_STOR(self, argument):
+        if not self.data_ready():
+            return
+        self.reply("150 Ok to send data.")
+        data = self.open_data()
+        throttle = Throttle(self.server.bandwidth)
+        buffer = bytearray(CHUNK_SIZE)
+        try:
+            while True:
+                count = data.recv_into(buffer)
+                if not count:
+                    break
+                throttle.wait(count)
+        except socket_error:
+            data.close()
+            self.reply("426 Connection closed; transfer aborted.")
+            return
+        data.close()
+        self.reply("226 Transfer complete.")
+
+    def do_LIST(self, argument):
+        self.send_listing(self.server.listing)
+
+    def do_MLSD(self, argument):
+        self.send_listing(self.server.machine_listing)
+
+    def send_listing(self, listing):
+        if not self.data_ready():
+            return
+        self.reply("150 Here comes the directory listing.")
+        data = self.open_data()
+        Throttle(self.server.bandwidth).wait(len(listing))
+        data.sendall(listing)
+        data.close()
+        self.reply("226 Directory send OK.")
+
+    def open_listener(self):
+        if self.listener:
+            self.listener.close()
+        self.listener = socket(AF_INET, SOCK_STREAM)
+        self.listener.bind((self.server.host, 0))
+        self.listener.listen(1)
+
+    def data_ready(self):
+        if self.listener or self.target:
+            return True
+        self.reply("425 Use PORT or PASV first.")
+        return False
+
+    def open_data(self):
+        if self.listener:
+            data, address = self.listener.accept()
+            self.listener.close()
+            self.listener = None
+            return data
+        data = create_connection(self.target)
+        self.target = None
+        return data
+
+
+"""
+Finds the size of a benchmark file from its name, e.g. "1048576.bin"
+Input:
+    name: The file name sent by the client
+Output:
+    The size in bytes, or None if the name is not a benchmark file
+"""
+def file_size(name):
+    match = re.match(r'^/?(\d+)\.bin$', name)
+    if match:
+        return int(match.group(1))
+    return None
+
+
+"""
+An FTP server on the loopback interface that runs in a background thread
+Input:
+    latency: Optional. Round trip time added to every command on the control connection, in seconds
+    bandwidth: Optional. Bytes per second allowed on each data connection (0 = no limit)
+    host: Optional. The address to listen on (default 127.0.0.1)
+"""
+class BenchmarkServer(threading.Thread):
+    def __init__(self, latency = 0, bandwidth = 0, host = "127.0.0.1"):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.host = host
+        self.block = b"\xa5" * CHUNK_SIZE
+        stamp = time.strftime('%b %d %H:%M')
+        self.listing = encode("".join(["-rw-r--r--    1 1001     1001     %12d %s file%05d.bin" % (index * 1000, stamp, index) + CRLF
+                                       for index in range(LIST_ENTRIES)]))
+        self.machine_listing = encode("".join(["type=file;size=%d;modify=20240101120000; file%05d.bin" % (index * 1000, index) + CRLF
+                                               for index in range(LIST_ENTRIES)]))
+        self.listener = socket(AF_INET, SOCK_STREAM)
+        self.listener.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        self.listener.bind((host, 0))
+        self.listener.listen(64)
+        self.port = self.listener.getsockname()[1]
+
+    def run(self):
+        while True:
+            try:
+                connection, address = self.listener.accept()
+            except socket_error:
+                return
+            #Send each reply at once, so Nagle's algorithm does not hold back the second of two replies
+            connection.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+            ServerSession(self, connection).start()
+
+    def close(self):
+        self.listener.close()
+
+
+
+#MEASUREMENT
+
+"""
+Parses a size such as 64K, 16M or 2G
+Input:
+    text: The size
+Output:
+    The size in bytes
+"""
+def parse_size(text):
+    match = re.match(r'^(\d+)([KMG]?)B?$', text.strip().upper())
+    if not match:
+        raise argparse.ArgumentTypeError("Not a size: " + text)
+    return int(match.group(1)) * UNITS[match.group(2)]
+
+
+"""
+Formats a size in bytes for display, e.g. 1048576 -> 1M
+"""
+def format_size(size):
+    for unit in ('G', 'M', 'K'):
+        if size >= UNITS[unit] and size % UNITS[unit] == 0:
+            return str(size // UNITS[unit]) + unit
+    return str(size)
+
+
+"""
+Finds a percentile of a list of samples by the nearest rank
+Input:
+    values: The samples
+    fraction: e.g. 0.99 for the 99th percentile
+Output:
+    The percentile, or None if there are no samples
+"""
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+"""
+Finds how much memory the process holds right now
+Output:
+    Resident set size in bytes, or None where the platform cannot tell (only Linux has /proc/self/statm)
+"""
+def current_rss():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * mmap.PAGESIZE
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+"""
+Samples the memory of the process while one scenario runs
+ru_maxrss only ever holds the peak of the whole run, so after the first large
+transfer every scenario would report the same figure; sampling the current size
+instead gives how far each scenario on its own pushed memory up.
+"""
+class RSSSampler(threading.Thread):
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.stopped = threading.Event()
+        self.baseline = current_rss()
+        self.peak = self.baseline
+
+    def run(self):
+        while self.baseline is not None and not self.stopped.is_set():
+            self.sample()
+            self.stopped.wait(RSS_INTERVAL)
+
+    def sample(self):
+        rss = current_rss()
+        if rss is not None and rss > self.peak:
+            self.peak = rss
+
+    """
+    Stops sampling
+    Output:
+        The most the memory grew by since the sampler was created, in bytes, or None where it cannot be measured
+    """
+    def finish(self):
+        self.stopped.set()
+        self.join()
+        if self.baseline is None:
+            return None
+        self.sample()
+        return self.peak - self.baseline
+
+
+"""
+Runs one get, put or ls, opening the data connection first
+Input:
+    session: A logged in session
+    op: 'get', 'put' or 'ls'
+    mode: 'pasv', 'epsv', 'port' or 'eprt', or 'auto' to let the transfer open the data connection
+    size: The file size, for get and put
+    workdir: Directory holding the upload sources and download targets
+    sink: Optional. Where downloads are written instead of workdir, e.g. os.devnull
+Output:
+    tuple : (Bytes Moved, Setup Seconds, Total Seconds)
+"""
+def run_operation(session, op, mode, size, workdir, sink = None):
+    start = time.time()
+    setup = None
+    if mode != 'auto':
+        resp = getattr(session, mode)()
+        if not resp[0] in ('200', '227', '229'):
+            raise FTPError(mode + " failed: " + resp[1])
+        setup = time.time() - start
+    if op == 'get':
+        target = sink or os.path.join(workdir, "get-%d-%d.bin" % (size, threading.current_thread().ident))
+        resp, result = session.get("%d.bin" % size, target)
+        moved = result[0] if result else 0
+    elif op == 'put':
+        resp, result = session.put(os.path.join(workdir, "%d.bin" % size), "%d.bin" % size)
+        moved = result[0] if result else 0
+    else:
+        resp, listing = session.iter_listing(raw = True)
+        moved = 0
+        if listing:
+            with listing:
+                for line in listing:
+                    pass
+            resp, moved = listing.reply, listing.received
+    if not resp[0] == '226':
+        raise FTPError(op + " failed: " + resp[1])
+    return (moved, setup, time.time() - start)
+
+
+"""
+Times one operation in one mode at one file size and level of concurrency
+Each of the concurrent sessions runs the operation repeat times, all at once.
+Input:
+    server: The BenchmarkServer
+    op: 'get', 'put' or 'ls'
+    mode: The data connection mode
+    size: The file size (ignored for ls)
+    concurrency: How many sessions run at once
+    repeat: How many times each session runs the operation
+    workdir: Directory holding the upload sources and download targets
+    sink: Optional. Where downloads are written instead of workdir
+Output:
+    dict : The result record
+"""
+def run_scenario(server, op, mode, size, concurrency, repeat, workdir, sink = None):
+    sampler = RSSSampler()
+    sampler.start()
+    sessions = []
+    for index in range(concurrency):
+        session = FTPSession(server.host, server.port)
+        session.connect()
+        session.login("bench", "bench")
+        sessions.append(session)
+    samples = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker(session):
+        for attempt in range(repeat):
+            try:
+                sample = run_operation(session, op, mode, size, workdir, sink)
+            except (FTPError, socket_error) as e:
+                with lock:
+                    errors.append(str(e))
+                return
+            with lock:
+                samples.append(sample)
+
+    start = time.time()
+    workers = [threading.Thread(target = worker, args = (session,)) for session in sessions]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.time() - start
+    for session in sessions:
+        try:
+            session.quit()
+        except (FTPError, socket_error):
+            session.close()
+    growth = sampler.finish()
+
+    moved = sum([sample[0] for sample in samples])
+    latencies = [sample[2] for sample in samples]
+    return {'type': 'result', 'op': op, 'mode': mode, 'size': size if op != 'ls' else None,
+            'concurrency': concurrency, 'count': len(samples), 'errors': len(errors),
+            'bytes': moved, 'seconds': elapsed, 'throughput': moved / elapsed if elapsed > 0 else None,
+            'p50': percentile(latencies, 0.5), 'p99': percentile(latencies, 0.99),
+            'setup_p50': percentile([sample[1] for sample in samples if sample[1] is not None], 0.5), 'rss_growth': growth}
+
+
+"""
+Builds the key a result is matched on when comparing two runs
+"""
+def scenario_key(result):
+    return (result['op'], result['mode'], result['size'], result['concurrency'])
+
+
+"""
+Reads the results of an earlier run
+Input:
+    filename: The JSON lines file written with -o
+Output:
+    dict : {Scenario Key: Result}
+"""
+def read_results(filename):
+    results = {}
+    with open(filename) as previous:
+        for line in previous:
+            if line.strip():
+                record = json.loads(line)
+                if record.get('type') == 'result':
+                    results[scenario_key(record)] = record
+    return results
+
+
+"""
+Compares a result with the same scenario from an earlier run
+Input:
+    result: The new result
+    baseline: The earlier result
+    threshold: The fraction throughput may fall, or p99 latency rise, before it counts as a regression
+Output:
+    list : A description of each regression, empty if there were none
+"""
+def compare(result, baseline, threshold):
+    regressions = []
+    if result['throughput'] and baseline.get('throughput'):
+        change = result['throughput'] / baseline['throughput'] - 1
+        if change < -threshold:
+            regressions.append("throughput %+.1f%%" % (change * 100))
+    if result['p99'] and baseline.get('p99'):
+        change = result['p99'] / baseline['p99'] - 1
+        if change > threshold:
+            regressions.append("p99 %+.1f%%" % (change * 100))
+    return regressions
+
+
+"""
+Formats one result as a line of the report
+"""
+def format_result(result):
+    return "%-4s %-5s %6s %4d %6d %12s %10.2f %10.2f %10s" % (
+        result['op'], result['mode'], format_size(result['size']) if result['size'] is not None else '-',
+        result['concurrency'], result['count'], FTPClient.format_rate(result['bytes'], result['seconds']),
+        (result['p50'] or 0) * 1000, (result['p99'] or 0) * 1000,
+        "%.1fM" % (result['rss_growth'] / 1048576.0) if result.get('rss_growth') is not None else '-')
+
+
+"""
+Entry point for the benchmark
+Input:
+    argv : Optional. The command line arguments (default sys.argv[1:])
+Output:
+    int : 0, or 1 if a scenario failed or regressed against the baseline
+"""
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Benchmarks FTPClient.py against a loopback FTP server.")
+    parser.add_argument('-o','--output', metavar = 'FILE', help="Write the results to FILE as JSON lines")
+    parser.add_argument('--sizes', default = DEFAULT_SIZES, help="File sizes for get and put. [Default = " + DEFAULT_SIZES + "]")
+    parser.add_argument('--modes', default = DEFAULT_MODES, help="Data connection modes. [Default = " + DEFAULT_MODES + "]")
+    parser.add_argument('--ops', default = DEFAULT_OPS, help="Operations to time. [Default = " + DEFAULT_OPS + "]")
+    parser.add_argument('--concurrency', default = DEFAULT_CONCURRENCY, help="Numbers of sessions run at once. [Default = " + DEFAULT_CONCURRENCY + "]")
+    parser.add_argument('-r','--repeat', type = int, default = 5, help="Times each session runs each operation. [Default = 5]")
+    parser.add_argument('--latency', type = float, default = 0, help="Round trip time added to every command, in milliseconds. [Default = 0]")
+    parser.add_argument('--bandwidth', type = parse_size, default = 0, help="Bytes per second allowed on each data connection, e.g. 10M. [Default = no limit]")
+    parser.add_argument('--null', action = 'store_true', help="Write downloads to the null device instead of a temporary directory")
+    parser.add_argument('--baseline', metavar = 'FILE', help="Compare with the results of an earlier run")
+    parser.add_argument('--threshold', type = float, default = 0.10, help="Change that counts as a regression against the baseline. [Default = 0.10]")
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    sizes = [parse_size(size) for size in args.sizes.split(',')]
+    modes = args.modes.split(',')
+    ops = args.ops.split(',')
+    levels = [int(level) for level in args.concurrency.split(',')]
+    baseline = read_results(args.baseline) if args.baseline else {}
+
+    server = BenchmarkServer(args.latency / 1000.0, args.bandwidth)
+    server.start()
+    workdir = tempfile.mkdtemp(prefix = "ftpbench")
+    output = open(args.output, 'w') if args.output else None
+    status = 0
+    try:
+        #Sparse files to upload, so large sizes take no time or disk to create
+        if 'put' in ops:
+            for size in sizes:
+                with open(os.path.join(workdir, "%d.bin" % size), 'wb') as source:
+                    source.truncate(size)
+        if output:
+            output.write(json.dumps({'type': 'run', 'time': time.time(), 'python': platform.python_version(),
+                                     'platform': platform.platform(), 'latency': args.latency,
+                                     'bandwidth': args.bandwidth, 'repeat': args.repeat, 'null': args.null}) + "\n")
+        print("%-4s %-5s %6s %4s %6s %12s %10s %10s %10s" % ("OP", "MODE", "SIZE", "CONC", "COUNT", "THROUGHPUT", "P50 MS", "P99 MS", "RSS GROWTH"))
+        for op in ops:
+            for size in (sizes if op != 'ls' else [None]):
+                for mode in modes:
+                    for concurrency in levels:
+                        result = run_scenario(server, op, mode, size, concurrency, args.repeat, workdir,
+                                              os.devnull if args.null else None)
+                        line = format_result(result)
+                        if result['errors']:
+                            line += "  " + str(result['errors']) + " FAILED"
+                            status = 1
+                        previous = baseline.get(scenario_key(result))
+                        if previous:
+                            regressions = compare(result, previous, args.threshold)
+                            if regressions:
+                                line += "  REGRESSION " + ", ".join(regressions)
+                                status = 1
+                        print(line)
+                        if output:
+                            output.write(json.dumps(result) + "\n")
+                            output.flush()
+    finally:
+        if output:
+            output.close()
+        server.close()
+        shutil.rmtree(workdir, ignore_errors = True)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,7 +3,9 @@
 # Alex M Brown
 # FTPClient.py
 #
-# This module contains all the functions for sending the commands for the FTP client
+# This module contains all the functions for sending the commands for the FTP client.
+# FTPSession holds the state for one connection to a server and can be imported and
+# used on its own; running this file starts the interactive client on top of it.
 
 from socket import *
 from socket import error as socket_error
@@ -15,425 +17,4381 @@ import getpass
 import datetime
 import time
 import os
+import mmap
+import threading
+import atexit
+import glob
+import fnmatch
+import json
+import calendar
+import collections
+import posixpath
+import shlex
+import zlib
+import hashlib
+import io
+import select
+import signal
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    raw_input
+except NameError:
+    raw_input = input
+
+
+
+#GLOBAL VARIABLES
+LOG_FILE = None                                     #Name of the log file (None = don't write a log file)
+BUFFER_SIZE = 8192                                  #Buffer for reading from FTP server
+DATA_BUFFER_SIZE = 65536                            #Buffer for reading from the data connection
+SEND_CHUNK_SIZE = 1048576                           #Size of each write when uploading without sendfile
+CHUNK_SIZE = 0                                      #Size of each read from the data connection (0 = sized from measurements and grown)
+CHUNK_SIZE_MAX = 4194304                            #Largest read from the data connection when reads are grown
+SOCKET_BUFFER = 0                                   #Size of data socket buffers (0 = sized from the bandwidth-delay product)
+SOCKET_BUFFER_MAX = 16777216                        #Largest data socket buffer sized from the bandwidth-delay product
+AUTOTUNING = os.path.exists('/proc/sys/net/ipv4/tcp_moderate_rcvbuf')   #Does the kernel grow socket buffers itself? (Linux)
+BUFFER_LIMITS = None                                #(Autotuning Limit, Largest Buffer That Can Be Set) from the kernel, once read
+RATE_SAMPLE_MIN = 1048576                           #Smallest transfer whose throughput is used to size buffers
+VERBOSE = False                                     #Should the client print logging info to stdout?
+CRLF = "\r\n"
+ENCODING = "utf-8"                                  #Encoding of commands and replies on the control connection
+SUPPORTED_COMMANDS = """\nSupported Commands:
+    about     ascii     binary    cd
+    compress  dir       du        eprt
+    epsv      find      get       help
+    limit     ls        mget      mirror
+    mput      pasv      pget      port
+    priority  put       pwd       quit
+    reget     reput     resume    stats
+    tune      verify\n"""
+POOL_SIZE = 4                                       #Number of control connections used by mget/mput/pget
+SEGMENT_MIN_SIZE = 1048576                          #Smallest byte range pget fetches on its own connection
+CHECKPOINT_BYTES = 4194304                          #Bytes downloaded between journal checkpoints
+JOURNAL_FILE = ".ftp_journal"                       #File that records unfinished reget/reput transfers
+JOURNAL_INTERVAL = 1.0                              #Least seconds between rewrites of the journal
+RETRY_LIMIT = 5                                     #Reconnect attempts before a resumable transfer gives up
+RETRY_DELAY = 1.0                                   #Seconds before the first reconnect, doubled after each failure
+RETRY_MAX_DELAY = 60.0                              #Longest wait between reconnects
+LOG_QUEUE_SIZE = 10000                              #Log lines held in memory before new ones are dropped
+LOG_FLUSH_INTERVAL = 1.0                            #Seconds between flushes of the log file
+LOG_MAX_BYTES = 10485760                            #Size at which the log file is rotated (0 = never)
+LOG_BACKUPS = 3                                     #Number of rotated log files to keep
+LOG_STOP_TIMEOUT = 5.0                              #Most seconds spent at exit writing out queued log lines
+LOG_WRITER = None                                   #Background thread that writes the log file
+LOG_LOCK = threading.Lock()                         #Held while the log writer is started or stopped
+LOG_STOPPED = False                                 #Has the log been closed for good? (at exit)
+QUICKACK = 'TCP_QUICKACK' in globals()              #Can replies be acknowledged without delay? (Linux only)
+LISTING_TTL = 30.0                                  #Seconds a cached directory listing stays valid (0 = no cache)
+LISTING_CACHE_SIZE = 256                            #Most directory listings cached per session
+MIRROR_INDEX = ".ftp_mirror"                        #File in a mirrored local directory that records the last run
+METRICS_FILE = None                                 #Where to write the metrics when the client exits (None = don't)
+METRICS_FORMAT = "json"                             #Format of METRICS_FILE, json or prometheus
+BANDWIDTH_LIMIT = 0                                 #Bytes per second shared by all transfers (0 = no limit)
+TRANSFER_LIMIT = 0                                  #Bytes per second for each transfer on its own (0 = no limit)
+BANDWIDTH_BURST = 0.25                              #Seconds of traffic a transfer may send at once after being idle
+PRIORITY_WEIGHTS = {'high': 4, 'normal': 2, 'low': 1}   #Share of the global limit for each priority class
+COMPRESSION = False                                 #Send data in MODE Z (deflate) when the server offers it
+COMPRESSION_LEVEL = 6                               #zlib level used for uploads in MODE Z, 1 (fast) to 9 (small)
+TRANSFER_TYPE = "I"                                 #TYPE for get and put: I (binary) or A (ASCII, line endings converted)
+VERIFY = None                                       #Checksum to verify transfers with: auto, crc32, md5, sha256 (None = off)
+VERIFY_RETRIES = 2                                  #Times a transfer that fails verification is repeated
+HASH_NAMES = collections.OrderedDict([('sha256', 'SHA-256'), ('md5', 'MD5'), ('crc32', 'CRC32')])   #Strongest first
+KEEPALIVE_INTERVAL = 60.0                           #Seconds between NOOPs on the session daemon's idle connections
+DAEMON_WAIT = 30.0                                  #Seconds a thin client waits for the session daemon to free a session
+
+
+"""
+Used for logging commands/replies/other important notes
+Logs a written to a log file. If the -v flag was set, they are also written to stdout.
+The line is handed to the background log writer, so this never waits on the disk.
+Once logging has been stopped, lines are no longer written to the log file.
+Input:
+    msg: The message to be logged
+"""
+def log(msg):
+    if LOG_FILE:
+        writer = LOG_WRITER or start_logging()
+        if writer:
+            writer.write(str(datetime.datetime.now())[:-3] + ": "+msg + "\n")
+    if VERBOSE:
+        print("#LOG: " + msg)
+
+
+"""
+Background thread that owns the log file
+Lines are queued by log() and written in batches every LOG_FLUSH_INTERVAL seconds.
+If the queue is full the line is dropped and counted rather than blocking the caller.
+The log file is rotated once it grows past LOG_MAX_BYTES.
+"""
+class LogWriter(threading.Thread):
+    STOP = None
+
+    def __init__(self, filename, queue_size = LOG_QUEUE_SIZE, flush_interval = LOG_FLUSH_INTERVAL,
+                 max_bytes = LOG_MAX_BYTES, backups = LOG_BACKUPS):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.filename = filename
+        self.lines = queue.Queue(queue_size)
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.dropped = 0
+        self.logfile = None
+
+    def write(self, line):
+        try:
+            self.lines.put_nowait(line)
+        except queue.Full:
+            self.dropped += 1
+
+    """
+    Asks the writer to write out what is queued and finish, waiting at most timeout seconds
+    A writer that has died (e.g. the disk filled up) no longer empties the queue, so
+    nothing is waited on for it; one that is stuck on the disk is left behind.
+    """
+    def stop(self, timeout = LOG_STOP_TIMEOUT):
+        if not self.is_alive():
+            return
+        try:
+            self.lines.put(self.STOP, timeout = timeout)
+        except queue.Full:
+            return
+        self.join(timeout)
+
+    def run(self):
+        self.logfile = open(self.filename, 'a+')
+        running = True
+        while running:
+            batch = []
+            try:
+                batch.append(self.lines.get(timeout = self.flush_interval))
+                while True:
+                    batch.append(self.lines.get_nowait())
+            except queue.Empty:
+                pass
+            if self.STOP in batch:
+                batch = batch[:batch.index(self.STOP)]
+                running = False
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                batch.append(str(datetime.datetime.now())[:-3] + ": Dropped " + str(dropped) + " log messages\n")
+            if batch:
+                self.logfile.write(''.join(batch))
+                self.logfile.flush()
+                if self.max_bytes and self.logfile.tell() >= self.max_bytes:
+                    self.rotate()
+        self.logfile.close()
+
+    def rotate(self):
+        self.logfile.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(self.filename + "." + str(i)):
+                os.rename(self.filename + "." + str(i), self.filename + "." + str(i + 1))
+        if self.backups > 0:
+            os.rename(self.filename, self.filename + ".1")
+        else:
+            os.remove(self.filename)
+        self.logfile = open(self.filename, 'a+')
+
+
+"""
+Starts the background log writer for LOG_FILE, unless one is running or logging has been stopped
+Output:
+    LogWriter : The running log writer, or None once logging has been stopped
+"""
+def start_logging():
+    global LOG_WRITER
+    with LOG_LOCK:
+        if not LOG_WRITER and not LOG_STOPPED:
+            LOG_WRITER = LogWriter(LOG_FILE, LOG_QUEUE_SIZE, LOG_FLUSH_INTERVAL, LOG_MAX_BYTES, LOG_BACKUPS)
+            LOG_WRITER.start()
+        return LOG_WRITER
+
+
+"""
+Writes out every queued log line and stops the background log writer
+"""
+def stop_logging():
+    global LOG_WRITER, LOG_STOPPED
+    with LOG_LOCK:
+        writer, LOG_WRITER = LOG_WRITER, None
+        LOG_STOPPED = True
+    if writer:
+        writer.stop()
+
+atexit.register(stop_logging)
+
+
+"""
+Counts observations in fixed buckets, so percentiles can be estimated without keeping every value
+Input:
+    bounds: The upper bound of each bucket, in increasing order. Larger values go in a last, open bucket
+"""
+class Histogram(object):
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.low = None
+        self.high = None
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.bounds) and value > self.bounds[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.low = value if self.low is None else min(self.low, value)
+        self.high = value if self.high is None else max(self.high, value)
+
+    """
+    Estimates a percentile by interpolating inside the bucket it falls in
+    Input:
+        fraction: e.g. 0.99 for the 99th percentile
+    Output:
+        The estimate, or None if nothing was observed
+    """
+    def quantile(self, fraction):
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.bounds[index - 1] if index > 0 else self.low
+                upper = self.bounds[index] if index < len(self.bounds) else self.high
+                lower, upper = max(lower, self.low), min(upper, self.high)
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.high
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': self.total, 'min': self.low, 'max': self.high,
+                'p50': self.quantile(0.5), 'p90': self.quantile(0.9), 'p99': self.quantile(0.99),
+                'buckets': [[bound, count] for bound, count in zip(self.bounds + ['+Inf'], self.counts)]}
+
+
+"""
+Histograms of command round trips, data connection setup and transfers for the whole process
+Every session records into the same registry, so pooled connections are counted too.
+"""
+class Metrics(object):
+    SECONDS = [0.0005 * 2 ** power for power in range(18)]             #0.5 ms to 65 s
+    BYTES = [1024 * 4 ** power for power in range(13)]                  #1 KiB to 16 GiB
+    RATES = [1024 * 4 ** power for power in range(13)]                  #1 KiB/s to 16 GiB/s
+    KINDS = collections.OrderedDict([
+        ('ftp_command_seconds', ('command', SECONDS, "Time from sending a command to reading its reply")),
+        ('ftp_pipelined_seconds', ('command', SECONDS, "Wait for the reply to a command sent behind others in one write")),
+        ('ftp_data_setup_seconds', ('mode', SECONDS, "Time to get a data connection ready, by mode")),
+        ('ftp_transfer_bytes', ('direction', BYTES, "Bytes moved per transfer")),
+        ('ftp_transfer_seconds', ('direction', SECONDS, "Duration of each transfer")),
+        ('ftp_transfer_bytes_per_second', ('direction', RATES, "Throughput of each transfer"))])
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.histograms = collections.OrderedDict()                 #(Name, Label) -> Histogram
+            self.started = time.time()
+
+    def observe(self, name, label, value):
+        with self.lock:
+            histogram = self.histograms.get((name, label))
+            if not histogram:
+                histogram = self.histograms[(name, label)] = Histogram(self.KINDS[name][1])
+            histogram.observe(value)
+
+    """
+    Records the size, duration and throughput of one transfer
+    Input:
+        direction: e.g. 'get', 'put' or 'list'
+        count: Bytes moved
+        seconds: How long it took
+    """
+    def transfer(self, direction, count, seconds):
+        self.observe('ftp_transfer_bytes', direction, count)
+        self.observe('ftp_transfer_seconds', direction, seconds)
+        if seconds > 0:
+            self.observe('ftp_transfer_bytes_per_second', direction, count / seconds)
+
+    def to_json(self):
+        with self.lock:
+            metrics = {}
+            for (name, label), histogram in self.histograms.items():
+                metrics.setdefault(name, {})[label] = histogram.to_dict()
+            return json.dumps({'started': self.started, 'elapsed': time.time() - self.started, 'metrics': metrics}, indent = 1)
+
+    """
+    Formats the histograms in the Prometheus text exposition format
+    Output:
+        str : The metrics, one sample per line
+    """
+    def to_prometheus(self):
+        lines = []
+        with self.lock:
+            for name, (label_name, bounds, description) in self.KINDS.items():
+                series = [(label, histogram) for (kind, label), histogram in self.histograms.items() if kind == name]
+                if not series:
+                    continue
+                lines.append("# HELP " + name + " " + description)
+                lines.append("# TYPE " + name + " histogram")
+                for label, histogram in series:
+                    label = label_name + '="' + str(label).replace('\\', '\\\\').replace('"', '\\"') + '"'
+                    cumulative = 0
+                    for bound, count in zip(bounds + ['+Inf'], histogram.counts):
+                        cumulative += count
+                        lines.append("%s_bucket{%s,le=\"%s\"} %d" % (name, label, bound, cumulative))
+                    lines.append("%s_sum{%s} %r" % (name, label, histogram.total))
+                    lines.append("%s_count{%s} %d" % (name, label, histogram.count))
+        return "\n".join(lines) + "\n"
+
+    """
+    Formats a summary table for the stats command
+    Output:
+        str : One line per histogram with its count, mean, p50, p99 and max
+    """
+    def summary(self):
+        lines = ["%-32s %-10s %8s %12s %12s %12s %12s" % ("METRIC", "LABEL", "COUNT", "MEAN", "P50", "P99", "MAX")]
+        with self.lock:
+            names = list(self.KINDS)
+            for (name, label), histogram in sorted(self.histograms.items(), key = lambda item: (names.index(item[0][0]), item[0][1])):
+                values = [histogram.total / histogram.count, histogram.quantile(0.5), histogram.quantile(0.99), histogram.high]
+                unit = "%12.4f" if name.endswith('seconds') else "%12.0f"
+                lines.append("%-32s %-10s %8d " % (name[4:], label, histogram.count) + " ".join([unit % value for value in values]))
+        return "\n".join(lines)
+
+METRICS = Metrics()
+
+
+"""
+Writes the metrics to METRICS_FILE, if one was given, when the client exits
+"""
+def write_metrics():
+    if not METRICS_FILE:
+        return
+    try:
+        with open(METRICS_FILE, 'w') as output:
+            output.write(METRICS.to_prometheus() if METRICS_FORMAT == 'prometheus' else METRICS.to_json())
+    except IOError as e:
+        print("Could not write metrics: " + str(e))
+
+atexit.register(write_metrics)
+
+
+"""
+Parses a transfer rate such as 512K, 10M or 1G (bytes per second)
+Input:
+    text: The rate. 0, off or none mean no limit
+Output:
+    int : Bytes per second, 0 for no limit
+"""
+def parse_rate(text):
+    text = text.strip().upper()
+    if text in ('OFF', 'NONE', ''):
+        return 0
+    match = re.match(r'^(\d+(?:\.\d+)?)([KMG]?)(?:B|B/S)?$', text)
+    if not match:
+        raise ValueError("Not a rate: " + text)
+    return int(float(match.group(1)) * {'': 1, 'K': 1024, 'M': 1048576, 'G': 1073741824}[match.group(2)])
+
+
+"""
+One transfer's share of the bandwidth scheduler
+The flow holds a token bucket filled at the rate the scheduler gives it.
+consume() is called after each chunk and sleeps while the flow is over its rate.
+Transfers with no limits never sleep or take the lock.
+
+Input:
+    scheduler: The BandwidthScheduler
+    priority: The priority class, a key of PRIORITY_WEIGHTS
+    cap: Most bytes per second for this transfer, 0 for no cap of its own
+"""
+class Flow(object):
+    def __init__(self, scheduler, priority, cap):
+        self.scheduler = scheduler
+        self.priority = priority if priority in PRIORITY_WEIGHTS else 'normal'
+        self.weight = PRIORITY_WEIGHTS[self.priority]
+        self.cap = cap
+        self.rate = None                            #Bytes per second given by the scheduler (None = unlimited)
+        self.tokens = 0.0
+        self.stamp = time.time()
+
+    def limited(self):
+        return self.rate is not None
+
+    """
+    Accounts for count bytes that were just moved, sleeping if the flow is ahead of its rate
+    Input:
+        count: The number of bytes moved
+    """
+    def consume(self, count):
+        if self.rate is None:
+            return
+        with self.scheduler.lock:
+            rate = self.rate
+            if rate is None:
+                return
+            now = time.time()
+            burst = max(rate * BANDWIDTH_BURST, DATA_BUFFER_SIZE)
+            self.tokens = min(burst, self.tokens + (now - self.stamp) * rate) - count
+            self.stamp = now
+            delay = -self.tokens / rate if self.tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+    def close(self):
+        self.scheduler.release(self)
+
+
+"""
+Shares bandwidth between every transfer in the process
+The global rate is split between the running transfers in proportion to the
+weight of their priority class. A transfer with its own cap below its share
+keeps only the cap, and what it leaves is shared among the rest.
+
+Input:
+    rate: Optional. Global limit in bytes per second, 0 for no limit
+"""
+class BandwidthScheduler(object):
+    def __init__(self, rate = 0):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.flows = []
+
+    """
+    Starts accounting for a transfer
+    Input:
+        priority: Optional. The priority class (default 'normal')
+        cap: Optional. Most bytes per second for this transfer (default no cap)
+    Output:
+        Flow : Call consume() as data moves and close() when the transfer ends
+    """
+    def open(self, priority = 'normal', cap = 0):
+        flow = Flow(self, priority, cap or 0)
+        with self.lock:
+            self.flows.append(flow)
+            self.share()
+        return flow
+
+    def release(self, flow):
+        with self.lock:
+            if flow in self.flows:
+                self.flows.remove(flow)
+                self.share()
+
+    """
+    Changes the global limit; running transfers pick up the new rate with their next chunk
+    Input:
+        rate: Bytes per second, 0 for no limit
+    """
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate
+            self.share()
+
+    """
+    Works out the rate of every flow. Must be called with the lock held
+    """
+    def share(self):
+        pending = list(self.flows)
+        if not self.rate:
+            for flow in pending:
+                flow.rate = flow.cap or None
+            return
+        remaining = float(self.rate)
+        while pending:
+            weight = float(sum([flow.weight for flow in pending]))
+            capped = [flow for flow in pending if flow.cap and flow.cap < remaining * flow.weight / weight]
+            if not capped:
+                for flow in pending:
+                    flow.rate = remaining * flow.weight / weight
+                return
+            for flow in capped:
+                flow.rate = flow.cap
+                remaining -= flow.cap
+                pending.remove(flow)
+
+    """
+    Describes the limits and the running transfers for the limit command
+    Output:
+        str : One line for the global limit and one per running transfer
+    """
+    def summary(self):
+        with self.lock:
+            lines = ["Global limit: " + (format_rate(self.rate, 1) if self.rate else "none")]
+            for flow in self.flows:
+                lines.append("  %-6s transfer at %s" % (flow.priority, format_rate(flow.rate, 1) if flow.rate else "full speed"))
+        return "\n".join(lines)
+
+SCHEDULER = BandwidthScheduler(BANDWIDTH_LIMIT)
+
+
+"""
+Raised when a session cannot carry on, e.g. the control connection was lost
+"""
+class FTPError(Exception):
+    pass
+
+
+"""
+Shut down the client with an error message
+Input:
+    msg: The message to be logged
+    session: Optional. The session whose connections should be closed
+"""
+def terminate(msg, session = None):
+    log("FATAL ERROR: " + msg)
+    print("A fatal error has occured: " + msg)
+    if session:
+        session.close()
+    stop_logging()
+    exit(1)
+
+
+"""
+Converts text to the bytes sent over the control connection
+Input:
+    text: A command or path
+Output:
+    bytes : The encoded text. Bytes are passed through unchanged
+"""
+def encode(text):
+    if isinstance(text, bytes):
+        return text
+    return text.encode(ENCODING, 'surrogateescape' if bytes is not str else 'strict')
+
+
+"""
+Converts bytes read from a connection to text
+Input:
+    data: Bytes read from a socket
+Output:
+    str : The decoded text. Strings are passed through unchanged
+"""
+def decode(data):
+    if isinstance(data, str):
+        return data
+    return data.decode(ENCODING, 'surrogateescape')
+
+
+"""
+Streams everything from the data connection until the server closes it.
+Data is read into one preallocated buffer that is reused for every recv, and each
+chunk is yielded as soon as it arrives. A yielded chunk is a view of that buffer,
+so it is only valid until the next chunk is requested.
+Input:
+    socket: The socket to read everything from
+    chunk_size: Size of the receive buffer
+    flow: Optional. The bandwidth scheduler flow to account each chunk to
+    grow_to: Optional. Whenever a recv fills the buffer, more data is waiting, so the
+             buffer is doubled up to this size (default keep chunk_size). A paced flow is not grown.
+Output:
+    memoryview : The bytes read by each recv, in order
+"""
+def recv_stream(socket, chunk_size = DATA_BUFFER_SIZE, flow = None, grow_to = None):
+    log("Reading info from the data connection...")
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    count = 0
+    while(True):
+        if grow_to and count == len(buf) and len(buf) < grow_to and not (flow and flow.limited()):
+            buf = bytearray(min(len(buf) * 2, grow_to))
+            view = memoryview(buf)
+        try:
+            count = socket.recv_into(buf)
+        except socket_error as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if count == 0:
+            return
+        if flow:
+            flow.consume(count)
+        yield view[:count]
+
+
+"""
+Decompresses a MODE Z (deflate) data stream as it arrives
+Each piece of output is at most chunk_size bytes, however well the data
+compressed, so memory use stays bounded.
+Input:
+    chunks: The compressed chunks, e.g. from recv_stream
+    chunk_size: Optional. Most bytes of output at a time
+Output:
+    memoryview : The decompressed data, in order
+"""
+def inflate_stream(chunks, chunk_size = DATA_BUFFER_SIZE):
+    inflater = zlib.decompressobj()
+    for chunk in chunks:
+        data = inflater.decompress(chunk.tobytes(), chunk_size)
+        while True:
+            if data:
+                yield memoryview(data)
+            if not inflater.unconsumed_tail:
+                break
+            data = inflater.decompress(inflater.unconsumed_tail, chunk_size)
+    data = inflater.flush()
+    if data:
+        yield memoryview(data)
+
+
+"""
+A checksum computed over a file's data as it passes through a transfer
+Input:
+    algorithm: 'crc32', 'md5' or 'sha256'
+"""
+class StreamHash(object):
+    def __init__(self, algorithm):
+        self.algorithm = algorithm
+        self.crc = 0
+        self.hash = None if algorithm == 'crc32' else hashlib.new(algorithm)
+
+    def update(self, data):
+        if self.hash:
+            self.hash.update(data)
+            return
+        try:
+            self.crc = zlib.crc32(data, self.crc)
+        except TypeError:
+            self.crc = zlib.crc32(data.tobytes(), self.crc)     #Python 2 zlib takes no memoryview
+
+    def hexdigest(self):
+        return self.hash.hexdigest() if self.hash else "%08x" % (self.crc & 0xffffffff)
+
+
+"""
+Rewrites line endings in a stream of text for ASCII transfers
+Both CRLF and LF line endings become newline. A CR at the end of one chunk
+is held back until the next chunk shows whether an LF follows it.
+Input:
+    newline: The line ending to write, e.g. CRLF for the network or os.linesep for local files
+"""
+class NewlineConverter(object):
+    def __init__(self, newline):
+        self.newline = newline.encode('ascii')
+        self.pending = b""
+
+    def convert(self, data):
+        data = self.pending + (data.tobytes() if isinstance(data, memoryview) else data)
+        self.pending = b""
+        if data.endswith(b"\r"):
+            data, self.pending = data[:-1], b"\r"
+        data = data.replace(b"\r\n", b"\n")
+        if not self.newline == b"\n":
+            data = data.replace(b"\n", self.newline)
+        return data
+
+    def flush(self):
+        data, self.pending = self.pending, b""
+        return data
+
+
+"""
+Used for receiving information from the data connection.
+Input:
+    socket: The socket to read everything from
+    flow: Optional. The bandwidth scheduler flow to account the data to
+    decompress: Optional. The data is sent in MODE Z
+Output:
+    data: All of the data read from socket
+"""
+def recvall(socket, flow = None, decompress = False):
+    chunks = recv_stream(socket, flow = flow)
+    if decompress:
+        chunks = inflate_stream(chunks)
+    return b"".join([chunk.tobytes() for chunk in chunks])
+
+
+"""
+Splits data from the data connection into lines as it arrives
+Only the part of a line not yet complete is held back, so memory use does not
+grow with the amount of data.
+Input:
+    chunks: The data, e.g. from recv_stream
+Output:
+    bytes : Each line, with its line ending. The last one may have none
+"""
+def read_lines(chunks):
+    partial = b""
+    for chunk in chunks:
+        lines = (partial + chunk.tobytes()).split(b"\n")
+        partial = lines.pop()
+        for line in lines:
+            yield line + b"\n"
+    if partial:
+        yield partial
+
+"""
+Establishes a connection between the client and the server
+Input:
+    str network : The network address of the server
+    int port    : The port number of the server (default 21)
+    int buffer_size : Optional. Size of the socket's send and receive buffers (default the kernel's)
+Output:
+    On success, returns the socket for the control connection
+    On fail, returns None
+"""
+def establish_connection(network, port = 21, buffer_size = None):
+    CONNECTION = socket(AF_INET, SOCK_STREAM)
+    log("Establishing connection at " + str((network, port)))
+    set_buffers(CONNECTION, buffer_size)            #Before connect, so the window scale covers it
+    try:
+        CONNECTION.settimeout(5)
+        CONNECTION.connect((network, port))
+        return CONNECTION
+    except socket_error as e:
+        log("An unexpected error occured during connection establishment: " + str(e))
+        CONNECTION.close()
+        return None
+
+
+
+"""
+Sets the size of a socket's send and receive buffers
+The kernel may round the size or cap it (net.core.rmem_max on Linux).
+Input:
+    socket: The socket, before it connects or listens
+    size: The size in bytes, or None to leave the kernel's
+"""
+def set_buffers(socket, size):
+    if not size:
+        return
+    try:
+        socket.setsockopt(SOL_SOCKET, SO_RCVBUF, size)
+        socket.setsockopt(SOL_SOCKET, SO_SNDBUF, size)
+    except socket_error as e:
+        log("Could not set socket buffers to " + str(size) + " bytes: " + str(e))
+
+
+"""
+Reads how far Linux grows a receive buffer by itself, and how large one may be set
+Setting a size turns autotuning off for the socket, and the kernel keeps twice
+the size asked for, up to twice net.core.rmem_max.
+Output:
+    tuple : (Autotuning Limit, Largest Buffer That Can Be Set) in bytes, 0 where unknown
+"""
+def kernel_buffer_limits():
+    global BUFFER_LIMITS
+    if BUFFER_LIMITS is None:
+        limits = []
+        for name, field in (('/proc/sys/net/ipv4/tcp_rmem', 2), ('/proc/sys/net/core/rmem_max', 0)):
+            try:
+                with open(name) as setting:
+                    limits.append(int(setting.read().split()[field]))
+            except (IOError, OSError, ValueError, IndexError):
+                limits.append(0)
+        BUFFER_LIMITS = (limits[0], 2 * limits[1])
+    return BUFFER_LIMITS
+
+
+"""
+Converts the FTP format (h1,h2,h3,h4,p1,p2) into a socket address
+Input:
+    str headers : A string in the format h1,h2,h3,h4,p1,p2
+OutputL
+    tuple : (IP_ADDR, PORT_NUM)
+"""
+def get_socket_address(headers):
+    address_fields = headers.split(',')
+    DEST_IP = '.'.join(address_fields[0:4])
+    DEST_PORT = int(address_fields[4]) * 256 + int(address_fields[5])
+    return (DEST_IP,DEST_PORT)
+
+
+
+"""
+Reads complete FTP replies from the control connection
+Replies are buffered and split on line endings, so a reply split across TCP
+segments, several replies in one segment and multi-line replies (RFC 959
+"123-" ... "123 ") all come out as one complete reply each.
+"""
+class ReplyReader(object):
+    def __init__(self, socket):
+        self.socket = socket
+        self.buffer = b""
+        self.quickack = QUICKACK and socket.family == AF_INET  #Not for a session daemon's Unix socket
+
+    def read_line(self):
+        end = self.buffer.find(b"\n")
+        while end < 0:
+            if self.quickack:
+                #Acknowledge replies at once. Servers that use Nagle's algorithm hold back
+                #a second reply (e.g. 150 after 227) until the first one is acknowledged
+                self.socket.setsockopt(IPPROTO_TCP, TCP_QUICKACK, 1)
+            data = self.socket.recv(BUFFER_SIZE)
+            if not data:
+                raise socket_error(errno.ECONNRESET, "Control connection closed by server")
+            self.buffer += data
+            end = self.buffer.find(b"\n")
+        line = self.buffer[:end + 1]
+        self.buffer = self.buffer[end + 1:]
+        return line
+
+    def read_reply(self):
+        line = self.read_line()
+        lines = [line]
+        if line[3:4] == b"-":
+            last = line[:3] + b" "
+            while not line.startswith(last):
+                line = self.read_line()
+                lines.append(line)
+        return b"".join(lines)
+
+
+"""
+Separates the response code and the response message from a server reply
+Input:
+    reply: An FTP server message
+Output:
+    tuple : (Response Code, Response Message)
+"""
+def parse_response(reply):
+    if not reply:
+        return None
+
+    code = reply[0:3]
+    text = reply[4:-2]
+    return (code,text)
+
+
+"""
+Send a file along a socket
+The kernel copies the file straight into the socket with sendfile where the
+platform supports it. Otherwise the file is memory-mapped and pushed with
+sendall in large chunks, so partial writes never drop data. An open stream,
+such as stdin, is read and sent a chunk at a time, so only one chunk is held
+in memory and a slow connection holds back reading.
+Input:
+    socket: The socket to transmit the data over
+    filename: The name of the file to be sent, or an open file-like object to read from
+    chunk_size: Optional. Size of each write in the fallback path
+    offset: Optional. Where in the file to start sending from (files only)
+    flow: Optional. The bandwidth scheduler flow to account the data to; a limited flow
+          is sent in chunks instead of with sendfile so it can be paced
+    compress: Optional. zlib level to deflate the data with for MODE Z (default send it as is)
+    digest: Optional. A StreamHash to update with the file's data as it is sent
+    newline: Optional. Convert line endings to this for an ASCII transfer (default send the bytes as they are)
+Output:
+    tuple : (Bytes Sent, Elapsed Seconds), or None if the file could not be opened
+"""
+def sendFile(socket, filename, chunk_size = SEND_CHUNK_SIZE, offset = 0, flow = None, compress = None,
+             digest = None, newline = None):
+    stream = hasattr(filename, 'read')
+    sendFile = None
+    start = time.time()
+    try:
+        try:
+            sendFile = filename if stream else open(filename, "rb")
+        except IOError as e:
+            print("File path does not exist.")
+            return None
+        if stream:
+            read = getattr(sendFile, 'read1', sendFile.read)  #Send what has arrived instead of waiting for a full chunk
+            sent = send_chunks(socket, iter(lambda: read(chunk_size), b""), flow, compress, digest, newline)
+        elif hasattr(socket, 'sendfile') and not (flow and flow.limited() or compress is not None or digest or newline):
+            sent = socket.sendfile(sendFile, offset)
+        else:
+            sent = sendMapped(socket, sendFile, chunk_size, offset, flow, compress, digest, newline)
+    finally:
+        if sendFile and not stream:
+            sendFile.close()
+        socket.close()
+    elapsed = time.time() - start
+    log("Sent " + str(sent) + " bytes in " + str(round(elapsed, 3)) + " seconds")
+    return (sent, elapsed)
+
+
+"""
+Send an open file along a socket by memory-mapping it
+Input:
+    socket: The socket to transmit the data over
+    fileobj: The open file to send
+    chunk_size: Size of each write
+    offset: Optional. Where in the file to start sending from
+    flow: Optional. The bandwidth scheduler flow to account each write to
+    compress: Optional. zlib level to deflate each chunk with as it is sent
+    digest: Optional. A StreamHash to update with each chunk of the file
+    newline: Optional. Convert line endings to this as each chunk is sent
+Output:
+    The number of bytes of the file sent
+"""
+def sendMapped(socket, fileobj, chunk_size, offset = 0, flow = None, compress = None, digest = None,
+               newline = None):
+    size = os.fstat(fileobj.fileno()).st_size
+    if size <= offset:
+        return send_chunks(socket, [], flow, compress, digest, newline)
+    mapped = mmap.mmap(fileobj.fileno(), 0, access = mmap.ACCESS_READ)
+    try:
+        view = memoryview(mapped)
+    except TypeError:
+        view = mapped                               #Older mmaps can only be sliced
+    try:
+        return send_chunks(socket, (view[position:position + chunk_size] for position in range(offset, size, chunk_size)),
+                           flow, compress, digest, newline)
+    finally:
+        if isinstance(view, memoryview):
+            view.release()
+        mapped.close()
+
+
+"""
+Sends chunks of a file along a socket, applying the transfer's options to each one in turn
+Input:
+    socket: The socket to transmit the data over
+    chunks: The file's data, in order
+    flow: Optional. The bandwidth scheduler flow to account each write to
+    compress: Optional. zlib level to deflate each chunk with as it is sent
+    digest: Optional. A StreamHash to update with each chunk of the file
+    newline: Optional. Convert line endings to this as each chunk is sent
+Output:
+    The number of bytes of the file sent
+"""
+def send_chunks(socket, chunks, flow = None, compress = None, digest = None, newline = None):
+    deflater = zlib.compressobj(compress) if compress is not None else None
+    converter = NewlineConverter(newline) if newline else None
+    sent = 0
+    data = None
+    try:
+        for data in chunks:
+            sent += len(data)
+            if digest:
+                digest.update(data)
+            if converter:
+                data = converter.convert(data)
+            if deflater:
+                data = deflater.compress(data)
+            socket.sendall(data)
+            if flow:
+                flow.consume(len(data))
+        data = converter.flush() if converter else b""
+        if deflater:
+            data = deflater.compress(data) + deflater.flush()
+        if data:
+            socket.sendall(data)
+            if flow:
+                flow.consume(len(data))
+    finally:
+        data = None                                 #A chunk from a memory map must go before the map can close
+    return sent
+
+
+"""
+Read the data for a file being send over the data connection.
+Each chunk is written to disk as soon as it arrives, so memory use is bounded
+by chunk_size no matter how large the file is. An open stream, such as stdout,
+is written to the same way; a stream that is slow to take the data holds back
+reading from the connection.
+Input:
+    socket: The socket for the data connection
+    filename: The name of the file to save the data under, or an open file-like object to write to
+    chunk_size: Optional. Size of the receive buffer
+    fsync: Optional. Flush the file to disk before returning
+    preallocate: Optional. Expected size of the file, reserved on disk up front (files only)
+    offset: Optional. Keep the first offset bytes of an existing file and write after them (files only)
+    checkpoint: Optional. Called with the size of the file on disk every CHECKPOINT_BYTES
+                and when the transfer ends, after the data has been flushed
+    flow: Optional. The bandwidth scheduler flow to account each chunk to
+    decompress: Optional. The data is sent in MODE Z
+    digest: Optional. A StreamHash to update with each chunk as it is written
+    newline: Optional. Convert line endings to this for an ASCII transfer (default write the bytes as they are)
+    grow_to: Optional. Let the receive buffer grow up to this size while the data keeps it full
+Output:
+    tuple : (Bytes Written, Elapsed Seconds), or None if the file could not be opened
+"""
+def readFile(socket, filename, chunk_size = DATA_BUFFER_SIZE, fsync = False, preallocate = None,
+             offset = 0, checkpoint = None, flow = None, decompress = False, digest = None, newline = None,
+             grow_to = None):
+    stream = hasattr(filename, 'write')
+    try:
+        newFile = filename if stream else open(filename, "r+b" if offset else "wb+")
+    except IOError as e:
+        print("File path does not exist.")
+        return None
+    if stream:
+        offset = 0
+        preallocate = None
+    if offset:
+        newFile.seek(offset)
+        newFile.truncate()
+    if preallocate:
+        preallocate_file(newFile, offset + preallocate)
+        newFile.seek(offset)
+    start = time.time()
+    written = 0
+    unsaved = 0
+    chunks = recv_stream(socket, chunk_size, flow, grow_to)
+    if decompress:
+        chunks = inflate_stream(chunks, chunk_size)
+    converter = NewlineConverter(newline) if newline else None
+    try:
+        for chunk in chunks:
+            if converter:
+                chunk = converter.convert(chunk)
+            newFile.write(chunk)
+            if digest:
+                digest.update(chunk)
+            written += len(chunk)
+            unsaved += len(chunk)
+            if checkpoint and unsaved >= CHECKPOINT_BYTES:
+                flush_file(newFile, fsync)
+                checkpoint(offset + written)
+                unsaved = 0
+        if converter:
+            chunk = converter.flush()
+            newFile.write(chunk)
+            if digest:
+                digest.update(chunk)
+            written += len(chunk)
+    finally:
+        if preallocate and preallocate != written:
+            newFile.truncate(offset + written)
+        flush_file(newFile, fsync and not stream)
+        if not stream:
+            newFile.close()
+        if checkpoint:
+            checkpoint(offset + written)
+    elapsed = time.time() - start
+    log("Received " + str(written) + " bytes in " + str(round(elapsed, 3)) + " seconds")
+    return (written, elapsed)
+
+
+"""
+Pushes everything written to a file out of Python's buffers
+Input:
+    fileobj: The open file
+    fsync: Also wait for the operating system to put it on disk
+"""
+def flush_file(fileobj, fsync):
+    fileobj.flush()
+    if fsync:
+        os.fsync(fileobj.fileno())
+
+
+"""
+Reserve space on disk for a file that is about to be written
+Uses fallocate where the platform has it, so the blocks are actually allocated,
+and falls back to extending the file.
+Input:
+    fileobj: The open file
+    size: The number of bytes to reserve
+"""
+def preallocate_file(fileobj, size):
+    fileobj.flush()
+    try:
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(fileobj.fileno(), 0, size)
+        else:
+            fileobj.truncate(size)
+    except (IOError, OSError) as e:
+        log("Could not preallocate " + str(size) + " bytes: " + str(e))
+    fileobj.seek(0)
+
+
+"""
+Finds the size of a transfer announced in a 150 reply, e.g. "(1234 bytes)"
+Input:
+    text: The message of the 150 reply
+Output:
+    The announced size, or None if the server did not give one
+"""
+def get_transfer_size(text):
+    size = re.search(r'\((\d+) bytes\)', text)
+    if size:
+        return int(size.group(1))
+    return None
+
+
+#DIRECTORY LISTINGS
+
+"""
+One entry of a directory listing
+name is the file name, type is 'file', 'dir' or 'link', size is in bytes and
+mtime is seconds since the epoch (UTC). size and mtime are None if the server did not give them.
+"""
+DirEntry = collections.namedtuple('DirEntry', ['name', 'type', 'size', 'mtime'])
+
+MONTHS = dict((month, index + 1) for index, month in enumerate(['jan', 'feb', 'mar', 'apr', 'may', 'jun',
+                                                               'jul', 'aug', 'sep', 'oct', 'nov', 'dec']))
+UNIX_LIST = re.compile(r'^([\-dlbcps])\S{9}\S*\s+\d+\s+\S+\s+(?:\S+\s+)?(\d+)\s+(\w{3})\s+(\d{1,2})\s+(\d{1,2}:\d{2}|\d{4})\s(.*)$')
+DOS_LIST = re.compile(r'^(\d{2})-(\d{2})-(\d{2,4})\s+(\d{1,2}):(\d{2})([AP]M)\s+(<DIR>|\d+)\s+(.*)$', re.IGNORECASE)
+
+
+"""
+Parses one line of an MLSD listing, e.g. "type=file;size=1000;modify=20240101120000; a.txt"
+Input:
+    line: One line of the listing
+Output:
+    DirEntry, or None for the current and parent directory entries
+"""
+def parse_mlsd_line(line):
+    facts, _, name = line.partition(' ')
+    if not name:
+        return None
+    values = {}
+    for fact in facts.split(';'):
+        key, _, value = fact.partition('=')
+        values[key.lower()] = value
+    kind = values.get('type', '').lower()
+    if kind in ('cdir', 'pdir'):
+        return None
+    if kind.startswith('os.unix=slink') or kind.startswith('os.unix=symlink'):
+        kind = 'link'
+    elif kind != 'dir':
+        kind = 'file'
+    size = values.get('size') or values.get('sizd')
+    mtime = None
+    if values.get('modify'):
+        try:
+            mtime = calendar.timegm(time.strptime(values['modify'][:14], '%Y%m%d%H%M%S'))
+        except ValueError:
+            pass
+    return DirEntry(name, kind, int(size) if size and size.isdigit() else None, mtime)
+
+
+"""
+Parses one line of a LIST listing in the Unix "ls -l" or Windows "dir" format
+Unix listings leave out the year for recent files, so it is taken to be the
+latest year that does not put the file in the future.
+Input:
+    line: One line of the listing
+    now: Optional. The current time, used to fill in missing years
+Output:
+    DirEntry, or None if the line is not an entry (e.g. "total 12")
+"""
+def parse_list_line(line, now = None):
+    match = UNIX_LIST.match(line)
+    if match:
+        kind, size, month, day, clock, name = match.groups()
+        if name in ('.', '..'):
+            return None
+        kind = {'d': 'dir', 'l': 'link'}.get(kind, 'file')
+        if kind == 'link':
+            name = name.split(' -> ')[0]
+        month = MONTHS.get(month.lower())
+        if not month:
+            return DirEntry(name, kind, int(size), None)
+        if ':' in clock:
+            hour, minute = [int(part) for part in clock.split(':')]
+            today = time.gmtime(now or time.time())
+            year = today.tm_year
+            if (month, int(day)) > (today.tm_mon, today.tm_mday + 1):
+                year -= 1
+        else:
+            year, hour, minute = int(clock), 0, 0
+        mtime = calendar.timegm((year, month, int(day), hour, minute, 0, 0, 0, 0))
+        return DirEntry(name, kind, int(size), mtime)
+    match = DOS_LIST.match(line)
+    if match:
+        month, day, year, hour, minute, half, size, name = match.groups()
+        year = int(year) + (2000 if int(year) < 70 else 1900 if len(year) == 2 else 0)
+        hour = int(hour) % 12 + (12 if half.upper() == 'PM' else 0)
+        mtime = calendar.timegm((year, int(month), int(day), hour, int(minute), 0, 0, 0, 0))
+        if size.upper() == '<DIR>':
+            return DirEntry(name, 'dir', None, mtime)
+        return DirEntry(name, 'file', int(size), mtime)
+    return None
+
+
+"""
+Parses a whole MLSD or LIST listing
+Input:
+    text: The listing
+    mlsd: TRUE if the listing came from MLSD
+Output:
+    list : A DirEntry for each entry the parser understood
+"""
+def parse_listing(text, mlsd):
+    parse = parse_mlsd_line if mlsd else parse_list_line
+    entries = []
+    for line in text.splitlines():
+        entry = parse(line.rstrip('\r'))
+        if entry:
+            entries.append(entry)
+    return entries
+
+
+"""
+Formats a directory entry as one line for display, e.g. "d          -  2024-01-01 12:00  docs"
+Input:
+    entry: The DirEntry
+Output:
+    str : The formatted line
+"""
+def format_entry(entry):
+    size = '-' if entry.size is None else str(entry.size)
+    mtime = time.strftime('%Y-%m-%d %H:%M', time.gmtime(entry.mtime)) if entry.mtime is not None else '?'.ljust(16)
+    return entry.type[0] + ' ' + size.rjust(12) + '  ' + mtime + '  ' + entry.name
+
+
+"""
+Reads a time for filtering listings, either a UTC date or an age
+Input:
+    text: e.g. 2024-01-31, "2024-01-31 12:00", 7d, 12h or 30m
+Output:
+    float : Seconds since the epoch
+"""
+def parse_since(text):
+    match = re.match(r'^(\d+)([smhd])$', text.strip().lower())
+    if match:
+        return time.time() - int(match.group(1)) * {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[match.group(2)]
+    for layout in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return calendar.timegm(time.strptime(text.strip(), layout))
+        except ValueError:
+            pass
+    raise ValueError("Not a date or age: " + text)
+
+
+"""
+Builds a test for directory entries, so a listing can be filtered as it arrives
+Entries whose size or time the server did not give never pass a size or time condition.
+Input:
+    pattern: Optional. Glob the name must match, e.g. *.csv
+    kind: Optional. 'file', 'dir' or 'link'
+    min_size: Optional. Smallest size in bytes
+    newer: Optional. Seconds since the epoch the entry must have been modified after
+Output:
+    function : Takes a DirEntry and returns TRUE if it passes, or None if there are no conditions
+"""
+def entry_filter(pattern = None, kind = None, min_size = None, newer = None):
+    if pattern is None and kind is None and min_size is None and newer is None:
+        return None
+    def match(entry):
+        return ((pattern is None or fnmatch.fnmatch(entry.name, pattern)) and
+                (kind is None or entry.type == kind) and
+                (min_size is None or (entry.size is not None and entry.size >= min_size)) and
+                (newer is None or (entry.mtime is not None and entry.mtime > newer)))
+    return match
+
+
+"""
+A directory listing that is parsed line by line while it arrives
+Memory use does not grow with the size of the directory, and the first entries
+can be used before the rest have arrived. Once the iteration ends the server's
+final reply is in reply. Stopping early and closing the listing (or leaving a
+with block) closes the data connection and sends ABOR, so the control
+connection stays in step.
+
+Input:
+    session: The session the listing arrives on; its data connection must be open
+    mlsd: TRUE if the listing comes from MLSD
+    match: Optional. Only entries this accepts are yielded (see entry_filter)
+    raw: Optional. Yield (Line, DirEntry) instead, with DirEntry None for lines that are
+         not entries (e.g. "total 12"); those are left out when there is a match
+"""
+class ListingStream(object):
+    def __init__(self, session, mlsd, match = None, raw = False):
+        self.session = session
+        self.parse = parse_mlsd_line if mlsd else parse_list_line
+        self.match = match
+        self.raw = raw
+        self.reply = None                           #The server's final reply, once the listing has ended
+        chunks = recv_stream(session.data_socket)
+        if session.transfer_mode == 'Z':
+            chunks = inflate_stream(chunks)
+        self.lines = read_lines(chunks)
+        self.received = 0
+        self.start = time.time()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while self.reply is None:
+            try:
+                line = next(self.lines)
+            except StopIteration:
+                self.finish(False)
+                break
+            self.received += len(line)
+            text = decode(line).rstrip('\r\n')
+            entry = self.parse(text)
+            if (entry is None and not self.raw) or (self.match and not (entry and self.match(entry))):
+                continue
+            return (text, entry) if self.raw else entry
+        raise StopIteration
+
+    next = __next__                                 #Python 2
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    """
+    Closes the data connection and reads the server's final reply
+    Input:
+        cut: The listing has not ended, so the transfer is cut off with ABOR
+    """
+    def finish(self, cut):
+        self.lines.close()
+        self.session.close_data()
+        METRICS.transfer('list', self.received, time.time() - self.start)
+        self.reply = self.session.ftp_abor() if cut else parse_response(self.session.read_reply())
+
+    """
+    Stops the listing if it has not ended
+    """
+    def close(self):
+        if self.reply is None:
+            self.finish(True)
+
+
+"""
+Recently read directory listings, keyed by absolute remote path
+Listings expire after ttl seconds. Once more than size directories are held the
+least recently used one is dropped. Sessions in a pool share one cache, so it is locked.
+
+Input:
+    ttl: Optional. Seconds a listing stays valid, 0 to disable the cache (default LISTING_TTL)
+    size: Optional. The most directories held at once (default LISTING_CACHE_SIZE)
+"""
+class ListingCache(object):
+    def __init__(self, ttl = None, size = None):
+        self.ttl = LISTING_TTL if ttl is None else ttl
+        self.size = LISTING_CACHE_SIZE if size is None else size
+        self.listings = collections.OrderedDict()   #Path -> (Time Read, Entries), oldest use first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        with self.lock:
+            cached = self.listings.pop(path, None)
+            if cached and time.time() - cached[0] < self.ttl:
+                self.listings[path] = cached
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+            return None
+
+    def put(self, path, entries):
+        if self.ttl <= 0:
+            return
+        with self.lock:
+            self.listings.pop(path, None)
+            self.listings[path] = (time.time(), entries)
+            while len(self.listings) > self.size:
+                self.listings.popitem(last = False)
+
+    def invalidate(self, path):
+        with self.lock:
+            self.listings.pop(path, None)
+
+    def clear(self):
+        with self.lock:
+            self.listings.clear()
+
+
+"""
+Reads the extensions listed in a FEAT reply
+Input:
+    text: The message of the 211 reply, one feature per line
+Output:
+    dict : {Feature Name: Parameters}, e.g. {'EPSV': '', 'MLST': 'type*;size*;modify*;'}
+"""
+def parse_features(text):
+    features = {}
+    for line in text.splitlines()[1:]:
+        if not line.startswith(' '):
+            continue                                #The closing "211 End" line
+        name, _, parameters = line.strip().partition(' ')
+        if name:
+            features[name.upper()] = parameters
+    return features
+
+
+"""
+One connection to an FTP server
+Holds everything the client knows about the connection: the control socket and
+its reply reader, the current data connection and whether it is active or passive.
+Sessions are independent, so several can be open in one process.
+
+Input:
+    host: The IP Address or Name of the FTP server
+    port: Optional. The port number of the FTP server (default 21)
+"""
+class FTPSession(object):
+    def __init__(self, host, port = 21):
+        self.host = host
+        self.control_port = port                    #Port Number for the Control Connection at the FTP server
+        self.address = None                         #IP Address of the FTP server
+        self.control_socket = None                  #Socket for Control Connection
+        self.reader = None                          #Reads complete replies from the Control Connection
+        self.data_socket = None                     #Socket for Data Connection
+        self.active_mode = False                    #Is data_socket the listener, waiting for the server to connect?
+        self.listener = None                        #Listening socket reused by every transfer in active mode
+        self.data_mode = None                       #The data connection mode that worked last
+        self.failed_modes = set()                   #Data connection modes that did not work with this server
+        self.features = None                        #What the server listed in FEAT (None = not asked yet)
+        self.user = None                            #Credentials from the last login
+        self.password = None
+        self.cwd = None                             #Absolute working directory on the server, if known
+        self.mlsd = None                            #Does the server support MLSD? (None = not tried yet)
+        self.cache = ListingCache()                 #Directory listings read recently
+        self.priority = 'normal'                    #Share of the bandwidth limit this session's transfers get
+        self.rate_limit = TRANSFER_LIMIT            #Most bytes per second for each transfer (0 = no limit)
+        self.compress = COMPRESSION                 #Use MODE Z when the server offers it?
+        self.compress_level = COMPRESSION_LEVEL     #zlib level for uploads in MODE Z
+        self.transfer_mode = 'S'                    #The MODE the server is in, S (stream) or Z (deflate)
+        self.transfer_type = TRANSFER_TYPE          #The TYPE get and put use, I (binary) or A (ASCII)
+        self.server_type = None                     #The TYPE the server is in (None = not set yet)
+        self.verify = VERIFY                        #Checksum to verify get and put with (None = off)
+        self.via = None                             #Unix socket of a session daemon to connect through (None = connect directly)
+        self.local_address = None                   #This machine's address as the server sees it, when connected through a daemon
+        self.socket_buffer = SOCKET_BUFFER          #Size of data socket buffers (0 = sized from the bandwidth-delay product)
+        self.chunk_size = CHUNK_SIZE                #Size of each read from the data connection (0 = sized from measurements)
+        self.rtt = None                             #Shortest command round trip seen, in seconds
+        self.rate = None                            #Throughput of recent transfers, in bytes per second
+
+
+    """
+    Looks up the server, opens the control connection and reads the greeting
+    Output:
+        tuple : (Response Code, Response Message) of the greeting
+    """
+    def connect(self):
+        if self.via:
+            return self.connect_via()
+        try:
+            self.address = gethostbyname(self.host)
+        except socket_error as e:
+            raise FTPError("An unexpected error occured while looking up host: " + str(e))
+        self.control_socket = establish_connection(self.address, self.control_port)
+        if not self.control_socket:
+            raise FTPError("Failed to establish control connection")
+        #Each command waits for its reply, so Nagle's algorithm could only hold it back
+        self.control_socket.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        self.reader = ReplyReader(self.control_socket)
+        return parse_response(self.read_reply())
+
+
+    """
+    Opens the control connection through a session daemon instead of the server
+    The daemon's greeting names the server it is logged in to, the server's address
+    (for EPSV) and this machine's address (for active mode).
+    Output:
+        tuple : (Response Code, Response Message) of the greeting
+    """
+    def connect_via(self):
+        self.control_socket = socket(AF_UNIX, SOCK_STREAM)
+        self.control_socket.settimeout(DAEMON_WAIT + 5)    #The daemon may be waiting for a free session
+        try:
+            self.control_socket.connect(self.via)
+        except socket_error as e:
+            self.close()
+            raise FTPError("Could not reach the session daemon at " + self.via + ": " + str(e))
+        self.reader = ReplyReader(self.control_socket)
+        resp = parse_response(self.read_reply())
+        found = re.search(r'to (\S+) at (\S+) port (\d+) from (\S+)', resp[1])
+        if not resp[0] == '220' or not found:
+            self.close()
+            raise FTPError("Session daemon: " + resp[1])
+        host, self.address, port, self.local_address = found.groups()
+        if self.host not in (host, self.address) or not int(port) == self.control_port:
+            self.close()
+            raise FTPError("The session daemon is logged in to " + host + " port " + port)
+        self.control_socket.settimeout(5)
+        return resp
+
+
+    """
+    Logs the user into the FTP server
+    Input:
+        user : Username of the user to be logged in
+        password : Optional. Password, sent if the server asks for one
+    Output:
+        tuple : (Response Code, Response Message) of the last reply
+    """
+    def login(self, user, password = None):
+        self.user = user
+        self.password = password
+        if self.via:
+            self.probe_features()                   #The daemon's connection is already logged in
+            return ('230', "Logged in through the session daemon")
+        resp = self.ftp_user(user)
+        if resp[0] == '331' and password is not None:
+            resp = self.ftp_pass(password)
+        if resp[0] == '230':
+            self.probe_features()
+        return resp
+
+
+    """
+    Opens a fresh control connection and logs in again with the last credentials
+    Used to carry on after the control connection was lost.
+    """
+    def reconnect(self):
+        self.close()
+        self.connect()
+        resp = self.login(self.user, self.password)
+        if not resp[0] == '230':
+            self.close()
+            raise FTPError("Login failed: " + resp[1])
+
+
+    """
+    Closes the control and data connections
+    """
+    def close(self):
+        self.close_data()
+        if self.listener:
+            self.listener.close()
+            self.listener = None
+        if self.control_socket:
+            self.control_socket.close()
+            self.control_socket = None
+            self.reader = None
+        self.cwd = None
+        self.transfer_mode = 'S'                    #A new connection starts in stream mode
+        self.server_type = None
+
+
+    """
+    Closes the data connection. The listening socket for active mode is kept for the next transfer
+    """
+    def close_data(self):
+        if self.data_socket and self.data_socket is not self.listener:
+            self.data_socket.close()
+        self.data_socket = None
+        self.active_mode = False
+
+
+    """
+    Reads one complete reply from the control connection
+    Output:
+        The reply from the server
+    """
+    def read_reply(self):
+        try:
+            reply = decode(self.reader.read_reply())
+        except socket_error as e:
+            log(str(e))
+            raise FTPError("Control connection lost.")
+        log("Received: " + reply[:-2])
+        return reply
+
+
+    """
+    Sends an FTP command over the control connection socket
+    Input:
+        msg : a complete FTP command
+    Output:
+        The reply from the server
+    """
+    def send_command(self, msg):
+        log("Sent: " + msg[:-2])
+        if not self.control_socket:
+            raise FTPError("No Control Connection")
+        start = time.time()
+        try:
+            self.control_socket.sendall(encode(msg))
+        except socket_error as e:
+            log(str(e))
+            raise FTPError("Control connection lost.")
+        reply = self.read_reply()
+        elapsed = time.time() - start
+        METRICS.observe('ftp_command_seconds', msg.split(' ')[0].strip().upper(), elapsed)
+        self.rtt = min(self.rtt or elapsed, elapsed)
+        return reply
+
+
+    """
+    Sends several FTP commands over the control connection in a single write
+    The server answers them in order, so the commands only cost one round trip
+    instead of one each. Replies are read lazily, which lets the caller act on one
+    reply (e.g. connect to the address from PASV) before the next one is read.
+    Every reply must be consumed, or the control connection falls out of step.
+    Only the first reply is a true round trip. The wait for each later one is
+    recorded apart, as it overlaps the round trips of the replies before it.
+    Input:
+        msgs : a list of complete FTP commands
+    Output:
+        generator : (Response Code, Response Message) for each command, in order
+    """
+    def send_pipeline(self, msgs):
+        for msg in msgs:
+            log("Sent: " + msg[:-2])
+        if not self.control_socket:
+            raise FTPError("No Control Connection")
+        start = time.time()
+        try:
+            self.control_socket.sendall(b"".join([encode(msg) for msg in msgs]))
+        except socket_error as e:
+            log(str(e))
+            raise FTPError("Control connection lost.")
+        for index, msg in enumerate(msgs):
+            if index:
+                start = time.time()                 #Not counting the time the caller spent on the last reply
+            reply = parse_response(self.read_reply())
+            elapsed = time.time() - start
+            if index:
+                METRICS.observe('ftp_pipelined_seconds', msg.split(' ')[0].strip().upper(), elapsed)
+            else:
+                METRICS.observe('ftp_command_seconds', msg.split(' ')[0].strip().upper(), elapsed)
+                self.rtt = min(self.rtt or elapsed, elapsed)
+            yield reply
+
+
+    #ACCESS CONTROL COMMANDS
+
+    """
+    FTP USER COMMAND
+    Identifies the username of the current user.
+
+    Input:
+        username : Username of the user to be logged in
+    Output:
+        tuple : (Response Code, Response Message)
+    """
+    def ftp_user(self, username):
+        msg = "USER " + username + CRLF
+
+        reply = parse_response(self.send_command(msg))
+
+        return reply
+
+
+    """
+    FTP PASS COMMAND
+    Identifies the user's password.
+
+    Input:
+        password : Password of the user to be logged in
+    Output:
+        tuple : (Response Code, Response Message)
+    """
+    def ftp_pass(self, password):
+        msg = "PASS "+password+CRLF
+
+        reply = parse_response(self.send_command(msg))
+
+        return reply
+
+
+    """
+    FTP CWD COMMAND
+    Allows the user to work with a different directory.
+
+    Input:
+        pathname : The directory to change the server to
+    Output:
+        tuple : (Respone Code, Response Message)
+    """
+    def ftp_cwd(self, pathname):
+        msg = "CWD "+pathname+CRLF
+
+        reply = parse_response(self.send_command(msg))
+        if reply[0] == '250':
+            self.cwd = self.absolute(pathname) if self.cwd or pathname.startswith('/') else None
+
+        return reply
+
+
+    """
+    FTP QUIT COMMAND
+    Terminates user connection.
+
+    Output:
+        tuple : (Response Code, Response Message)
+    """
+    def ftp_quit(self):
+        msg = "QUIT" + CRLF
+
+        reply = parse_response(self.send_command(msg))
+
+        return reply
+
+
+    #TRANSFER PARAMETER COMMANDS
+
+    """
+    FTP PASV COMMAND
+    Requests the server to listen on a data port and wait for a connection.
+
+    Output:
+        tuple : (Response Code, Response Message)
+    """
+    def ftp_pasv(self):
+        msg = "PASV" + CRLF
+
+        reply = parse_response(self.send_command(msg))
+
+        return reply
+
+
+    """
+    FTP PORT COMMAND
+    Intructs the server to connect to the socket located at the host-port address
+
+    Input:
+        headers : The address of the socket for the server to connect to. "h1,h2,h3,h4,p1,p2"
+    Output:
+        tuple : (Response Code, Response Message)
+    """
+    def ftp_port(self, headers):
+
+        msg = "PORT " + headers + CRLF
+
+        reply = parse_response(self.send_command(msg))
+
+        return reply
+
+
+    """
+    FTP EPSV COMMAND
+    Requests the server to listen on a data port and wait for a connection
+
+    Output:
+        tuple : (Response Code, Response Message)
+    """
+    def ftp_epsv(self):
+        msg = "EPSV 1" + CRLF
+
+        reply = parse_response(self.send_command(msg))
+
+        return reply
+
+
+    """
+    FTP EPSV COMMAND
+    Allows for the specification of an extended address for the data connection
+
+    Input:
+        protocol : The number indicating which internet protocol to use. 1 = IPv4, 2 = IPv6.
+        address : The IP address of the socket address
+        port : The port number of the socket address
+    Output:
+        tuple : (Response Code, Response Message)
+    """
+    def ftp_eprt(self, protocol, address, port):
+        msg = "EPRT |"+str(protocol)+"|"+str(address)+"|"+str(port)+"|" + CRLF
+
+        reply = parse_response(self.send_command(msg))
+
+        return reply
+
+
+    """
+    FTP TYPE COMMAND
+    Specifies the representation type of transfered data.
+
+    Input:
+        type_code : "I" for binary (image) or "A" for ASCII
+    Output:
+        tuple : (Response Code, Response Message)
+    """
+    def ftp_type(self, type_code):
+        msg = "TYPE " + type_code + CRLF
+
+        reply = parse_response(self.send_command(msg))
+        self.finish_type(type_code, reply)
+
+        return reply
+
+
+    """
+    FTP MODE COMMAND
+    Specifies how data is sent over the data connection.
+
+    Input:
+        mode_code : "S" for stream or "Z" for deflate
+    Output:
+        tuple : (Response Code, Response Message)
+    """
+    def ftp_mode(self, mode_code):
+        msg = "MODE " + mode_code + CRLF
+
+        reply = parse_response(self.send_command(msg))
+        self.finish_switch(mode_code, reply)
+
+        return reply
+
+
+    #SERVICE COMMANDS
+
+
+    """
+    FTP RETR COMMAND
+    Instructs the server to transfer a copy of the file PATHNAME to
+    the host at the other end of the data connection.
+
+    Input:
+        pathname : The name of the file to be sent from the server
+    Output:
+        tuple : (Response Code, Response Message)
+    """
+    def ftp_retr(self, pathname):
+        msg = "RETR "+pathname+CRLF
+
+        reply = parse_response(self.send_command(msg))
+
+        return reply
+
+
+    """
+    FTP REST COMMAND
+    Sets the byte offset the next RETR or STOR starts at.
+
+    Input:
+        offset : The number of bytes to skip
+    Output:
+        tuple : (Response Code, Response Message)
+    """
+    def ftp_rest(self, offset):
+        msg = "REST " + str(offset) + CRLF
+
+        reply = parse_response(self.send_command(msg))
+
+        return reply
+
+
+    """
+    FTP ABOR COMMAND
+    Aborts the transfer in progress on the data connection.
+    Only send it while a transfer is outstanding: the server first answers the
+    transfer (426 if it was cut off, 226 if it had already finished) and then
+    the ABOR itself.
+
+    Output:
+        tuple : (Response Code, Response Message) of the reply to ABOR
+    """
+    def ftp_abor(self):
+        msg = "ABOR" + CRLF
+
+        self.send_command(msg)
+        reply = parse_response(self.read_reply())
+
+        return reply
+
+
+    """
+    FTP STOR COMMAND
+    Causes the server to accept the data transfered via the data connection
+    and store the file at the server site.
+
+    Input:
+        pathname : The name of the file to be sent to the server
+    Output:
+        tuple : (Response Code, Response Message)
+    """
+    def ftp_stor(self, pathname):
+        msg = "STOR "+pathname+CRLF
+
+        reply = parse_response(self.send_command(msg))
+        self.changed(pathname)
+
+        return reply
+
+
+    """
+    FTP APPE COMMAND
+    Causes the server to accept the data transfered via the data connection
+    and append it to the file at the server site, creating it if needed.
+
+    Input:
+        pathname : The name of the file to be appended to
+    Output:
+        tuple : (Response Code, Response Message)
+    """
+    def ftp_appe(self, pathname):
+        msg = "APPE "+pathname+CRLF
+
+        reply = parse_response(self.send_command(msg))
+        self.changed(pathname)
+
+        return reply
+
+
+    """
+    FTP PWD COMMAND
+    Causes the name of the current working directory to be returned in the reply.
+
+    Output:
+        tuple : (Response Code, Response Message)
+    """
+    def ftp_pwd(self):
+        msg = "PWD" + CRLF
+
+        reply = parse_response(self.send_command(msg))
+
+        return reply
+
+
+    """
+    FTP LIST COMMAND
+    Causes a list to be sent from the server to the passive DTP.
+
+    Input:
+        pathname : Optional. Name of a directory or file to list information about
+    Output:
+        tuple : (Response Code, Response Message)
+    """
+    def ftp_list(self, pathname = None):
+        if pathname:
+            msg = "LIST " + pathname + CRLF
+        else:
+            msg = "LIST" + CRLF
+
+        reply = parse_response(self.send_command(msg))
+
+        return reply
+
+
+    """
+    FTP MLSD COMMAND
+    Causes a machine readable list of a directory to be sent over the data connection.
+
+    Input:
+        pathname : Optional. Name of a directory to list
+    Output:
+        tuple : (Response Code, Response Message)
+    """
+    def ftp_mlsd(self, pathname = None):
+        if pathname:
+            msg = "MLSD " + pathname + CRLF
+        else:
+            msg = "MLSD" + CRLF
+
+        reply = parse_response(self.send_command(msg))
+
+        return reply
+
+
+    """
+    FTP NLST COMMAND
+    Causes a list of file names to be sent from the server to the passive DTP.
+
+    Input:
+        pathname : Optional. Name of a directory to list
+    Output:
+        tuple : (Response Code, Response Message)
+    """
+    def ftp_nlst(self, pathname = None):
+        if pathname:
+            msg = "NLST " + pathname + CRLF
+        else:
+            msg = "NLST" + CRLF
+
+        reply = parse_response(self.send_command(msg))
+
+        return reply
+
+
+    """
+    FTP SIZE COMMAND
+    Asks the server for the size of a file in bytes.
+
+    Input:
+        pathname : The name of the file on the server
+    Output:
+        tuple : (Response Code, Response Message)
+    """
+    def ftp_size(self, pathname):
+        msg = "SIZE " + pathname + CRLF
+
+        reply = parse_response(self.send_command(msg))
+
+        return reply
+
+
+    """
+    FTP HASH COMMAND
+    Asks the server for the checksum of a file, computed with the algorithm
+    selected by OPTS HASH (or the server's default).
+
+    Input:
+        pathname : The name of the file on the server
+    Output:
+        tuple : (Response Code, Response Message), e.g. ('213', 'SHA-256 0-1024 <digest> name')
+    """
+    def ftp_hash(self, pathname):
+        msg = "HASH " + pathname + CRLF
+
+        reply = parse_response(self.send_command(msg))
+
+        return reply
+
+
+    """
+    FTP XCRC COMMAND
+    Asks the server for the CRC32 of a file.
+
+    Input:
+        pathname : The name of the file on the server
+    Output:
+        tuple : (Response Code, Response Message)
+    """
+    def ftp_xcrc(self, pathname):
+        msg = "XCRC " + pathname + CRLF
+
+        reply = parse_response(self.send_command(msg))
+
+        return reply
+
+
+    """
+    FTP XMD5 COMMAND
+    Asks the server for the MD5 of a file.
+
+    Input:
+        pathname : The name of the file on the server
+    Output:
+        tuple : (Response Code, Response Message)
+    """
+    def ftp_xmd5(self, pathname):
+        msg = "XMD5 " + pathname + CRLF
+
+        reply = parse_response(self.send_command(msg))
+
+        return reply
+
+
+    """
+    FTP OPTS COMMAND
+    Sets an option of another command, e.g. OPTS HASH MD5.
+
+    Input:
+        option : The command and its new settings
+    Output:
+        tuple : (Response Code, Response Message)
+    """
+    def ftp_opts(self, option):
+        msg = "OPTS " + option + CRLF
+
+        reply = parse_response(self.send_command(msg))
+
+        return reply
+
+
+    """
+    FTP MDTM COMMAND
+    Asks the server when a file was last modified.
+
+    Input:
+        pathname : The name of the file on the server
+    Output:
+        tuple : (Response Code, Response Message)
+    """
+    def ftp_mdtm(self, pathname):
+        msg = "MDTM " + pathname + CRLF
+
+        reply = parse_response(self.send_command(msg))
+
+        return reply
+
+
+    """
+    FTP MKD COMMAND
+    Causes the directory to be created on the server.
+
+    Input:
+        pathname : The name of the new directory
+    Output:
+        tuple : (Response Code, Response Message)
+    """
+    def ftp_mkd(self, pathname):
+        msg = "MKD " + pathname + CRLF
+
+        reply = parse_response(self.send_command(msg))
+        self.changed(pathname)
+
+        return reply
+
+
+    """
+    FTP DELE COMMAND
+    Causes the file to be deleted at the server site.
+
+    Input:
+        pathname : The name of the file to delete
+    Output:
+        tuple : (Response Code, Response Message)
+    """
+    def ftp_dele(self, pathname):
+        msg = "DELE " + pathname + CRLF
+
+        reply = parse_response(self.send_command(msg))
+        self.changed(pathname)
+
+        return reply
+
+
+    """
+    FTP RMD COMMAND
+    Causes the directory to be removed at the server site.
+
+    Input:
+        pathname : The name of the directory to remove
+    Output:
+        tuple : (Response Code, Response Message)
+    """
+    def ftp_rmd(self, pathname):
+        msg = "RMD " + pathname + CRLF
+
+        reply = parse_response(self.send_command(msg))
+        self.changed(pathname)
+        self.cache.invalidate(self.absolute(pathname))
+
+        return reply
+
+
+    """
+    FTP FEAT COMMAND
+    Asks the server to list the extensions it supports.
+
+    Output:
+        tuple : (Response Code, Response Message)
+    """
+    def ftp_feat(self):
+        msg = "FEAT" + CRLF
+
+        reply = parse_response(self.send_command(msg))
+
+        return reply
+
+
+    """
+    FTP SYST COMMAND
+    Used to find out the type of operating system at the server
+
+    Output:
+        tuple : (Response Code, Response Message)
+    """
+    def ftp_syst(self):
+        msg = "SYST" + CRLF
+
+        reply = parse_response(self.send_command(msg))
+
+        return reply
+
+
+    """
+    FTP NOOP COMMAND
+    Does nothing but get a reply, which keeps an idle control connection open
+
+    Output:
+        tuple : (Response Code, Response Message)
+    """
+    def ftp_noop(self):
+        msg = "NOOP" + CRLF
+
+        reply = parse_response(self.send_command(msg))
+
+        return reply
+
+
+    #DATA CONNECTION
+
+    """
+    Asks the server which extensions it supports, once per login
+    The answer decides which data connection mode is tried first and whether MLSD is used.
+    Output:
+        dict : {Feature Name: Parameters}, empty if the server does not support FEAT
+    """
+    def probe_features(self):
+        resp = self.ftp_feat()
+        self.features = parse_features(resp[1]) if resp[0] == '211' else {}
+        if 'MLST' not in self.features:
+            self.mlsd = False
+        return self.features
+
+
+    """
+    Lists the data connection modes to try, best first
+    EPSV comes first when the server lists it in FEAT, then PASV, then the active
+    modes. The mode that worked last moves to the front and modes that failed are
+    left out, unless every mode has failed.
+    Output:
+        list : Mode names, e.g. ['epsv', 'pasv', 'eprt', 'port']
+    """
+    def mode_order(self):
+        if self.features is not None and 'EPSV' not in self.features:
+            order = ['pasv', 'epsv', 'port', 'eprt']
+        else:
+            order = ['epsv', 'pasv', 'eprt', 'port']
+        if self.data_mode in order:
+            order.remove(self.data_mode)
+            order.insert(0, self.data_mode)
+        return [mode for mode in order if mode not in self.failed_modes] or order
+
+
+    """
+    Opens the socket the server connects to in active mode, or returns the one already open
+    The same port is given to the server for every transfer, so active mode does
+    not bind and listen on a new socket each time.
+    Output:
+        socket : The listening socket
+    """
+    def listen(self):
+        if not self.listener:
+            #Get the IP Address of the machine and open a port on it
+            my_ip = self.local_address or self.control_socket.getsockname()[0]
+            self.listener = socket(AF_INET, SOCK_STREAM)
+            self.listener.bind((my_ip, 0))
+            self.listener.listen(1)
+        return self.listener
+
+
+    """
+    Builds the command that sets up a data connection in a mode
+    Input:
+        mode : 'pasv', 'epsv', 'port' or 'eprt'
+    Output:
+        str : The complete command
+    """
+    def mode_command(self, mode):
+        if mode == 'pasv':
+            return "PASV" + CRLF
+        if mode == 'epsv':
+            return "EPSV 1" + CRLF
+        my_ip, my_port = self.listen().getsockname()
+        if mode == 'port':
+            #Generate the headers for the PORT command (h1,h2,h3,h4,p1,p2)
+            return "PORT " + ','.join(my_ip.split('.')) + ',' + str(my_port // 256) + ',' + str(my_port % 256) + CRLF
+        return "EPRT |1|" + my_ip + "|" + str(my_port) + "|" + CRLF
+
+
+    """
+    Acts on the reply to a mode command
+    In passive mode this connects to the port the server opened; in active mode the
+    listening socket becomes the data connection until the server connects to it.
+    Input:
+        mode : The mode the command was for
+        resp : (Response Code, Response Message) of the command
+    Output:
+        TRUE if the data connection is ready
+        FALSE otherwise
+    """
+    def finish_mode(self, mode, resp):
+        if mode == 'port' or mode == 'eprt':
+            if not resp[0] == '200':
+                return False
+            self.close_data()
+            set_buffers(self.listener, self.tuning()[0])   #The server's connection takes the listener's buffers
+            self.data_socket = self.listener
+            self.active_mode = True
+            return True
+        if mode == 'pasv' and resp[0] == '227':
+            #Search the response string for the socket headers: (h1,h2,h3,h4,p1,p2).
+            address = re.search(r'\((.*)\)', resp[1])
+            socket_address = get_socket_address(address.group(1)) if address else None
+        elif mode == 'epsv' and resp[0] == '229':
+            #Search the response string for the port number
+            port = re.search(r'\|\|\|(\d+)\|', resp[1])
+            socket_address = (self.address, int(port.group(1))) if port else None
+        else:
+            return False
+        if not socket_address:
+            return False
+        self.close_data()
+        self.data_socket = establish_connection(socket_address[0], socket_address[1], self.tuning()[0])
+        self.active_mode = False
+        return self.data_socket is not None
+
+
+    """
+    Sets up a data connection in one mode, as the pasv/epsv/port/eprt commands do
+    Input:
+        mode : 'pasv', 'epsv', 'port' or 'eprt'
+    Output:
+        tuple : (Response Code, Response Message) of the mode command.
+        On success the connection, or the listening socket in active mode, is left in data_socket.
+    """
+    def set_mode(self, mode):
+        start = time.time()
+        resp = parse_response(self.send_command(self.mode_command(mode)))
+        if self.finish_mode(mode, resp):
+            METRICS.observe('ftp_data_setup_seconds', mode, time.time() - start)
+            self.data_mode = mode
+            self.failed_modes.discard(mode)
+        else:
+            self.failed_modes.add(mode)
+        return resp
+
+
+    """
+    Enters passive mode and connects to the port the server opened
+    Output:
+        tuple : (Response Code, Response Message) of the PASV command.
+        On success the data connection is left in data_socket.
+    """
+    def pasv(self):
+        return self.set_mode('pasv')
+
+
+    """
+    Enters active mode by sending the port this machine listens on with PORT
+    Output:
+        tuple : (Response Code, Response Message) of the PORT command.
+        On success the listening socket is left in data_socket.
+    """
+    def port(self):
+        return self.set_mode('port')
+
+
+    """
+    Enters extended passive mode and connects to the port the server opened
+    Output:
+        tuple : (Response Code, Response Message) of the EPSV command.
+        On success the data connection is left in data_socket.
+    """
+    def epsv(self):
+        return self.set_mode('epsv')
+
+
+    """
+    Enters extended active mode by sending the port this machine listens on with EPRT
+    Output:
+        tuple : (Response Code, Response Message) of the EPRT command.
+        On success the listening socket is left in data_socket.
+    """
+    def eprt(self):
+        return self.set_mode('eprt')
+
+
+    """
+    In active mode, waits for the server to connect to the listening socket
+    The listening socket stays open for the next transfer.
+    """
+    def accept_data(self):
+        if self.active_mode:
+            start = time.time()
+            self.data_socket, address = self.listener.accept()
+            self.active_mode = False
+            METRICS.observe('ftp_data_setup_seconds', 'accept', time.time() - start)
+            log("Accepted data connection from Server")
+
+
+    """
+    Opens a data connection for the next transfer, trying each mode from mode_order in turn
+    Output:
+        TRUE if a data connection is ready
+        FALSE otherwise
+    """
+    def open_data(self):
+        for mode in self.mode_order():
+            self.set_mode(mode)
+            if self.data_socket:
+                return True
+        return False
+
+
+    """
+    Acts on the reply to a TYPE command
+    Input:
+        type_code : The type that was asked for
+        resp : (Response Code, Response Message) of the TYPE command
+    """
+    def finish_type(self, type_code, resp):
+        if resp[0] == '200':
+            self.server_type = type_code
+        else:
+            log("Server refused TYPE " + type_code + ": " + resp[1])
+
+
+    """
+    Sends TYPE if the server is not already in type_code
+    Transfers started with start_transfer do this themselves.
+    Input:
+        type_code : "I" for binary or "A" for ASCII
+    """
+    def select_type(self, type_code):
+        if not type_code == self.server_type:
+            self.ftp_type(type_code)
+
+
+    """
+    Works out whether the server has to change MODE before the next transfer
+    MODE Z is used when compression is on and the server listed it in FEAT.
+    Output:
+        str : 'Z' or 'S' if a MODE command is needed, None if the server is already in the right mode
+    """
+    def mode_switch(self):
+        offered = self.features and 'Z' in self.features.get('MODE', '').upper().split()
+        wanted = 'Z' if self.compress and offered else 'S'
+        return wanted if wanted != self.transfer_mode else None
+
+
+    """
+    Acts on the reply to a MODE command
+    If the server refuses MODE Z it is not asked again, and data is sent uncompressed.
+    Input:
+        mode : The mode that was asked for
+        resp : (Response Code, Response Message) of the MODE command
+    """
+    def finish_switch(self, mode, resp):
+        if resp[0] == '200':
+            self.transfer_mode = mode
+            log("Transfer mode is now " + mode)
+        elif mode == 'Z' and self.features:
+            log("Server refused MODE Z, sending data uncompressed")
+            self.features.pop('MODE', None)
+
+
+    """
+    Sends MODE if the server is not in the mode the next transfer should use
+    Transfers started with start_transfer do this themselves.
+    """
+    def select_mode(self):
+        switch = self.mode_switch()
+        if switch:
+            self.ftp_mode(switch)
+
+
+    """
+    Lists the TYPE and MODE commands the server needs before the next transfer
+    Input:
+        type_code : The type the transfer needs, or None if it does not matter
+    Output:
+        list : (Command, Argument) pairs, e.g. [('TYPE', 'I'), ('MODE', 'Z')]
+    """
+    def transfer_settings(self, type_code):
+        settings = []
+        if type_code and not type_code == self.server_type:
+            settings.append(('TYPE', type_code))
+        switch = self.mode_switch()
+        if switch:
+            settings.append(('MODE', switch))
+        return settings
+
+
+    """
+    Sends the commands that start a transfer, opening a data connection first if none is ready
+    Once a mode has worked, its command is sent in the same write as the transfer
+    commands, so setting up the data connection costs no round trip of its own; if
+    it fails the server refuses the transfer too, and the next mode is tried. Until
+    then each mode is tried on its own before the transfer is sent, since a server
+    may hold back its reply to the transfer while it waits for a data connection
+    that never comes (e.g. a firewalled passive port). TYPE and MODE commands the
+    transfer needs go in the first write.
+    Input:
+        msgs : complete FTP commands; the last one starts the transfer, e.g. RETR
+        type_code : Optional. The TYPE the transfer needs, "I" or "A"
+    Output:
+        list : (Response Code, Response Message) for each command.
+        If the transfer was refused the data connection is closed again.
+    """
+    def start_transfer(self, msgs, type_code = None):
+        settings = self.transfer_settings(type_code)
+        prefix = [command + " " + argument + CRLF for command, argument in settings]
+        if self.data_socket:
+            pipeline = self.send_pipeline(prefix + msgs)
+            self.finish_settings(settings, pipeline)
+            replies = list(pipeline)
+        else:
+            for mode in self.mode_order():
+                start = time.time()
+                batched = self.data_mode is not None
+                pipeline = self.send_pipeline(prefix + [self.mode_command(mode)] + (msgs if batched else []))
+                self.finish_settings(settings, pipeline)
+                settings, prefix = [], []
+                ready = self.finish_mode(mode, next(pipeline))
+                if batched:
+                    replies = [next(pipeline) for msg in msgs]
+                elif ready:
+                    replies = list(self.send_pipeline(msgs))
+                if ready:
+                    METRICS.observe('ftp_data_setup_seconds', mode, time.time() - start)
+                    self.data_mode = mode
+                    break
+                log("Data connection mode " + mode + " failed")
+                self.failed_modes.add(mode)
+                self.data_mode = None                       #Try the other modes on their own
+                if batched and replies[-1][0].startswith('1'):
+                    parse_response(self.read_reply())      #The server gives up waiting for the connection
+            else:
+                raise FTPError("Could not open a data connection")
+        if not replies[-1][0].startswith('1'):
+            self.close_data()
+        return replies
+
+
+    #VERIFICATION
+
+    """
+    Picks the checksum to verify the next transfer with, from what the server listed in FEAT
+    With verify set to 'auto' the strongest the server offers is used.
+    HASH is preferred, then XMD5 and XCRC.
+    Output:
+        tuple : (Algorithm, Command), e.g. ('sha256', 'HASH'), or (None, None) if
+        the server offers none, in which case only the size is checked
+    """
+    def verify_plan(self):
+        features = self.features or {}
+        offered = [name.rstrip('*').upper() for name in features.get('HASH', '').split(';')]
+        wanted = list(HASH_NAMES) if self.verify == 'auto' else [self.verify]
+        for algorithm in wanted:
+            if HASH_NAMES.get(algorithm) in offered:
+                return (algorithm, 'HASH')
+            if algorithm == 'md5' and 'XMD5' in features:
+                return (algorithm, 'XMD5')
+            if algorithm == 'crc32' and 'XCRC' in features:
+                return (algorithm, 'XCRC')
+        return (None, None)
+
+
+    """
+    Asks the server for the checksum of a file
+    Input:
+        pathname : The name of the file on the server
+        algorithm : 'crc32', 'md5' or 'sha256'
+        command : 'HASH', 'XMD5' or 'XCRC', as chosen by verify_plan
+    Output:
+        str : The checksum in hex, or None if the server did not give one
+    """
+    def remote_checksum(self, pathname, algorithm, command):
+        if command == 'HASH':
+            names = self.features['HASH'].split(';')
+            name = HASH_NAMES[algorithm]
+            if not name + '*' in names:
+                if self.ftp_opts("HASH " + name)[0] == '200':
+                    #The server now hashes with name, so mark it as the selected one
+                    self.features['HASH'] = ';'.join([item.rstrip('*') + ('*' if item.rstrip('*') == name else '') for item in names])
+                else:
+                    #It cannot be selected after all, so stop choosing it and try the older commands
+                    self.features['HASH'] = ';'.join([item for item in names if not item.rstrip('*') == name])
+                    command = {'md5': 'XMD5', 'crc32': 'XCRC'}.get(algorithm)
+                    if command not in self.features:
+                        return None
+        if command == 'HASH':
+            resp = self.ftp_hash(pathname)
+            fields = resp[1].split()
+            return fields[2] if resp[0] == '213' and len(fields) > 2 else None
+        resp = self.ftp_xmd5(pathname) if command == 'XMD5' else self.ftp_xcrc(pathname)
+        value = re.search(r'\b(?:0x)?([0-9A-Fa-f]{8,})\b', resp[1])
+        return value.group(1) if resp[0] in ('213', '250') and value else None
+
+
+    """
+    Checks a finished transfer against what the server holds
+    The checksum computed during the transfer is compared with the server's. If
+    the server cannot give one, the size is compared instead.
+    Input:
+        pathname : The name of the file on the server
+        count : The bytes that were transferred
+        expected : The size the server gave when the transfer started, or None
+        digest : The StreamHash computed during the transfer, or None
+        command : How to ask the server for its checksum, from verify_plan
+    Output:
+        str : What did not match, or None if the transfer checked out
+    """
+    def check_transfer(self, pathname, count, expected, digest, command):
+        if expected is not None and count != expected:
+            return "expected " + str(expected) + " bytes but received " + str(count)
+        if not self.verify:
+            return None
+        remote = self.remote_checksum(pathname, digest.algorithm, command) if digest else None
+        if remote is not None:
+            try:
+                matches = int(remote, 16) == int(digest.hexdigest(), 16)
+            except ValueError:
+                matches = False
+            log(digest.algorithm + " of " + pathname + ": " + digest.hexdigest() + (" matches" if matches else " but server has " + remote))
+            return None if matches else digest.algorithm + " mismatch (" + digest.hexdigest() + " here, " + remote + " on server)"
+        if expected is None:
+            resp = self.ftp_size(pathname)
+            if resp[0] == '213' and int(resp[1].split()[0]) != count:
+                return "server has " + resp[1].split()[0] + " bytes but " + str(count) + " were transferred"
+        return None
 
 
+    """
+    Reads the replies to the commands from transfer_settings
+    Input:
+        settings : The (Command, Argument) pairs that were sent
+        pipeline : The replies, starting with the one to the first setting
+    """
+    def finish_settings(self, settings, pipeline):
+        for command, argument in settings:
+            if command == 'TYPE':
+                self.finish_type(argument, next(pipeline))
+            else:
+                self.finish_switch(argument, next(pipeline))
+
+
+    #TRANSFERS
+
+    """
+    Registers a transfer with the bandwidth scheduler at this session's priority and limit
+    Output:
+        Flow : Pass it to the data functions and close it when the transfer ends
+    """
+    def open_flow(self):
+        return SCHEDULER.open(self.priority, self.rate_limit)
+
+
+    """
+    Sizes the socket buffers and the first read of the next transfer
+    The shortest round trip times the throughput of recent transfers (the
+    bandwidth-delay product) is how much data a busy connection has in flight.
+    Buffers get twice that, so the window never runs dry, and reads start at it
+    and grow while the data keeps them full. Where the kernel grows buffers by
+    itself they are left to it, since a fixed size turns that off, unless the
+    product needs more than autotuning will give and rmem_max lets a set size
+    go past that. Sizes set with socket_buffer or chunk_size are used as they are.
+    Output:
+        tuple : (Socket Buffer Size, or None for the kernel's, First Read Size)
+    """
+    def tuning(self):
+        bdp = int(self.rtt * self.rate) if self.rtt and self.rate else 0
+        buffer_size = self.socket_buffer
+        if not buffer_size and bdp:
+            buffer_size = min(max(2 * bdp, DATA_BUFFER_SIZE), SOCKET_BUFFER_MAX)
+            if AUTOTUNING:
+                autotuned, settable = kernel_buffer_limits()
+                if min(2 * buffer_size, settable) <= autotuned:
+                    buffer_size = None              #Autotuning grows the buffers at least as far
+        chunk_size = self.chunk_size or min(max(bdp, DATA_BUFFER_SIZE), CHUNK_SIZE_MAX)
+        return (buffer_size or None, chunk_size)
+
+
+    """
+    Records a finished transfer in the metrics and in the throughput used by tuning
+    Small transfers are timed mostly by the round trip, so they are left out of the throughput.
+    Input:
+        direction : 'get' or 'put'
+        count : Bytes moved
+        seconds : How long it took
+    """
+    def observe_transfer(self, direction, count, seconds):
+        METRICS.transfer(direction, count, seconds)
+        if count >= RATE_SAMPLE_MIN and seconds > 0:
+            sample = count / seconds
+            self.rate = sample if self.rate is None else (self.rate + sample) / 2
+
+
+    """
+    Lists a directory or file over the data connection
+    The listing is read line by line through iter_listing; use that instead to
+    work on the lines as they arrive rather than holding them all.
+    Input:
+        pathname : Optional. Name of a directory or file to list information about
+    Output:
+        tuple : ((Response Code, Response Message), Listing)
+        The reply is the server's final answer; the listing is None if it was refused.
+    """
+    def ls(self, pathname = None):
+        resp, listing = self.iter_listing(pathname, raw = True)
+        if listing is None:
+            return (resp, None)
+        with listing:
+            lines = [encode(line + CRLF) for line, entry in listing]
+        return (listing.reply, b"".join(lines))
+
+
+    """
+    Reads the entries of a directory, from the cache if a recent listing is held
+    Uses MLSD, or LIST on servers without it. A data connection is opened with
+    open_data() if one is not already waiting.
+    Input:
+        pathname : Optional. The directory to list (default the working directory)
+        refresh : Optional. Ask the server even if the listing is cached
+    Output:
+        tuple : ((Response Code, Response Message), Entries)
+        The entries are a list of DirEntry, or None if the listing was refused.
+    """
+    def listdir(self, pathname = None, refresh = False):
+        path = self.absolute(pathname or '.')
+        entries = None if refresh else self.cache.get(path)
+        if entries is not None:
+            log("Listing of " + path + " read from cache")
+            return (('226', "Listing read from cache"), entries)
+        resp, listing = self.iter_listing(path)
+        if listing is None:
+            return (resp, None)
+        entries = list(listing)
+        if not listing.reply[0] == '226':
+            return (listing.reply, None)
+        self.cache.put(path, entries)
+        return (listing.reply, entries)
+
+
+    """
+    Starts a directory listing that is parsed while it arrives
+    MLSD is used if the server supports it, otherwise LIST. Nothing is cached.
+    Input:
+        pathname : Optional. The directory to list (default the working directory)
+        match : Optional. Only entries this accepts are yielded (see entry_filter)
+        raw : Optional. Use LIST and yield (Line, DirEntry) for each line, as ls prints them
+    Output:
+        tuple : ((Response Code, Response Message), ListingStream)
+        The stream is None if the listing was refused. Iterate it to the end or close it
+        before the session is used again.
+    """
+    def iter_listing(self, pathname = None, match = None, raw = False):
+        mlsd = self.mlsd is not False and not raw
+        argument = " " + pathname if pathname else ""
+        resp = self.start_transfer([("MLSD" if mlsd else "LIST") + argument + CRLF])[-1]
+        if mlsd and (resp[0] == '500' or resp[0] == '502'):
+            #MLSD is not supported, so remember that and fall back to LIST
+            self.mlsd = False
+            mlsd = False
+            resp = self.start_transfer(["LIST" + argument + CRLF])[-1]
+        if not (resp[0] == '150' or resp[0] == '125'):
+            return (resp, None)
+        if mlsd:
+            self.mlsd = True
+        self.accept_data()
+        return (resp, ListingStream(self, mlsd, match, raw))
+
+
+    """
+    Finds the working directory on the server, asking with PWD if it is not known
+    Output:
+        str : The absolute working directory
+    """
+    def getcwd(self):
+        if not self.cwd:
+            self.cwd = parse_pwd(self.ftp_pwd()[1]) or '/'
+        return self.cwd
+
+
+    """
+    Turns a remote path into a normalized absolute one
+    Input:
+        pathname : The remote path
+    Output:
+        str : The absolute remote path
+    """
+    def absolute(self, pathname):
+        if not pathname.startswith('/'):
+            pathname = posixpath.join(self.getcwd(), pathname)
+        return posixpath.normpath(pathname).replace('//', '/')
+
+
+    """
+    Drops the cached listing of the directory holding pathname after it was changed
+    Input:
+        pathname : The remote file that was created, changed or removed
+    """
+    def changed(self, pathname):
+        if pathname.startswith('/') or self.cwd:
+            self.cache.invalidate(posixpath.dirname(self.absolute(pathname)))
+        else:
+            self.cache.clear()
+
+
+    """
+    Downloads a file over the data connection
+    With verify on, the file is checksummed as it is written and compared with
+    the server's checksum, and downloaded again up to VERIFY_RETRIES times if
+    they differ. In ASCII type, line endings are converted to the local ones and
+    the size and checksum are not checked, since they differ from the server's.
+    Input:
+        filename : The name of the file on the server
+        savename : The name to save the file under, or an open file-like object to write
+                   to. A stream cannot be rewound, so it is not downloaded again.
+    Output:
+        tuple : ((Response Code, Response Message), (Bytes Written, Elapsed Seconds))
+        The transfer result is None if nothing was written. The reply is 451 if
+        the file never passed verification.
+    """
+    def get(self, filename, savename):
+        ascii = self.transfer_type == 'A'
+        attempts = 1 if hasattr(savename, 'write') else VERIFY_RETRIES + 1
+        for attempt in range(attempts):
+            algorithm, command = self.verify_plan() if self.verify and not ascii else (None, None)
+            digest = StreamHash(algorithm) if algorithm else None
+            resp = self.start_transfer(["RETR " + filename + CRLF], self.transfer_type)[-1]
+            #If the server approves:
+            if not (resp[0] == '150' or resp[0] == '125'):
+                return (resp, None)
+            #Do we need to accept a connection from the server?
+            self.accept_data()
+            #Read everything from the data connection and save it to savename
+            expected = get_transfer_size(resp[1])
+            chunk_size = self.tuning()[1]
+            flow = self.open_flow()
+            try:
+                result = readFile(self.data_socket, savename, chunk_size, preallocate = None if ascii else expected,
+                                  flow = flow, decompress = self.transfer_mode == 'Z', digest = digest,
+                                  newline = os.linesep if ascii else None,
+                                  grow_to = None if self.chunk_size else CHUNK_SIZE_MAX)
+            finally:
+                flow.close()
+            self.close_data()
+            if result:
+                self.observe_transfer('get', result[0], result[1])
+            resp = parse_response(self.read_reply())
+            if not (resp[0] == '226' and result) or ascii:
+                return (resp, result)
+            #Make sure the whole file arrived intact
+            problem = self.check_transfer(filename, result[0], expected, digest, command)
+            if not problem:
+                return (resp, result)
+            if not self.verify:
+                log("Warning: " + filename + ": " + problem)
+                return (resp, result)
+            log("Verification of " + filename + " failed (" + problem + "), attempt " + str(attempt + 1) + " of " + str(attempts))
+        return (('451', "Verification failed: " + problem), result)
+
+
+    """
+    Downloads one byte range of a file and writes it into place in a local file
+    REST positions the server at offset and the range is read from the RETR
+    stream. If the range ends before the file does, the rest of the transfer
+    is cut off with ABOR.
+    Input:
+        filename : The name of the file on the server
+        fileobj : The local file, opened for writing
+        offset : Where the range starts
+        length : How many bytes the range holds
+        to_end : Optional. The range runs to the end of the file, so read until the server closes
+    Output:
+        tuple : ((Response Code, Response Message), Bytes Written)
+        The reply is 226 (or 225 after ABOR) when the server confirmed the range,
+        or the reply to REST if the server refused it.
+    """
+    def get_range(self, filename, fileobj, offset, length, to_end = False):
+        replies = self.start_transfer(["REST " + str(offset) + CRLF, "RETR " + filename + CRLF], "I")
+        resp = replies[1]
+        if not replies[0][0] == '350':
+            if resp[0] == '150' or resp[0] == '125':
+                #RETR went ahead from the start of the file; cut it off so the control connection stays in step
+                self.accept_data()
+                self.close_data()
+                self.ftp_abor()
+            return (replies[0], 0)
+        if not (resp[0] == '150' or resp[0] == '125'):
+            return (resp, 0)
+        self.accept_data()
+        start = time.time()
+        written = 0
+        cut = False
+        chunk_size = self.tuning()[1]
+        flow = self.open_flow()
+        try:
+            chunks = recv_stream(self.data_socket, chunk_size, flow, None if self.chunk_size else CHUNK_SIZE_MAX)
+            if self.transfer_mode == 'Z':
+                chunks = inflate_stream(chunks, chunk_size)
+            for chunk in chunks:
+                chunk = chunk[:length - written]
+                write_at(fileobj, chunk, offset + written)
+                written += len(chunk)
+                if written == length and not to_end:
+                    cut = True
+                    break
+        finally:
+            flow.close()
+        self.close_data()
+        self.observe_transfer('get', written, time.time() - start)
+        resp = self.ftp_abor() if cut else parse_response(self.read_reply())
+        return (resp, written)
+
+
+    """
+    Uploads a file over the data connection
+    With verify on, the file is checksummed as it is sent and compared with the
+    server's checksum of the stored file, and sent again up to VERIFY_RETRIES
+    times if they differ. In ASCII type, line endings are sent as CRLF and the
+    stored file is not checked.
+    Input:
+        filename : The name of the local file, or an open file-like object to read from.
+                   A stream cannot be rewound, so it is not sent again.
+        remotename : Optional. The name to store the file under (default filename, required for a stream)
+    Output:
+        tuple : ((Response Code, Response Message), (Bytes Sent, Elapsed Seconds))
+        The transfer result is None if nothing was sent. The reply is 451 if
+        the file never passed verification, and has no code if the local file
+        cannot be read (nothing is sent to the server then).
+    """
+    def put(self, filename, remotename = None):
+        stream = hasattr(filename, 'read')
+        if stream and not remotename:
+            raise ValueError("A remote name is needed to upload from a stream")
+        remotename = remotename or filename
+        if not stream:
+            #STOR would create or truncate the remote file, so make sure there is something to send first
+            try:
+                open(filename, "rb").close()
+            except IOError as e:
+                return ((None, "Cannot read " + filename + ": " + str(e.strerror)), None)
+        ascii = self.transfer_type == 'A'
+        attempts = 1 if stream else VERIFY_RETRIES + 1
+        for attempt in range(attempts):
+            algorithm, command = self.verify_plan() if self.verify and not ascii else (None, None)
+            digest = StreamHash(algorithm) if algorithm else None
+            resp = self.start_transfer(["STOR " + remotename + CRLF], self.transfer_type)[-1]
+            self.changed(remotename)
+            #Are we good to send the file?
+            if not (resp[0] == '150' or resp[0] == '125'):
+                return (resp, None)
+            #Do we need to accept a connection from the server?
+            self.accept_data()
+            #Send all the data in the file
+            flow = self.open_flow()
+            try:
+                result = sendFile(self.data_socket, filename, self.chunk_size or SEND_CHUNK_SIZE, flow = flow,
+                                  digest = digest, compress = self.compress_level if self.transfer_mode == 'Z' else None,
+                                  newline = CRLF if ascii else None)
+            finally:
+                flow.close()
+            self.close_data()
+            if result:
+                self.observe_transfer('put', result[0], result[1])
+            resp = parse_response(self.read_reply())
+            if not (resp[0] == '226' and result and self.verify) or ascii:
+                return (resp, result)
+            #Make sure the server stored what was sent
+            problem = self.check_transfer(remotename, result[0], None, digest, command)
+            if not problem:
+                return (resp, result)
+            log("Verification of " + remotename + " failed (" + problem + "), attempt " + str(attempt + 1) + " of " + str(attempts))
+        return (('451', "Verification failed: " + problem), result)
+
+
+    """
+    Sends QUIT and closes the connections
+    Output:
+        tuple : (Response Code, Response Message)
+    """
+    def quit(self):
+        try:
+            return self.ftp_quit()
+        finally:
+            self.close()
+
+
+#MULTI-FILE TRANSFERS
 
-#GLOBAL VARIABLES
-CONTROL_SOCKET = None                               #Socket for Control Connection
-DATA_SOCKET = None                                  #Socket for Data Connection
-TARGET_ADDR = None                                  #IP Address of the FTP server
-TARGET_PORT = None                                  #Port Number for the Control Connection at the FTP server
-LOG_FILE = None                                     #Name of the log file
-BUFFER_SIZE = 1024                                  #Buffer for reading from FTP server
-VERBOSE = False                                     #Should the client print logging info to stdout?
-CRLF = "\r\n"                                       
-SUPPORTED_COMMANDS = """\nSupported Commands:       
-    about   cd      eprt    epsv
-    get     help    ls      pasv
-    port    put     pwd     quit\n"""
-ACTIVE_MODE = False                                 #Is the server in active mode?
+"""
+Finds the directory named in a PWD reply, e.g. '"/home/cs472" is the current directory'
+Input:
+    text: The message of the 257 reply
+Output:
+    The directory, or None if the reply did not contain one
+"""
+def parse_pwd(text):
+    directory = re.search('"(.*)"', text)
+    if directory:
+        return directory.group(1).replace('""', '"')
+    return None
 
 
 """
-Used for logging commands/replies/other important notes
-Logs a written to a log file. If the -v flag was set, they are also written to stdout.
+A pool of logged in sessions to the same server
+Sessions are opened on demand, up to size, with the credentials and working
+directory of the session the pool was made from. A session is borrowed with
+acquire(), which first changes it to that session's current directory so relative
+names mean the same to both, and handed back with release(); sessions whose
+control connection was lost are dropped instead of being reused.
+
 Input:
-    msg: The message to be logged
+    session: A connected, logged in session to copy the server and credentials from
+    size: Optional. The most sessions the pool will open (default POOL_SIZE)
 """
-def log(msg):
-    logfile = open(LOG_FILE,'a+')
-    logfile.write(str(datetime.datetime.now())[:-3] + ": "+msg + "\n")
-    logfile.close()
-    if VERBOSE:
-        print("#LOG: " + msg)
+class SessionPool(object):
+    FREED = None                                    #Put on idle when a slot frees up, to wake a waiting take()
+
+    def __init__(self, session, size = POOL_SIZE):
+        self.host = session.host
+        self.control_port = session.control_port
+        self.user = session.user
+        self.password = session.password
+        self.directory = session.getcwd()
+        self.cache = session.cache                  #Pooled sessions share the listing cache
+        self.origin = session                       #Pooled sessions follow its transfer settings
+        self.via = session.via
+        self.size = size
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+        self.sessions = []
+
+    def connect(self):
+        session = FTPSession(self.host, self.control_port)
+        session.cache = self.cache
+        session.via = self.via
+        session.connect()
+        resp = session.login(self.user, self.password)
+        if not resp[0] == '230':
+            session.close()
+            raise FTPError("Pool login failed: " + resp[1])
+        if self.directory:
+            session.ftp_cwd(self.directory)
+        return session
+
+    def acquire(self):
+        session = self.take()
+        session.priority = self.origin.priority
+        session.rate_limit = self.origin.rate_limit
+        session.compress = self.origin.compress
+        session.compress_level = self.origin.compress_level
+        session.verify = self.origin.verify
+        session.transfer_type = self.origin.transfer_type
+        session.socket_buffer = self.origin.socket_buffer
+        session.chunk_size = self.origin.chunk_size
+        if session.rate is None:
+            session.rtt, session.rate = self.origin.rtt, self.origin.rate  #Same server, so start from its measurements
+        directory = self.origin.cwd or self.directory   #Known without asking, so no PWD from this thread
+        if directory and not session.cwd == directory:
+            try:
+                resp = session.ftp_cwd(directory)
+            except (FTPError, socket_error):
+                session.close()
+                self.release(session)
+                raise
+            if not resp[0] == '250':
+                self.release(session)
+                raise FTPError("Could not change to " + directory + ": " + resp[1])
+        return session
+
+    def take(self, timeout = None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            try:
+                session = self.idle.get_nowait()
+            except queue.Empty:
+                with self.lock:
+                    create = len(self.sessions) < self.size
+                    if create:
+                        self.sessions.append(None)  #Hold the slot while connecting
+                if create:
+                    break
+                session = self.idle.get(timeout = None if deadline is None else max(0, deadline - time.time()))
+            if session is not self.FREED:
+                return session
+        try:
+            session = self.connect()
+        except (FTPError, socket_error):
+            self.free(None)
+            raise
+        with self.lock:
+            self.sessions[self.sessions.index(None)] = session
+        return session
+
+    def adopt(self, session):
+        with self.lock:
+            self.sessions.append(session)
+        self.idle.put(session)
+
+    def release(self, session):
+        if session.control_socket:
+            self.idle.put(session)
+        else:
+            self.free(session)
+
+    def free(self, slot):
+        with self.lock:
+            self.sessions.remove(slot)
+        self.idle.put(self.FREED)
+
+    def close(self):
+        with self.lock:
+            sessions, self.sessions = self.sessions, []
+        for session in sessions:
+            if session:
+                try:
+                    session.quit()
+                except (FTPError, socket_error):
+                    session.close()
 
 
 """
-Shut down the client with an error message
+Reads a manifest of files to transfer
+Each line names one file. A second, tab separated column gives the name to save
+it under. Blank lines and lines starting with # are skipped.
 Input:
-    msg: The message to be logged
+    filename: The name of the manifest file
+Output:
+    list : (Source, Destination) for each file. Destination is None if not given
 """
-def terminate(msg):
-    log("FATAL ERROR: " + msg)
-    print("A fatal error has occured: " + msg)
-    if CONTROL_SOCKET:
-        CONTROL_SOCKET.close()
-    if DATA_SOCKET:
-        DATA_SOCKET.close()
-    exit()
-    
+def read_manifest(filename):
+    jobs = []
+    with open(filename) as manifest:
+        for line in manifest:
+            line = line.rstrip("\r\n")
+            if not line.strip() or line.startswith('#'):
+                continue
+            fields = line.split('\t')
+            jobs.append((fields[0], fields[1] if len(fields) > 1 else None))
+    return jobs
+
 
 """
-Used for receiving information from the data connection. 
+Expands remote glob patterns into file names
+Directories are listed with listdir, so patterns in the same directory share one listing.
 Input:
-    socket: The socket to read everything from
+    session: A logged in session to list directories with
+    patterns: Remote file names or glob patterns
 Output:
-    data: All of the data read from socket
+    list : The matching remote file names, in order
 """
-def recvall(socket):
-    log("Reading info from the data connection...")
-    blankCount = 0
-    data = b""
-    while(True):
-        resp = socket.recv(BUFFER_SIZE)
-        if len(resp) == 0:
-            blankCount += 1
-            time.sleep(.1)
+def expand_remote(session, patterns):
+    names = []
+    for pattern in patterns:
+        if not glob.has_magic(pattern):
+            names.append(pattern)
+            continue
+        directory, match = pattern.rsplit('/', 1) if '/' in pattern else ('', pattern)
+        resp, entries = session.listdir(directory or None)
+        for name in sorted([entry.name for entry in entries or [] if not entry.type == 'dir']):
+            if fnmatch.fnmatch(name, match):
+                names.append(directory + '/' + name if directory else name)
+    return names
+
+
+"""
+Builds the list of files for mget/mput from what the user typed
+Input:
+    session: A logged in session, used to expand remote patterns
+    arguments: File names, glob patterns, or @manifest files
+    upload: TRUE for mput (local patterns), FALSE for mget (remote patterns)
+Output:
+    list : (Source, Destination) for each file
+"""
+def collect_transfers(session, arguments, upload):
+    jobs = []
+    patterns = []
+    for argument in arguments:
+        if argument.startswith('@'):
+            jobs.extend(read_manifest(argument[1:]))
         else:
-            data += resp
-            blankCount = 0
-        if blankCount > 3:
-            return data
+            patterns.append(argument)
+    if upload:
+        for pattern in patterns:
+            jobs.extend([(name, None) for name in sorted(glob.glob(pattern))])
+    else:
+        jobs.extend([(name, None) for name in expand_remote(session, patterns)])
+    return [(source, destination or os.path.basename(source)) for (source, destination) in jobs]
+
 
 """
-Establishes a connection between the client and the server
+Moves one file using a session borrowed from the pool
 Input:
-    str network : The network address of the server
-    int port    : The port number of the server (default 21)
+    pool: The session pool
+    source: The file to read from
+    destination: The file to write to
+    upload: TRUE to send a local file, FALSE to fetch a remote one
 Output:
-    On success, returns the socket for the control connection
-    On fail, returns None
+    tuple : (Source, Response Code, Response Message, Bytes, Elapsed Seconds)
 """
-def establish_connection(network, port = 21):
-    CONNECTION = socket(AF_INET, SOCK_STREAM)
-    log("Establishing connection at " + str((network, port)))
+def transfer_file(pool, source, destination, upload):
     try:
-        CONNECTION.settimeout(5)
-        CONNECTION.connect((network, port))
-        return CONNECTION
-    except socket_error as e:
-        print("An unexpected error occured during connection establishment")
-        print(e)
-        return None
-
+        session = pool.acquire()
+    except (FTPError, socket_error) as e:
+        return (source, None, str(e), 0, 0)
+    try:
+        if upload:
+            resp, result = session.put(source, destination)
+        else:
+            resp, result = session.get(source, destination)
+        if result:
+            return (source, resp[0], resp[1], result[0], result[1])
+        if resp[0] == '226':
+            resp = (None, "Nothing was transferred")   #The server finished, but the local file could not be used
+        return (source, resp[0], resp[1], 0, 0)
+    except (FTPError, socket_error) as e:
+        session.close()
+        return (source, None, str(e), 0, 0)
+    finally:
+        pool.release(session)
 
 
 """
-Converts the FTP format (h1,h2,h3,h4,p1,p2) into a socket address
+Moves many files at once, one per pooled session
 Input:
-    str headers : A string in the format h1,h2,h3,h4,p1,p2
-OutputL
-    tuple : (IP_ADDR, PORT_NUM)
+    pool: The session pool
+    jobs: (Source, Destination) for each file
+    upload: TRUE to send local files, FALSE to fetch remote ones
+    report: Optional. Called with each result as soon as that file is done
+Output:
+    list : (Source, Response Code, Response Message, Bytes, Elapsed Seconds) per file, in order
 """
-def get_socket_address(headers):
-    address_fields = headers.split(',')
-    DEST_IP = '.'.join(address_fields[0:4])
-    DEST_PORT = int(address_fields[4]) * 256 + int(address_fields[5])
-    return (DEST_IP,DEST_PORT)
-
+def transfer_files(pool, jobs, upload, report = None):
+    results = [None] * len(jobs)
+    pending = queue.Queue()
+    for index, job in enumerate(jobs):
+        pending.put((index, job))
+
+    def worker():
+        while True:
+            try:
+                index, (source, destination) = pending.get_nowait()
+            except queue.Empty:
+                return
+            results[index] = transfer_file(pool, source, destination, upload)
+            if report:
+                report(results[index])
+
+    workers = [threading.Thread(target = worker) for i in range(min(pool.size, len(jobs)))]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return results
 
 
 """
-Sends an FTP command over the control connection socket
+Formats a transfer rate for display
 Input:
-    msg : a complete FTP command
+    count: Number of bytes moved
+    seconds: Time taken
 Output:
-    The reply from the server, or None if the message failed to send
+    str : e.g. "1.50 MB/s"
 """
-def send_command(msg):
-    global CONTROL_SOCKET
-    log("Sent: " + msg[:-2])
-    try:    
-        if CONTROL_SOCKET:                                                             #Replace with code for establishing connection
-            CONTROL_SOCKET.send(msg)
-            reply = CONTROL_SOCKET.recv(BUFFER_SIZE)
-            log("Received: " + reply[:-2])
-            return reply
-        terminate("No Control Connection")
-    except socket_error as e:
-        print(e)
-        terminate("Control connection lost.")
+def format_rate(count, seconds):
+    rate = count / seconds if seconds > 0 else 0.0
+    for unit in ("B/s", "KB/s", "MB/s"):
+        if rate < 1024:
+            return "%.2f %s" % (rate, unit)
+        rate /= 1024.0
+    return "%.2f GB/s" % rate
 
 
 """
-Separates the response code and the response message from a server reply
+Prints the status of one file moved by transfer_files
+Called from the worker threads, so the lines are printed one at a time.
 Input:
-    reply: An FTP server message
-Output:
-    tuple : (Response Code, Response Message)
+    result: (Source, Response Code, Response Message, Bytes, Elapsed Seconds)
 """
-def parse_response(reply):
-    if not reply:
-        return None
+def report_transfer(result):
+    with REPORT_LOCK:
+        if result[1] == '226':
+            print("%-40s OK     %d bytes (%s)" % (result[0], result[3], format_rate(result[3], result[4])))
+        else:
+            print("%-40s FAILED %s" % (result[0], result[2]))
 
-    code = reply[0:3]
-    text = reply[4:-2]
-    return (code,text)
+REPORT_LOCK = threading.Lock()
 
 
 """
-Read a response from a socket.
+Runs mget or mput and prints the status of each file and a summary
 Input:
-    socket: The socket to read from
+    pool: The session pool
+    session: The interactive session, used to expand remote patterns
+    arguments: File names, glob patterns, or @manifest files
+    upload: TRUE for mput, FALSE for mget
 Output:
-    response: The message read 
+    list : The result for each file
 """
-def readSocket(socket):
-    response = socket.recv(BUFFER_SIZE)
-    log("Received: " + response[:-2])
-    return response
+def run_transfers(pool, session, arguments, upload):
+    jobs = collect_transfers(session, arguments, upload)
+    if not jobs:
+        print("No files matched")
+        return []
 
+    start = time.time()
+    results = transfer_files(pool, jobs, upload, report_transfer)
+    elapsed = time.time() - start
+    done = [result for result in results if result[1] == '226']
+    total = sum([result[3] for result in done])
+    print("%d of %d files transferred, %d bytes in %.2f seconds (%s)" %
+          (len(done), len(results), total, elapsed, format_rate(total, elapsed)))
+    log("Transferred " + str(len(done)) + " of " + str(len(results)) + " files, " + str(total) + " bytes in " + str(round(elapsed, 3)) + " seconds")
+    return results
+
+
+#SEGMENTED DOWNLOADS
 
 """
-Send a file along a socket
+Writes data at a position in a file without moving other writers
+Uses pwrite where the platform has it, so several threads can share one file.
+Otherwise the file object must belong to the calling thread.
 Input:
-    socket: The socket to transmit the data over
-    filename: The name of the file to be sent
+    fileobj: The open file
+    data: The bytes to write
+    offset: Where in the file to write them
 """
-def sendFile(socket, filename):
-    try:
-        sendFile = open(filename, "r+")
-    except IOError as e:
-        print("File path does not exist.")
-        return None
-    sendBuffer = sendFile.read(BUFFER_SIZE)
-    while not sendBuffer == "":
-        socket.send(sendBuffer)
-        sendBuffer = sendFile.read(BUFFER_SIZE)
-    sendFile.close()
-    socket.close()
+def write_at(fileobj, data, offset):
+    if hasattr(os, 'pwrite'):
+        view = memoryview(data)
+        while len(view):
+            count = os.pwrite(fileobj.fileno(), view, offset)
+            view = view[count:]
+            offset += count
+    else:
+        fileobj.seek(offset)
+        fileobj.write(data)
 
 
 """
-Read the data for a file being send over the data connection
+Splits a file into byte ranges for a segmented download
 Input:
-    socket: The socket for the data connection
-    filename: The name of the file to save the data under
+    size: Size of the file in bytes
+    segments: The most ranges to split it into
+    minimum: Optional. The smallest range worth its own connection
+Output:
+    list : (Offset, Length) for each range
+"""
+def split_ranges(size, segments, minimum = SEGMENT_MIN_SIZE):
+    segments = max(1, min(segments, size // minimum))
+    length = size // segments
+    ranges = [(i * length, length) for i in range(segments)]
+    ranges[-1] = (ranges[-1][0], size - ranges[-1][0])
+    return ranges
+
+
+"""
+Downloads one file over several connections at once
+The file is split into byte ranges with SIZE, and each range is fetched with
+REST + RETR on its own pooled session and written straight into place in a
+preallocated local file. Every range must be confirmed by the server and the
+finished file must match the remote size; if not, the local file is deleted.
+A server without REST gets a plain get instead.
+Input:
+    pool: The session pool; its size is the number of segments
+    filename: The name of the file on the server
+    savename: The name to save the file under
+Output:
+    tuple : (TRUE if the file is complete, Bytes Written, Elapsed Seconds)
 """
-def readFile(socket, filename):
+def segmented_get(pool, filename, savename):
+    start = time.time()
+    session = pool.acquire()
+    try:
+        if session.features and 'REST' not in session.features:
+            log("Server does not support REST, downloading " + filename + " in one piece")
+            return whole_get(session, filename, savename, start)
+        session.select_type("I")
+        resp = session.ftp_size(filename)
+    finally:
+        pool.release(session)
+    if not resp[0] == '213':
+        print(resp[1])
+        return (False, 0, 0)
+    size = int(resp[1].split()[0])
+    ranges = split_ranges(size, pool.size)
+    log("Downloading " + filename + " (" + str(size) + " bytes) in " + str(len(ranges)) + " segments")
+
     try:
-        newFile = open(filename, "w+")
+        newFile = open(savename, "wb+")
     except IOError as e:
         print("File path does not exist.")
-        return None
-    newFile.write(recvall(socket))
+        return (False, 0, 0)
+    if size:
+        preallocate_file(newFile, size)
     newFile.close()
 
+    results = [None] * len(ranges)
+
+    def fetch(index, offset, length):
+        to_end = offset + length == size
+        try:
+            session = pool.acquire()
+        except (FTPError, socket_error) as e:
+            results[index] = ((None, str(e)), 0)
+            return
+        target = None
+        try:
+            try:
+                target = open(savename, "r+b")
+            except IOError as e:                    #Caught apart, as socket errors are IOErrors in Python 3
+                results[index] = ((None, "Cannot write " + savename + ": " + str(e.strerror)), 0)
+                return
+            results[index] = session.get_range(filename, target, offset, length, to_end)
+        except (FTPError, socket_error) as e:
+            session.close()
+            results[index] = ((None, str(e)), 0)
+        finally:
+            if target:
+                target.close()
+            pool.release(session)
+
+    workers = [threading.Thread(target = fetch, args = (i, r[0], r[1])) for i, r in enumerate(ranges)]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+    complete = True
+    written = 0
+    refused = False
+    for (offset, length), result in zip(ranges, results):
+        resp, count = result or ((None, "Segment did not finish"), 0)
+        written += count
+        if count != length or not (resp[0] == '226' or resp[0] == '225'):
+            log("Segment at " + str(offset) + " failed: " + str(count) + " of " + str(length) + " bytes, " + str(resp[1]))
+            complete = False
+            refused = refused or resp[0] in ('500', '501', '502', '504')     #REST is not implemented
+    if os.path.getsize(savename) != size:
+        complete = False
+    if not complete:
+        os.remove(savename)                         #Don't leave a preallocated file of zeros behind
+        if refused:
+            log("Server refused REST, downloading " + filename + " in one piece")
+            session = pool.acquire()
+            try:
+                return whole_get(session, filename, savename, start)
+            finally:
+                pool.release(session)
+    elapsed = time.time() - start
+    log("Segmented download of " + filename + " " + ("complete" if complete else "FAILED") + ": " + str(written) + " bytes in " + str(round(elapsed, 3)) + " seconds")
+    return (complete, written, elapsed)
 
-#ACCESS CONTROL COMMANDS
 
 """
-FTP USER COMMAND
-Identifies the username of the current user.
-
-Input: 
-    username : Username of the user to be logged in
+Downloads a file in one piece for pget, when the server cannot send byte ranges
+Input:
+    session: A pooled session
+    filename: The name of the file on the server
+    savename: The name to save the file under
+    start: When the download started, from time.time()
 Output:
-    tuple : (Response Code, Response Message)
+    tuple : (TRUE if the file is complete, Bytes Written, Elapsed Seconds)
 """
-def ftp_user(username):
-    msg = "USER " + username + CRLF
-    
-    reply = parse_response(send_command(msg))
+def whole_get(session, filename, savename, start):
+    session.transfer_type = "I"                     #pget is always binary
+    try:
+        resp, result = session.get(filename, savename)
+    except (FTPError, socket_error) as e:
+        session.close()
+        resp, result = (None, str(e)), None
+    if not resp[0] == '226':
+        print(resp[1])
+    return (resp[0] == '226' and result is not None, result[0] if result else 0, time.time() - start)
 
-    return reply
 
+#RESUMABLE TRANSFERS
 
 """
-FTP PASS COMMAND
-Identifies the user's password.
+Records unfinished reget/reput transfers so they can be continued later
+The journal is a JSON file with one entry per transfer: the direction, the local
+and remote paths, the server, the file size and how many bytes are safely on
+the receiving side. It is rewritten atomically, at most every JOURNAL_INTERVAL
+seconds while a transfer is running and immediately when one starts or ends.
 
 Input:
-    password : Password of the user to be logged in
-Output:
-    tuple : (Response Code, Response Message)
+    filename: The name of the journal file
 """
-def ftp_pass(password):
-    msg = "PASS "+password+CRLF
-
-    reply = parse_response(send_command(msg))
-    
-    return reply
+class TransferJournal(object):
+    def __init__(self, filename, interval = JOURNAL_INTERVAL):
+        self.filename = filename
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.saved = 0
+        self.entries = {}
+        if os.path.exists(filename):
+            try:
+                with open(filename) as journal:
+                    self.entries = json.load(journal)
+            except (IOError, ValueError) as e:
+                log("Ignoring unreadable journal " + filename + ": " + str(e))
+
+    def find(self, direction, local, remote):
+        return self.entries.get(direction + "|" + local + "|" + remote)
+
+    def pending(self, host = None):
+        return [entry for entry in self.entries.values() if host is None or entry['host'] == host]
+
+    def begin(self, direction, local, remote, session, size, committed):
+        key = direction + "|" + local + "|" + remote
+        with self.lock:
+            self.entries[key] = {'direction': direction, 'local': local, 'remote': remote,
+                                 'host': session.host, 'port': session.control_port,
+                                 'size': size, 'committed': committed, 'updated': time.time()}
+            self.save()
+        return key
+
+    def update(self, key, committed):
+        with self.lock:
+            self.entries[key]['committed'] = committed
+            self.entries[key]['updated'] = time.time()
+            if time.time() - self.saved >= self.interval:
+                self.save()
+
+    def finish(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.save()
+
+    def save(self):
+        temp = self.filename + ".tmp"
+        with open(temp, 'w') as journal:
+            json.dump(self.entries, journal, indent = 1)
+        os.rename(temp, self.filename)
+        self.saved = time.time()
 
 
 """
-FTP CWD COMMAND
-Allows the user to work with a different directory.
-
+Turns a remote path into an absolute one, so it still means the same file after a reconnect
 Input:
-    pathname : The directory to change the server to
+    session: A logged in session
+    remote: The remote path
 Output:
-    tuple : (Respone Code, Response Message)
+    str : The absolute remote path
 """
-def ftp_cwd(pathname):
-    msg = "CWD "+pathname+CRLF
-
-    reply = parse_response(send_command(msg))
-
-    return reply 
+def absolute_remote(session, remote):
+    if remote.startswith('/'):
+        return remote
+    return session.absolute(remote)
 
 
 """
-FTP QUIT COMMAND
-Terminates user connection.
-
+Runs one attempt of a resumable transfer, reconnecting with backoff when the connection drops
+Input:
+    session: A logged in session
+    attempt: Called with no arguments for each try. Returns the final result, or raises
+             FTPError/socket.error for a failure worth retrying (a lost connection or a 4xx reply)
+    description: What is being transfered, for the log
 Output:
-    tuple : (Response Code, Response Message)
+    Whatever attempt returned, or None if every try lost the connection
 """
-def ftp_quit():
-    msg = "QUIT" + CRLF
-
-    reply = parse_response(send_command(msg))
-    
-    return reply
+def with_retries(session, attempt, description):
+    delay = RETRY_DELAY
+    for tries in range(RETRY_LIMIT + 1):
+        try:
+            return attempt()
+        except (FTPError, socket_error) as e:
+            log("Transfer of " + description + " interrupted: " + str(e))
+            session.close()
+        if tries == RETRY_LIMIT:
+            break
+        print("Connection lost, retrying in " + str(delay) + " seconds...")
+        time.sleep(delay)
+        delay = min(delay * 2, RETRY_MAX_DELAY)
+        try:
+            session.reconnect()
+            log("Reconnected to " + session.host)
+        except (FTPError, socket_error) as e:
+            log("Reconnect failed: " + str(e))
+    log("Giving up on " + description + " after " + str(RETRY_LIMIT) + " retries")
+    return None
 
 
-#TRANSFER PARAMETER COMMANDS
-
 """
-FTP PASV COMMAND
-Requests the server to listen on a data port and wait for a connection.
-
+Downloads a file, continuing from where an earlier attempt stopped
+The local file and the journal say how much has already arrived; the rest is
+fetched with REST + RETR. If the connection drops the session reconnects and
+carries on from the last checkpoint.
+Input:
+    session: A logged in session
+    remote: The name of the file on the server
+    local: The name to save the file under
+    journal: The transfer journal
 Output:
-    tuple : (Response Code, Response Message)
+    tuple : ((Response Code, Response Message), (File Size, Elapsed Seconds)), or None if it gave up
 """
-def ftp_pasv():
-    msg = "PASV" + CRLF
-
-    reply = parse_response(send_command(msg))
-
-    return reply
+def resumable_get(session, remote, local, journal):
+    remote = absolute_remote(session, remote)
+    local = os.path.abspath(local)
+
+    def attempt():
+        entry = journal.find('get', local, remote)
+        session.select_type("I")
+        resp = session.ftp_size(remote)
+        size = int(resp[1].split()[0]) if resp[0] == '213' else None
+        offset = 0
+        if entry and os.path.exists(local):
+            offset = min(os.path.getsize(local), entry['committed'])
+        if size is not None and offset > size:
+            offset = 0
+        key = journal.begin('get', local, remote, session, size, offset)
+        if size is not None and offset == size and offset > 0:
+            journal.finish(key)
+            return (('226', "Already complete"), (size, 0))
+        session.select_mode()
+        if not session.open_data():
+            raise FTPError("Could not open a data connection")
+        if offset and not session.ftp_rest(offset)[0] == '350':
+            offset = 0
+        if offset:
+            log("Resuming " + remote + " at byte " + str(offset))
+        resp = session.ftp_retr(remote)
+        if not (resp[0] == '150' or resp[0] == '125'):
+            session.close_data()
+            if resp[0].startswith('4'):
+                raise FTPError("Transfer refused: " + resp[1])
+            return (resp, None)                     #Permanent; left in the journal for resume
+        session.accept_data()
+        flow = session.open_flow()
+        try:
+            result = readFile(session.data_socket, local, session.tuning()[1], offset = offset, flow = flow,
+                              decompress = session.transfer_mode == 'Z',
+                              checkpoint = lambda committed: journal.update(key, committed),
+                              grow_to = None if session.chunk_size else CHUNK_SIZE_MAX)
+        finally:
+            flow.close()
+        session.close_data()
+        if result:
+            session.observe_transfer('get', result[0], result[1])
+        resp = parse_response(session.read_reply())
+        if resp[0].startswith('4'):
+            raise FTPError("Transfer failed: " + resp[1])
+        if not resp[0] == '226':
+            return (resp, None)                     #Permanent; left in the journal for resume
+        if size is not None and offset + result[0] != size:
+            raise FTPError("Received " + str(offset + result[0]) + " of " + str(size) + " bytes")
+        journal.finish(key)
+        return (resp, (offset + result[0], result[1]))
+
+    return with_retries(session, attempt, remote)
 
 
 """
-FTP PORT COMMAND
-Intructs the server to connect to the socket located at the host-port address
-
+Uploads a file, continuing from where an earlier attempt stopped
+The server's SIZE says how much has already arrived; the rest is sent with
+REST + STOR, or APPE if the server does not take REST for uploads. If the
+connection drops the session reconnects and carries on.
 Input:
-    headers : The address of the socket for the server to connect to. "h1,h2,h3,h4,p1,p2"
+    session: A logged in session
+    local: The name of the local file
+    remote: The name to store the file under
+    journal: The transfer journal
 Output:
-    tuple : (Response Code, Response Message) 
+    tuple : ((Response Code, Response Message), (File Size, Elapsed Seconds)), or None if it gave up
 """
-def ftp_port(headers):
-    
-    msg = "PORT " + headers + CRLF
-
-    reply = parse_response(send_command(msg))
-
-    return reply
+def resumable_put(session, local, remote, journal):
+    remote = absolute_remote(session, remote)
+    local = os.path.abspath(local)
+    size = os.path.getsize(local)
+
+    def attempt():
+        entry = journal.find('put', local, remote)
+        session.select_type("I")
+        offset = 0
+        if entry:
+            resp = session.ftp_size(remote)
+            if resp[0] == '213':
+                offset = int(resp[1].split()[0])
+            if offset > size:
+                offset = 0
+        key = journal.begin('put', local, remote, session, size, offset)
+        if offset == size and offset > 0:
+            journal.finish(key)
+            return (('226', "Already complete"), (size, 0))
+        session.select_mode()
+        if not session.open_data():
+            raise FTPError("Could not open a data connection")
+        if offset:
+            log("Resuming " + remote + " at byte " + str(offset))
+            if session.ftp_rest(offset)[0] == '350':
+                resp = session.ftp_stor(remote)
+            else:
+                resp = session.ftp_appe(remote)
+        else:
+            resp = session.ftp_stor(remote)
+        if not (resp[0] == '150' or resp[0] == '125'):
+            session.close_data()
+            if resp[0].startswith('4'):
+                raise FTPError("Transfer refused: " + resp[1])
+            return (resp, None)                     #Permanent; left in the journal for resume
+        session.accept_data()
+        flow = session.open_flow()
+        try:
+            result = sendFile(session.data_socket, local, session.chunk_size or SEND_CHUNK_SIZE, offset = offset,
+                              flow = flow, compress = session.compress_level if session.transfer_mode == 'Z' else None)
+        finally:
+            flow.close()
+        session.close_data()
+        if result:
+            session.observe_transfer('put', result[0], result[1])
+        resp = parse_response(session.read_reply())
+        if resp[0].startswith('4'):
+            raise FTPError("Transfer failed: " + resp[1])
+        if not resp[0] == '226':
+            return (resp, None)                     #Permanent; left in the journal for resume
+        journal.finish(key)
+        return (resp, (size, result[1]))
+
+    return with_retries(session, attempt, local)
 
 
 """
-FTP EPSV COMMAND
-Requests the server to listen on a data port and wait for a connection
-
+Continues every unfinished transfer in the journal for this server
+Input:
+    session: A logged in session
+    journal: The transfer journal
 Output:
-    tuple : (Response Code, Response Message)
+    list : The result of each transfer
 """
-def ftp_epsv():
-    msg = "EPSV 1" + CRLF
-
-    reply = parse_response(send_command(msg))
+def resume_all(session, journal):
+    results = []
+    for entry in journal.pending(session.host):
+        if entry['direction'] == 'get':
+            print("Resuming download of " + entry['remote'])
+            results.append(resumable_get(session, entry['remote'], entry['local'], journal))
+        else:
+            print("Resuming upload of " + entry['local'])
+            results.append(resumable_put(session, entry['local'], entry['remote'], journal))
+    return results
 
-    return reply
 
+#TREE WALKING
 
 """
-FTP EPSV COMMAND
-Allows for the specification of an extended address for the data connection
-
+Walks a remote directory tree breadth first, listing directories in parallel
+Each pooled session lists one directory at a time; the subdirectories it finds
+are queued behind the directories already waiting. Listings are yielded as soon
+as they arrive, so the caller can work on them while the walk carries on.
+Closing the generator early stops the walk.
 Input:
-    protocol : The number indicating which internet protocol to use. 1 = IPv4, 2 = IPv6.
-    address : The IP address of the socket address
-    port : The port number of the socket address
+    pool: The session pool
+    top: The absolute remote directory to start from
 Output:
-    tuple : (Response Code, Response Message)
+    Yields (Directory, Entries) for each directory, in the order the listings arrive.
+    Entries is a list of DirEntry, or None if the directory could not be listed.
 """
-def ftp_eprt(protocol, address, port):
-    msg = "EPRT |"+str(protocol)+"|"+str(address)+"|"+str(port)+"|" + CRLF
-
-    reply = parse_response(send_command(msg))
-
-    return reply
+def walk_tree(pool, top):
+    pending = queue.Queue()                         #Directories waiting to be listed
+    done = queue.Queue()                            #(Directory, Entries) of finished listings
+    stop = threading.Event()
+
+    def list_directory(directory):
+        try:
+            session = pool.acquire()
+        except (FTPError, socket_error) as e:
+            log("Could not list " + directory + ": " + str(e))
+            return None
+        try:
+            resp, entries = session.listdir(directory)
+            if entries is None:
+                log("Could not list " + directory + ": " + resp[1])
+            return entries
+        except (FTPError, socket_error) as e:
+            log("Could not list " + directory + ": " + str(e))
+            session.close()
+        except Exception:
+            session.close()                         #Its control connection may be out of step
+            raise
+        finally:
+            pool.release(session)
+
+    def worker():
+        while True:
+            directory = pending.get()
+            if directory is None or stop.is_set():
+                return
+            entries = None
+            try:
+                entries = list_directory(directory)
+            except Exception as e:
+                log("Could not list " + directory + ": " + repr(e))
+            finally:
+                done.put((directory, entries))      #Every directory started is finished, or the walk waits forever
+
+    workers = [threading.Thread(target = worker) for i in range(pool.size)]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+    pending.put(top)
+    outstanding = 1
+    try:
+        while outstanding:
+            directory, entries = done.get()
+            outstanding -= 1
+            for entry in entries or []:
+                if entry.type == 'dir':
+                    pending.put(posixpath.join(directory, entry.name))
+                    outstanding += 1
+            yield (directory, entries)
+    finally:
+        stop.set()
+        for thread in workers:
+            pending.put(None)
+        if not outstanding:
+            for thread in workers:
+                thread.join()
 
 
-#SERVICE COMMANDS
+"""
+Finds the remote files below a directory whose names match a pattern
+Input:
+    pool: The session pool
+    top: The absolute remote directory to search
+    pattern: Optional. A glob pattern the file name must match (default every file)
+    kind: Optional. Only yield entries of this type, 'file' or 'dir'
+Output:
+    Yields (Path, DirEntry) for each match, while the walk is still running
+"""
+def find_remote(pool, top, pattern = '*', kind = None):
+    for directory, entries in walk_tree(pool, top):
+        for entry in entries or []:
+            if (kind is None or entry.type == kind) and fnmatch.fnmatch(entry.name, pattern):
+                yield (posixpath.join(directory, entry.name), entry)
 
 
 """
-FTP RETR COMMAND
-Instructs the server to transfer a copy of the file PATHNAME to
-the host at the other end of the data connection.
+Adds up the size of the files below a remote directory
+Input:
+    pool: The session pool
+    top: The absolute remote directory
+Output:
+    tuple : ({Child Directory: Bytes} for each directory directly below top, Total Bytes, Files, Directories)
+"""
+def disk_usage(pool, top):
+    children = {}
+    total = files = directories = 0
+    for directory, entries in walk_tree(pool, top):
+        directories += 1
+        relative = directory[len(top):].lstrip('/')
+        child = relative.split('/')[0] if relative else None
+        for entry in entries or []:
+            if entry.type == 'dir' and not relative:
+                children.setdefault(entry.name, 0)
+            if entry.type == 'file':
+                files += 1
+                total += entry.size or 0
+                if child:
+                    children[child] += entry.size or 0
+    return (children, total, files, directories - 1)
+
+
+#MIRRORING
 
+"""
+Finds the time in an MDTM reply, e.g. "20240101120000"
 Input:
-    pathname : The name of the file to be sent from the server
+    text: The message of the 213 reply
 Output:
-    tuple : (Response Code, Response Message)
+    Seconds since the epoch, or None if the reply did not contain a time
 """
-def ftp_retr(pathname):
-    msg = "RETR "+pathname+CRLF
+def parse_mdtm(text):
+    stamp = re.search(r'(\d{14})', text)
+    if stamp:
+        return calendar.timegm(time.strptime(stamp.group(1), '%Y%m%d%H%M%S'))
+    return None
 
-    reply = parse_response(send_command(msg))
 
-    return reply
+"""
+Lists every file below a remote directory
+Input:
+    pool: The session pool, used to list directories in parallel
+    top: The absolute remote directory
+Output:
+    tuple : ({Relative Path: DirEntry} for each file, [Relative Path] of each directory)
+    Paths use / and are relative to top. Links are skipped.
+"""
+def walk_remote(pool, top):
+    files = {}
+    directories = []
+    for directory, entries in walk_tree(pool, top):
+        if entries is None:
+            raise FTPError("Could not list " + directory)
+        relative = directory[len(top):].lstrip('/')
+        for entry in entries:
+            path = posixpath.join(relative, entry.name) if relative else entry.name
+            if entry.type == 'dir':
+                directories.append(path)
+            elif entry.type == 'file':
+                files[path] = entry
+    return (files, sorted(directories))
 
 
 """
-FTP STOR COMMAND
-Causes the server to accept the data transfered via the data connection 
-and store the file at the server site. 
-
+Lists every file below a local directory
 Input:
-    pathname : The name of the file to be sent to the server
+    top: The local directory
+    skip: Optional. File names to leave out, e.g. the mirror index
 Output:
-    tuple : (Response Code, Response Message)   
+    tuple : ({Relative Path: (Size, Modified Time)} for each file, [Relative Path] of each directory)
+    Paths use / and are relative to top.
 """
-def ftp_stor(pathname):
-    msg = "STOR "+pathname+CRLF
-
-    reply = parse_response(send_command(msg))
+def walk_local(top, skip = ()):
+    files = {}
+    directories = []
+    for directory, subdirectories, names in os.walk(top):
+        relative = os.path.relpath(directory, top).replace(os.sep, '/')
+        relative = '' if relative == '.' else relative
+        for name in subdirectories:
+            directories.append(posixpath.join(relative, name) if relative else name)
+        for name in names:
+            if name in skip:
+                continue
+            info = os.stat(os.path.join(directory, name))
+            files[posixpath.join(relative, name) if relative else name] = (info.st_size, int(info.st_mtime))
+    return (files, sorted(directories))
 
-    return reply
 
+"""
+What the last mirror run left on both sides, stored as JSON in the local directory
+For each file it keeps the remote size and modified time and the local size and
+modified time after the file was transfered. A file whose facts still match on
+both sides has not changed and is not transfered again.
 
+Input:
+    filename: The name of the index file
+    host: The server being mirrored
+    remote: The absolute remote directory being mirrored
 """
-FTP PWD COMMAND
-Causes the name of the current working directory to be returned in the reply.
+class MirrorIndex(object):
+    def __init__(self, filename, host, remote):
+        self.filename = filename
+        self.host = host
+        self.remote = remote
+        self.files = {}
+        if os.path.exists(filename):
+            try:
+                with open(filename) as index:
+                    saved = json.load(index)
+                if saved.get('host') == host and saved.get('remote') == remote:
+                    self.files = saved.get('files', {})
+            except (IOError, ValueError) as e:
+                log("Ignoring unreadable mirror index " + filename + ": " + str(e))
+
+    def unchanged(self, path, remote, local):
+        record = self.files.get(path)
+        return bool(record) and [record['size'], record['mtime']] == list(remote) and \
+            [record['local_size'], record['local_mtime']] == list(local)
+
+    def record(self, path, remote, local):
+        self.files[path] = {'size': remote[0], 'mtime': remote[1], 'local_size': local[0], 'local_mtime': local[1]}
+
+    def forget(self, path):
+        self.files.pop(path, None)
+
+    def save(self):
+        temp = self.filename + ".tmp"
+        with open(temp, 'w') as index:
+            json.dump({'host': self.host, 'remote': self.remote, 'files': self.files}, index, indent = 1)
+        os.rename(temp, self.filename)
 
+
+"""
+Finds the size and modified time of a remote file
+They come from the listing when the server gave them, otherwise from SIZE and MDTM.
+Input:
+    session: A logged in session
+    path: The absolute remote path
+    entry: The DirEntry from the listing
 Output:
-    tuple : (Response Code, Response Message)
+    tuple : (Size, Modified Time). Either is None if the server would not say
 """
-def ftp_pwd():
-    msg = "PWD" + CRLF
+def remote_facts(session, path, entry):
+    size, mtime = entry.size, entry.mtime
+    if size is None:
+        resp = session.ftp_size(path)
+        size = int(resp[1].split()[0]) if resp[0] == '213' else None
+    if mtime is None:
+        resp = session.ftp_mdtm(path)
+        mtime = parse_mdtm(resp[1]) if resp[0] == '213' else None
+    return (size, mtime)
 
-    reply = parse_response(send_command(msg))
 
-    return reply
+"""
+Makes a local directory match a remote one, fetching only new and changed files
+Input:
+    pool: The session pool
+    session: The interactive session
+    remote: The remote directory
+    local: The local directory
+    delete: Optional. Remove local files that are not on the server
+Output:
+    tuple : (Files Transfered, Files Deleted, Files Failed)
+"""
+def mirror_pull(pool, session, remote, local, delete = False):
+    remote = session.absolute(remote)
+    remote_files, remote_directories = walk_remote(pool, remote)
+    if not os.path.isdir(local):
+        os.makedirs(local)
+    index = MirrorIndex(os.path.join(local, MIRROR_INDEX), session.host, remote)
+    local_files = walk_local(local, (MIRROR_INDEX, MIRROR_INDEX + ".tmp"))[0]
+    for directory in remote_directories:
+        path = os.path.join(local, *directory.split('/'))
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    #Work out which files changed since the last run
+    jobs = []
+    facts = {}
+    for path in sorted(remote_files):
+        facts[path] = remote_facts(session, posixpath.join(remote, path), remote_files[path])
+        mine = local_files.get(path)
+        if mine and index.unchanged(path, facts[path], mine):
+            continue
+        if mine and path not in index.files and facts[path] == mine:
+            index.record(path, facts[path], mine)      #Already the same, e.g. copied by hand
+            continue
+        jobs.append((posixpath.join(remote, path), os.path.join(local, *path.split('/'))))
+
+    results = transfer_files(pool, jobs, False, report_transfer) if jobs else []
+    failed = 0
+    for (source, destination), result in zip(jobs, results):
+        path = source[len(remote):].lstrip('/')
+        if not result[1] == '226':
+            failed += 1
+            index.forget(path)
+            continue
+        #Give the copy the server's time so the next run sees it unchanged
+        if facts[path][1] is not None:
+            os.utime(destination, (facts[path][1], facts[path][1]))
+        info = os.stat(destination)
+        index.record(path, facts[path], (info.st_size, int(info.st_mtime)))
+
+    deleted = 0
+    for path in sorted(local_files):
+        if path in remote_files:
+            continue
+        index.forget(path)
+        if delete:
+            os.remove(os.path.join(local, *path.split('/')))
+            print("Deleted " + path)
+            deleted += 1
+    index.save()
+    return (len(jobs) - failed, deleted, failed)
 
 
 """
-FTP LIST COMMAND
-Causes a list to be sent from the server to the passive DTP.
-
+Makes a remote directory match a local one, sending only new and changed files
 Input:
-    pathname : Optional. Name of a directory or file to list information about
+    pool: The session pool
+    session: The interactive session, used to change the remote tree
+    local: The local directory
+    remote: The remote directory
+    delete: Optional. Remove remote files that are not in the local directory
 Output:
-    tuple : (Response Code, Response Message)
+    tuple : (Files Transfered, Files Deleted, Files Failed)
 """
-def ftp_list(pathname = None):
-    if pathname:
-        msg = "LIST " + pathname + CRLF
-    else:
-        msg = "LIST" + CRLF
+def mirror_push(pool, session, local, remote, delete = False):
+    remote = session.absolute(remote)
+    if not os.path.isdir(local):
+        raise FTPError(local + " is not a directory")
+    resp, entries = session.listdir(remote)
+    if entries is None:
+        resp = session.ftp_mkd(remote)
+        if not resp[0] == '257':
+            raise FTPError("Could not create " + remote + ": " + resp[1])
+    remote_files, remote_directories = walk_remote(pool, remote)
+    index = MirrorIndex(os.path.join(local, MIRROR_INDEX), session.host, remote)
+    local_files, local_directories = walk_local(local, (MIRROR_INDEX, MIRROR_INDEX + ".tmp"))
+    for directory in local_directories:
+        if directory not in remote_directories:
+            resp = session.ftp_mkd(posixpath.join(remote, directory))
+            if not resp[0] == '257':
+                print("Could not create " + directory + ": " + resp[1])
+
+    #Work out which files changed since the last run
+    jobs = []
+    for path in sorted(local_files):
+        entry = remote_files.get(path)
+        if entry:
+            theirs = (entry.size, entry.mtime)
+            if index.unchanged(path, theirs, local_files[path]):
+                continue
+            if path not in index.files and entry.size == local_files[path][0] and \
+                    entry.mtime is not None and entry.mtime >= local_files[path][1]:
+                index.record(path, theirs, local_files[path])      #Already the same, e.g. copied by hand
+                continue
+        jobs.append((os.path.join(local, *path.split('/')), posixpath.join(remote, path)))
+
+    results = transfer_files(pool, jobs, True, report_transfer) if jobs else []
+    failed = 0
+    sent = []
+    for (source, destination), result in zip(jobs, results):
+        path = destination[len(remote):].lstrip('/')
+        if result[1] == '226':
+            sent.append(path)
+        else:
+            failed += 1
+            index.forget(path)
+
+    deleted = 0
+    for path in sorted(remote_files):
+        if path in local_files:
+            continue
+        index.forget(path)
+        if delete:
+            resp = session.ftp_dele(posixpath.join(remote, path))
+            if resp[0] == '250':
+                print("Deleted " + path)
+                deleted += 1
+            else:
+                print("Could not delete " + path + ": " + resp[1])
 
-    reply = parse_response(send_command(msg))
+    #Read back what the server recorded for the new copies, one listing per directory
+    if sent:
+        remote_files = walk_remote(pool, remote)[0]
+        for path in sent:
+            entry = remote_files.get(path)
+            if entry:
+                index.record(path, (entry.size, entry.mtime), local_files[path])
+    index.save()
+    return (len(sent), deleted, failed)
 
-    return reply
 
+#SESSION DAEMON
 
 """
-FTP SYST COMMAND
-Used to find out the type of operating system at the server
-
-Output:
-    tuple : (Response Code, Response Message)
+Counts the commands a server has answered from the raw bytes of its replies
+A multi-line reply (RFC 959 "123-" ... "123 ") answers one command, and a
+preliminary reply (1xx) is followed by another reply to the same command.
 """
-def ftp_syst():
-    msg = "SYST" + CRLF
+class ReplyCounter(object):
+    def __init__(self):
+        self.buffer = b""                           #Part of a line not yet complete
+        self.code = None                            #Code of the multi-line reply being read, if any
+
+    """
+    Input:
+        data: Bytes read from the control connection
+    Output:
+        int : The number of commands answered by the replies completed in data
+    """
+    def feed(self, data):
+        lines = (self.buffer + data).split(b"\n")
+        self.buffer = lines.pop()
+        answered = 0
+        for line in lines:
+            if self.code is None and line[3:4] == b"-":
+                self.code = line[:3]
+            elif self.code is None or line.startswith(self.code + b" "):
+                self.code = None
+                if not line.startswith(b"1"):
+                    answered += 1
+        return answered
 
-    reply = parse_response(send_command(msg))
 
-    return reply
+"""
+Holds logged in control connections for later runs of the client to use
+A thin client (--via) connects to a Unix socket instead of the server and is given
+an idle session from the pool. Its commands are relayed over that session's control
+connection, so it skips the DNS lookup, the connect, the greeting and the login.
+Data connections still go straight between the client and the server. Idle
+sessions are kept open with NOOP and reconnected if the server dropped them.
+When a client leaves, whatever it changed (directory, MODE, TYPE) is put back;
+a session left mid-command or logged in again is closed instead.
+
+Input:
+    session: A connected, logged in session
+    path: The Unix socket to listen on
+    size: Optional. The most control connections held open (default POOL_SIZE)
+"""
+class SessionDaemon(object):
+    DROP_COMMANDS = set(['USER', 'PASS', 'ACCT', 'REIN', 'OPTS'])  #Change the session in ways that cannot be undone
+    CWD_COMMANDS = set(['CWD', 'CDUP', 'XCWD', 'XCUP'])
+    PENDING_COMMANDS = set(['REST', 'RNFR'])        #Affect the next command, which may come from another client
+
+    def __init__(self, session, path, size = POOL_SIZE):
+        self.path = path
+        self.pool = SessionPool(session, size)
+        self.pool.adopt(session)
+        self.stopped = threading.Event()
+
+    """
+    Listens on the Unix socket and serves clients until interrupted
+    The socket is only usable by this user. A socket left behind by a daemon that
+    was killed is replaced.
+    """
+    def serve(self):
+        if os.path.exists(self.path):
+            probe = socket(AF_UNIX, SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                running = True
+            except socket_error:
+                running = False
+            probe.close()
+            if running:
+                raise FTPError("A session daemon is already listening on " + self.path)
+            os.remove(self.path)
+        listener = socket(AF_UNIX, SOCK_STREAM)
+        mask = os.umask(0o177)
+        try:
+            listener.bind(self.path)
+        finally:
+            os.umask(mask)
+        listener.listen(16)
+        log("Session daemon listening on " + self.path)
+        keepalive = threading.Thread(target = self.keepalive)
+        keepalive.daemon = True
+        keepalive.start()
+        try:
+            while True:
+                client = listener.accept()[0]
+                thread = threading.Thread(target = self.handle, args = (client,))
+                thread.daemon = True
+                thread.start()
+        finally:
+            self.stopped.set()
+            listener.close()
+            os.remove(self.path)
+            self.pool.close()
+
+    """
+    Serves one client on a session from the pool
+    Input:
+        client: The client's connection to the Unix socket
+    """
+    def handle(self, client):
+        try:
+            session = self.pool.take(DAEMON_WAIT)
+        except (queue.Empty, FTPError, socket_error) as e:
+            self.refuse(client, str(e) or "Every session is busy")
+            return
+        used = None
+        try:
+            if not self.alive(session):
+                self.revive(session)
+            if not session.control_socket:
+                self.refuse(client, "Could not reconnect to " + session.host)
+                return
+            greeting = ("220 Logged in to " + session.host + " at " + session.address + " port " + str(session.control_port) +
+                        " from " + session.control_socket.getsockname()[0])
+            client.sendall(encode(greeting + CRLF))
+            used = self.relay(client, session)
+        except (FTPError, socket_error) as e:
+            log("Session daemon client failed: " + str(e))
+        finally:
+            client.close()
+            self.restore(session, used)
+            self.pool.release(session)
+
+    """
+    Turns a client away with a 421 reply
+    Input:
+        client: The client's connection
+        reason: Why no session could be given to it
+    """
+    def refuse(self, client, reason):
+        try:
+            client.sendall(encode("421 " + reason + CRLF))
+        except socket_error:
+            pass
+        client.close()
+
+    """
+    Passes commands from the client to the server and the replies back until the client quits
+    FEAT is answered from the features read at login, and QUIT is answered here so
+    the control connection stays open for the next client.
+    Input:
+        client: The client's connection
+        session: The session to relay over
+    Output:
+        set : The commands the client sent, or None if it left a command unanswered or waiting for the next one
+    """
+    def relay(self, client, session):
+        server = session.control_socket
+        counter = ReplyCounter()
+        outstanding = 0                             #Commands sent to the server and not yet answered
+        used = set()
+        last = None
+        partial = b""                               #Part of a command line not yet complete
+        quitting = False
+        while not (quitting and outstanding == 0):
+            readable = select.select([server] if quitting else [client, server], [], [])[0]
+            if server in readable:
+                data = server.recv(DATA_BUFFER_SIZE)
+                if not data:
+                    raise FTPError("Control connection closed by server")
+                outstanding = max(outstanding - counter.feed(data), 0)
+                client.sendall(data)
+            if client in readable:
+                data = client.recv(BUFFER_SIZE)
+                if not data:
+                    break                           #Gone without QUIT
+                lines = (partial + data).split(b"\n")
+                partial = lines.pop()
+                for line in lines:
+                    command = decode(line).strip().split(' ')[0].upper()
+                    if command == 'QUIT':
+                        quitting = True
+                        break
+                    if command == 'FEAT' and outstanding == 0 and session.features:
+                        client.sendall(encode(self.feat_reply(session.features)))
+                        continue
+                    log("Relayed: " + decode(line).strip())
+                    server.sendall(line + b"\n")
+                    outstanding += 1
+                    used.add(command)
+                    last = command
+        if outstanding or last in self.PENDING_COMMANDS:
+            return None
+        if quitting:
+            client.sendall(encode("221 Goodbye." + CRLF))
+        return used
+
+    """
+    Builds a FEAT reply from the features read at login
+    Input:
+        features: {Feature Name: Parameters}
+    Output:
+        str : The complete 211 reply
+    """
+    def feat_reply(self, features):
+        lines = [" " + (name + " " + features[name]).strip() for name in sorted(features)]
+        return CRLF.join(["211-Features:"] + lines + ["211 End"]) + CRLF
+
+    """
+    Undoes what a client changed, so the next client finds the session as it was
+    Input:
+        session: The session the client used
+        used: The commands from relay, or None to close the session
+    """
+    def restore(self, session, used):
+        if used is None or used & self.DROP_COMMANDS:
+            session.close()
+            return
+        session.reader.buffer = b""                 #Replies were relayed without the reader
+        try:
+            if used & self.CWD_COMMANDS:
+                session.cwd = None
+                if not self.pool.directory or not session.ftp_cwd(self.pool.directory)[0] == '250':
+                    session.close()
+                    return
+            if 'MODE' in used and not session.ftp_mode('S')[0] == '200':
+                session.close()
+                return
+            if 'TYPE' in used:
+                session.server_type = None
+        except (FTPError, socket_error) as e:
+            log("Could not reset session: " + str(e))
+            session.close()
+
+    """
+    Checks that the server has not closed an idle control connection or sent an unasked reply (e.g. 421 timeout)
+    Input:
+        session: An idle session
+    Output:
+        TRUE if the session can be used
+    """
+    def alive(self, session):
+        if not session.control_socket:
+            return False
+        return not select.select([session.control_socket], [], [], 0)[0]
+
+    """
+    Opens a fresh control connection for a session whose connection was lost
+    On failure the session is left closed, and the pool drops it when it is released.
+    Input:
+        session: The session to reconnect
+    """
+    def revive(self, session):
+        try:
+            session.reconnect()
+            if self.pool.directory:
+                session.ftp_cwd(self.pool.directory)
+            log("Reconnected to " + session.host)
+        except (FTPError, socket_error) as e:
+            log("Reconnect failed: " + str(e))
+            session.close()
+
+    """
+    Sends NOOP on each idle session every KEEPALIVE_INTERVAL seconds, reconnecting those that failed
+    If every session was lost a new one is opened, so the next client does not wait for the login.
+    """
+    def keepalive(self):
+        while not self.stopped.wait(KEEPALIVE_INTERVAL):
+            idle = []
+            while True:
+                try:
+                    idle.append(self.pool.idle.get_nowait())
+                except queue.Empty:
+                    break
+            for session in idle:
+                try:
+                    healthy = self.alive(session) and session.ftp_noop()[0] == '200'
+                except (FTPError, socket_error):
+                    healthy = False
+                if not healthy:
+                    self.revive(session)
+                self.pool.release(session)
+            with self.pool.lock:
+                empty = not self.pool.sessions
+            if empty:
+                try:
+                    self.pool.release(self.pool.take())
+                except (FTPError, socket_error) as e:
+                    log("Reconnect failed: " + str(e))
 
 
 """
@@ -450,312 +4408,867 @@ def ftp_help(argument = None):
         print(SUPPORTED_COMMANDS)
     elif argument == "about":
         print("about:       Show server system information.")
+    elif argument == "ascii":
+        print("ascii:       Transfer files with get and put as text (TYPE A), converting line endings.")
+    elif argument == "binary":
+        print("binary:      Transfer files with get and put byte for byte (TYPE I). This is the default.")
     elif argument == "cd":
         print("cd:          Change current working directory.")
+    elif argument == "compress":
+        print("compress:    compress on|off|LEVEL. Sends data in MODE Z (deflate) when the server supports it; LEVEL 1 (fast) to 9 (small) sets the upload level. With no argument, shows the setting.")
+    elif argument == "dir":
+        print("dir:         Directory. Show the name, type, size and date of each entry in a directory. Listings are cached; dir -r asks the server again. Takes the same filters as ls.")
+    elif argument == "du":
+        print("du:          Disk usage. Totals the size of every file below a directory, listing several directories at once.")
     elif argument == "eprt":
-        print("eprt:        Extended Port. Tells the server what port to connect to for the data connection.")
+        print("eprt:        Extended Port. Tells the server what port to connect to for the data connection. Optional: transfers open one on their own.")
     elif argument == "epsv":
-        print("epsv:        Extended Passive. Tells the server to open a port so the client can establish a data connection.")
+        print("epsv:        Extended Passive. Tells the server to open a port so the client can establish a data connection. Optional: transfers open one on their own.")
+    elif argument == "find":
+        print("find:        find DIRECTORY [PATTERN] [-type f|d]. Prints every path below a directory whose name matches the pattern.")
     elif argument == "get":
-        peint("get:         Get file. Tells the server to send a file to the client. Requires data connection.")
+        print("get:         Get file. Tells the server to send a file to the client. get FILE - writes it to stdout.")
     elif argument == "help":
         print("help:        Show information regarding supported commands.")
+    elif argument == "limit":
+        print("limit:       limit RATE caps the bandwidth of all transfers together, e.g. limit 2M; limit transfer RATE caps each transfer; limit off removes the cap. With no rate, shows the limits.")
     elif argument == "ls":
-        print("ls:          List. Show the information for all files in a directory. Requires data connection.")
+        print("ls:          List. Show the information for all files in a directory, printing each line as it arrives. Filters: -name GLOB, -type f|d|l, -size MIN (e.g. 10M), -newer DATE|AGE (e.g. 2024-01-31 or 7d).")
+    elif argument == "mget":
+        print("mget:        Multiple get. Fetches every file matching the patterns or listed in an @manifest, several at a time.")
+    elif argument == "mirror":
+        print("mirror:      mirror pull REMOTE LOCAL or mirror push LOCAL REMOTE. Copies only new and changed files; -d also deletes files missing from the source.")
+    elif argument == "mput":
+        print("mput:        Multiple put. Sends every local file matching the patterns or listed in an @manifest, several at a time.")
     elif argument == "pasv":
-        print("pasv:        Passive. Tells the server to open a port so the client can establish a data connection.")
+        print("pasv:        Passive. Tells the server to open a port so the client can establish a data connection. Optional: transfers open one on their own.")
+    elif argument == "pget":
+        print("pget:        Parallel get. Downloads one large file in segments over several connections at once.")
     elif argument == "port":
-        print("port:        Port. Tells the server what port to connect to for the data connection.")
+        print("port:        Port. Tells the server what port to connect to for the data connection. Optional: transfers open one on their own.")
+    elif argument == "priority":
+        print("priority:    priority high|normal|low. Sets the share of the bandwidth limit given to this session's transfers.")
     elif argument == "put":
-        print("put:         Put file. Tells the server to store a file from the client. Requires data connection.")
+        print("put:         Put file. Tells the server to store a file from the client. put FILE [REMOTE]; put - REMOTE reads it from stdin.")
     elif argument == "pwd":
         print("pwd:         Shows the current working direcoty.")
     elif argument == "quit":
         print("quit:        Terminate the connection to the server and close the client.")
+    elif argument == "reget":
+        print("reget:       Resumable get. Continues a partial download and survives dropped connections.")
+    elif argument == "reput":
+        print("reput:       Resumable put. Continues a partial upload and survives dropped connections.")
+    elif argument == "resume":
+        print("resume:      Continue every unfinished reget/reput recorded in the journal.")
+    elif argument == "stats":
+        print("stats:       Show command round trip, data connection and transfer statistics. stats json or stats prometheus prints them in that format; stats reset clears them.")
+    elif argument == "tune":
+        print("tune:        Show the measured round trip and throughput and the socket buffer and read sizes they give. tune buffer SIZE or tune chunk SIZE fixes a size, e.g. tune buffer 8M; auto sizes them from the measurements again.")
+    elif argument == "verify":
+        print("verify:      verify on|off|crc32|md5|sha256. Checksums each get and put as it happens and compares it with the server's (HASH, XMD5 or XCRC, else SIZE), repeating transfers that do not match.")
 
 
 
 """
 Logs the user into the FTP server.
+Anything not given is asked for at the prompt.
 
+Input:
+    session : The session to log in
+    user : Optional. The username
+    password : Optional. The password
 Output:
     TRUE if the user is successfully logged in
     FALSE otherwise
 """
-def ftp_login():
-    user = raw_input('Enter Username: ')
-    resp = ftp_user(user)
+def ftp_login(session, user = None, password = None):
+    if session.via:
+        session.login(user)
+        return True
+    if user is None:
+        user = raw_input('Enter Username: ')
+    resp = session.ftp_user(user)
     if resp[0] == '230':
+        session.user = user
+        session.probe_features()
         return True
     if resp[0] == '331':
-        pswd = getpass.getpass('Enter Password: ')
-        resp = ftp_pass(pswd)
+        pswd = password if password is not None else getpass.getpass('Enter Password: ')
+        resp = session.ftp_pass(pswd)
         if resp[0] == '230':
+            session.user = user
+            session.password = pswd
+            session.probe_features()
             return True
-    
+
     print(resp[1])
     return False
 
 
+"""
+Raised when a command is missing an argument in batch mode
+"""
+class UsageError(Exception):
+    pass
 
-# 
-#   Read command line arguments. 
-#
-
-parser = argparse.ArgumentParser(description = "FTP client written by Alex M Brown.", epilog = "Have a nice day <3")
-parser.add_argument('-v','--verbose', action='store_true', help="Print notes to cmdline. Useful for debugging")
-parser.add_argument('IP_ADDR', help="The IP Address or Name of the FTP server")
-parser.add_argument('LOG_FILE', help="The name of the file for the client logs")
-parser.add_argument('PORT_NUM', nargs='?', default = 21, type = int, help="The port number of the FTP server. [Default = 21]")
-args = vars(parser.parse_args(sys.argv[1:]))
-
-TARGET_ADDR = args['IP_ADDR']
-LOG_FILE = args['LOG_FILE']
-TARGET_PORT = args['PORT_NUM']
-VERBOSE = args['verbose']
-
-try:
-    TARGET_ADDR = gethostbyname(TARGET_ADDR)
-except socket_error as e:
-    print("An unexpected error occured while looking up host.")
-    print(e)
-    exit()
 
-#
-#   Esablish control connection and run the client
-#
+"""
+Finds the byte stream under a text stream such as sys.stdout
+Input:
+    stream: The text stream
+    mode: 'rb' or 'wb'
+Output:
+    The stream to read or write bytes with
+"""
+def binary_stream(stream, mode):
+    if hasattr(stream, 'buffer'):
+        return stream.buffer
+    return io.open(stream.fileno(), mode, closefd = False)     #Python 2 text files take no memoryview
 
 
-log("-----------------------------------New Session-----------------------------------")
-CONTROL_SOCKET = establish_connection(TARGET_ADDR, TARGET_PORT)
+"""
+Splits a batch script into commands
+Commands are separated by newlines or semicolons. Arguments follow the command
+name and may be quoted, e.g. get "my file.txt" local.txt
+Input:
+    script: The text of the script
+Output:
+    list : The words of each command. Blank commands and # comments are skipped
+"""
+def parse_script(script):
+    commands = []
+    for line in script.splitlines():
+        if line.strip().startswith('#'):
+            continue
+        for command in split_commands(line):
+            words = shlex.split(command)
+            if words:
+                commands.append(words)
+    return commands
 
-if not CONTROL_SOCKET:
-    print("Failed to establish control connection")
-    log("Connection Failed")
-    exit()
 
+"""
+Splits a line on semicolons that are not inside quotes
+Input:
+    line: One line of a script
+Output:
+    list : The text of each command on the line
+"""
+def split_commands(line):
+    commands = [""]
+    quote = None
+    for char in line:
+        if quote:
+            if char == quote:
+                quote = None
+        elif char == '"' or char == "'":
+            quote = char
+        elif char == ';':
+            commands.append("")
+            continue
+        commands[-1] += char
+    return commands
 
-readSocket(CONTROL_SOCKET)
 
-#Log the user in
-if not ftp_login():
-    log("Failed to authenticate user")
-    exit()
+"""
+The client's commands, shared by the interactive prompt and batch mode
+Each do_ method takes the arguments typed after the command name and returns
+(Succeeded, Response Code, Message). Missing arguments are asked for at the
+prompt, or are an error in batch mode.
 
-#Begin UI
-print("Welcome to Alex Brown's FTP Client!")
-print(SUPPORTED_COMMANDS)
-while(True):
-    choice = raw_input("myFTP> ")
+Input:
+    session : A connected, logged in session
+    interactive : Optional. Prompt for missing arguments (default TRUE)
+"""
+class CommandLoop(object):
+    def __init__(self, session, interactive = True):
+        self.session = session
+        self.interactive = interactive
+        self.pool = None                            #Extra sessions for mget/mput/pget, opened on first use
+        self.journal = TransferJournal(JOURNAL_FILE)
+
+    """
+    Gets an argument typed after the command, or asks for it
+    Input:
+        args : The arguments typed after the command
+        index : Which argument is wanted
+        prompt : What to ask the user if it is missing
+        optional : Optional. In batch mode, return "" instead of failing
+    Output:
+        str : The argument
+    """
+    def ask(self, args, index, prompt, optional = False):
+        if index < len(args):
+            return args[index]
+        if self.interactive:
+            return raw_input(prompt)
+        if optional:
+            return ""
+        raise UsageError("Missing argument: " + prompt.rstrip(': '))
+
+    """
+    Takes the -name, -type, -size and -newer options of ls and dir out of the arguments
+    Input:
+        args : The arguments typed after the command
+    Output:
+        tuple : (The remaining arguments, test from entry_filter or None)
+    """
+    def listing_filter(self, args):
+        options = {}
+        rest = []
+        words = iter(args)
+        for word in words:
+            if word in ('-name', '-type', '-size', '-newer'):
+                options[word] = next(words, None)
+                if options[word] is None:
+                    raise UsageError("Missing value for " + word)
+            else:
+                rest.append(word)
+        kind = options.get('-type')
+        if kind is not None:
+            if kind not in ('f', 'd', 'l'):
+                raise UsageError("Unknown type: " + kind)
+            kind = {'f': 'file', 'd': 'dir', 'l': 'link'}[kind]
+        try:
+            min_size = parse_rate(options['-size']) if '-size' in options else None
+            newer = parse_since(options['-newer']) if '-newer' in options else None
+        except ValueError as e:
+            raise UsageError(str(e))
+        return (rest, entry_filter(options.get('-name'), kind, min_size, newer))
+
+    def get_pool(self):
+        if not self.pool:
+            self.pool = SessionPool(self.session, POOL_SIZE)
+        return self.pool
+
+    """
+    Runs one command
+    Input:
+        words : The command name followed by its arguments
+    Output:
+        tuple : (Succeeded, Response Code, Message)
+    """
+    def run(self, words):
+        handler = getattr(self, 'do_' + words[0], None)
+        if not handler:
+            print("Unknown Command")
+            print(SUPPORTED_COMMANDS)
+            return (False, None, "Unknown Command")
+        try:
+            return handler(words[1:])
+        except UsageError as e:
+            print(e)
+            return (False, None, str(e))
+
+    """
+    Runs the interactive command loop until the user quits
+    """
+    def interact(self):
+        print("Welcome to Alex Brown's FTP Client!")
+        print(SUPPORTED_COMMANDS)
+        unfinished = len(self.journal.pending(self.session.host))
+        if unfinished:
+            print("There are " + str(unfinished) + " unfinished transfers. Use resume to continue them.")
+        while(True):
+            try:
+                words = shlex.split(raw_input("myFTP> "))
+            except ValueError as e:
+                print(e)
+                continue
+            self.run(words or [""])
+
+    """
+    Runs a list of commands without prompting
+    Input:
+        commands : The words of each command
+        keep_going : Optional. Carry on after a command fails
+        results : Optional. File to write one JSON object per command to
+    Output:
+        int : Exit status. 0 if every command succeeded, 1 otherwise
+    """
+    def run_batch(self, commands, keep_going = False, results = None):
+        status = 0
+        for words in commands:
+            start = time.time()
+            ok, code, message = self.run(words)
+            if results:
+                results.write(json.dumps({'command': words[0], 'args': words[1:], 'ok': ok, 'code': code,
+                                          'message': message, 'elapsed': round(time.time() - start, 6)}) + "\n")
+                results.flush()
+            if words[0] == 'quit':
+                break
+            if not ok:
+                status = 1
+                if not keep_going:
+                    break
+        return status
+
+    """
+    Closes the pool and the session
+    """
+    def close(self):
+        if self.pool:
+            self.pool.close()
+            self.pool = None
+        try:
+            self.session.quit()
+        except (FTPError, socket_error):
+            self.session.close()
 
     #DO HELP
     #Read an optional command from the user and print that command's help text
-    if choice == 'help':
-        help_command = raw_input("Select command: ")
+    def do_help(self, args):
+        help_command = self.ask(args, 0, "Select command: ", optional = True)
         ftp_help(help_command)
+        return (True, None, help_command)
 
     #DO PASSIVE
-    elif choice == 'pasv':
+    def do_pasv(self, args):
         print("Entering passive mode...")
-        resp = ftp_pasv()
+        resp = self.session.pasv()
         if resp[0] == '227':
-            #Search the response string for the socket headers: (h1,h2,h3,h4,p1,p2).
-            address = re.search('\(.*\)', resp[1])
-            address = address.group(0)[1:-1]
-            #Parse the socket address and establish the data connection.
-            socket_address = get_socket_address(address)
-            DATA_SOCKET = establish_connection(socket_address[0], socket_address[1])
-            if DATA_SOCKET:
-                ACTIVE_MODE = False
+            if self.session.data_socket:
                 print("Data connection ready.")
-            else:
-                print("Error establishing data connection")
-        else:
-            print(resp[0])
-            
+                return (True, resp[0], resp[1])
+            print("Error establishing data connection")
+            return (False, resp[0], "Error establishing data connection")
+        print(resp[0])
+        return (False, resp[0], resp[1])
+
     #DO PORT
-    elif choice == 'port':
+    def do_port(self, args):
         print("Entering active mode...")
-        #Get the IP Address of the machine and open a port on it
-        my_ip = CONTROL_SOCKET.getsockname()[0]
-
-        DATA_SOCKET = socket(AF_INET, SOCK_STREAM)
-        DATA_SOCKET.bind((my_ip, 0))
-
-        #Generate the headers for the PORT command (h1,h2,h3,h4,p1,p2)
-        my_port = int(DATA_SOCKET.getsockname()[1])
-        p2 = my_port % 256
-        p1 = (my_port - p2) / 256
-
-        h = ','.join(my_ip.split('.'))
-        headers = h + ',' + str(p1) + ',' + str(p2)
-
-        #Begin listening on the newly opened port and send the PORT command
-        DATA_SOCKET.listen(1)
-        resp = ftp_port(headers)
-
+        resp = self.session.port()
         if resp[0] == '200':
-            ACTIVE_MODE = True
             print("Data connection port ready.")
-        else:
-            DATA_SOCKET.close()
-            print(resp[1])
+            return (True, resp[0], resp[1])
+        print(resp[1])
+        return (False, resp[0], resp[1])
 
     #DO EXTENDED PASSIVE
-    elif choice == 'epsv':
+    def do_epsv(self, args):
         print("Entering passive mode...")
-        resp = ftp_epsv()
+        resp = self.session.epsv()
         if resp[0] == '229':
-
-            #Search the response string for the port number
-            port = re.search('\|\|\|.*\|', resp[1])
-            port = port.group(0)[1:-1].strip('|')
-
-            #Establish the data connection
-            DATA_SOCKET = establish_connection(TARGET_ADDR, int(port))
-            if DATA_SOCKET:
-                ACTIVE_MODE = False
+            if self.session.data_socket:
                 print("Data connection ready.")
-            else:
-                print("Error establishing data connection")
+                return (True, resp[0], resp[1])
+            print("Error establishing data connection")
+            return (False, resp[0], "Error establishing data connection")
+        return (False, resp[0], resp[1])
 
     #DO EXTENDED PORT
-    elif choice == 'eprt':
-        #Get local ip address
-        my_ip = CONTROL_SOCKET.getsockname()[0]
-
-        #Open data port & get the port number
-        DATA_SOCKET = socket(AF_INET, SOCK_STREAM)
-        DATA_SOCKET.bind((my_ip, 0))
-
-        my_port = DATA_SOCKET.getsockname()[1]
-
-        DATA_SOCKET.listen(1)
-
-        #Give the socket address to the server
-        resp = ftp_eprt(1, my_ip, my_port)
+    def do_eprt(self, args):
+        resp = self.session.eprt()
         if resp[0] == '200':
-            ACTIVE_MODE = True
             print("Data connection port ready.")
-        else:
-            DATA_SOCKET.close()
-            print(resp[1])
+            return (True, resp[0], resp[1])
+        print(resp[1])
+        return (False, resp[0], resp[1])
 
     #DO PWD
-    elif choice == 'pwd':
-        resp = ftp_pwd()
+    def do_pwd(self, args):
+        resp = self.session.ftp_pwd()
         print(resp[1])      #No matter the response code, print the message from the server
+        return (resp[0] == '257', resp[0], resp[1])
 
     #DO LIST
-    elif choice == 'ls':
-        #Check for data connection
-        if not DATA_SOCKET:
-            print("Need to establish data connection. Use pasv, port, eprt, or epsv first")
-        else:
-            #Read optional argument from user & send request
-            subject = raw_input("Enter optional file/directory: ")
-            resp = ftp_list(subject)
-            #Check if the request was OK
-            if resp[0] == '150':
-                #Do we need to accept a connection from the server?
-                if ACTIVE_MODE:
-                    DATA_SOCKET, address = DATA_SOCKET.accept()
-                    log("Accepted data connection from Server")
-                #Read everything from the data connection & display it
-                list_info = recvall(DATA_SOCKET)
-                print(list_info)
-                resp = parse_response(readSocket(CONTROL_SOCKET))
-                #Check if something went wrong & display the error
-                if not resp[0] == '226':
-                    print(resp[1])
-                #End the data connection.
-                DATA_SOCKET.close()
-                DATA_SOCKET = None
-            else:
-                print(resp[1])
+    #Lines are printed as they arrive; -name, -type, -size and -newer filter them
+    def do_ls(self, args):
+        #Read optional argument from user & send request
+        args, match = self.listing_filter(args)
+        subject = self.ask(args, 0, "Enter optional file/directory: ", optional = True)
+        resp, listing = self.session.iter_listing(subject, match, raw = True)
+        #Display the listing
+        if listing is not None:
+            try:
+                with listing:
+                    for line, entry in listing:
+                        print(line)
+            except KeyboardInterrupt:
+                print("Listing stopped")
+            except (IOError, OSError) as e:
+                if not e.errno == errno.EPIPE:
+                    raise
+                #Whatever was reading stdout has gone (e.g. ls | head); the listing was cut off
+                sys.stdout = sys.stderr
+                print("Output closed, listing stopped")
+            resp = listing.reply
+        #Check if something went wrong & display the error
+        if not resp[0] == '226':
+            print(resp[1])
+        return (resp[0] == '226', resp[0], resp[1])
+
+    #DO DIRECTORY
+    #Print a parsed listing, from the cache if it was read recently
+    def do_dir(self, args):
+        refresh = '-r' in args
+        args, match = self.listing_filter([arg for arg in args if not arg == '-r'])
+        directory = self.ask(args, 0, "Enter optional directory: ", optional = True)
+        resp, entries = self.session.listdir(directory or None, refresh)
+        if entries is None:
+            print(resp[1])
+            return (False, resp[0], resp[1])
+        if match:
+            entries = [entry for entry in entries if match(entry)]
+        for entry in entries:
+            print(format_entry(entry))
+        return (True, resp[0], str(len(entries)) + " entries")
+
+    #DO FIND
+    #Walk a remote tree in parallel and print matching paths as they are found
+    def do_find(self, args):
+        kind = None
+        if '-type' in args and args.index('-type') + 1 < len(args):
+            position = args.index('-type')
+            kind = {'f': 'file', 'd': 'dir'}.get(args[position + 1])
+            args = args[:position] + args[position + 2:]
+        directory = self.ask(args, 0, "Enter directory to search: ")
+        pattern = self.ask(args, 1, "Enter optional name pattern: ", optional = True) or '*'
+        count = 0
+        for path, entry in find_remote(self.get_pool(), self.session.absolute(directory), pattern, kind):
+            print(path)
+            count += 1
+        return (True, None, str(count) + " matches")
+
+    #DO DISK USAGE
+    #Walk a remote tree in parallel and total the size of each directory below it
+    def do_du(self, args):
+        directory = self.session.absolute(self.ask(args, 0, "Enter optional directory: ", optional = True) or '.')
+        children, total, files, directories = disk_usage(self.get_pool(), directory)
+        for name in sorted(children):
+            print("%14d  %s" % (children[name], posixpath.join(directory, name)))
+        print("%14d  %s (%d files, %d directories)" % (total, directory, files, directories))
+        return (True, None, str(total) + " bytes")
 
     #DO CWD
-    elif choice == 'cd':
-        directory = raw_input("Enter directory name: ")
-        resp = ftp_cwd(directory)
+    def do_cd(self, args):
+        directory = self.ask(args, 0, "Enter directory name: ")
+        resp = self.session.ftp_cwd(directory)
         print(resp[1])      #Whether the command succeeded or not, print the response from the server
+        return (resp[0] == '250', resp[0], resp[1])
 
     #DO RETRIEVE
-    elif choice == 'get':
-        #Check for data connection
-        if not DATA_SOCKET:
-            print("Need to establish data connection. Use pasv, port, eprt, or epsv first")
-        else:
-            #Select file to read
-            filename = raw_input("Enter name of desired file: ")
-            resp = ftp_retr(filename)
-            #If the server approves:
-            if resp[0] == '150' or resp[0] == '125':
-                #Ask the user to select a savename for the file
-                savename = raw_input("Save file as: ")
-                #Do we need to accept a connection from the server?
-                if ACTIVE_MODE:
-                    DATA_SOCKET, address = DATA_SOCKET.accept()
-                    log("Accepted data connection from Server")
-                #Read everything from the data connection and save it to the savename specified by the uer
-                readFile(DATA_SOCKET, savename)
-                resp2 = parse_response(readSocket(CONTROL_SOCKET))
-                #Check for errors and display them
-                if not resp2[0] == '226':
-                    print(resp2[1])
-                #Close the data connection
-                DATA_SOCKET.close()
-                DATA_SOCKET = None
-            else:
-                print(resp[1])
+    def do_get(self, args):
+        #Select file to read and a savename for it
+        filename = self.ask(args, 0, "Enter name of desired file: ")
+        savename = self.ask(args, 1, "Save file as: ")
+        #- writes the file to stdout for a pipeline, even when messages have been moved to stderr
+        target = binary_stream(sys.__stdout__, 'wb') if savename == '-' else savename
+        try:
+            resp, result = self.session.get(filename, target)
+        except (IOError, OSError) as e:
+            if not e.errno == errno.EPIPE:
+                raise
+            #Whatever was reading stdout has gone, so stop the transfer
+            self.session.close_data()
+            resp, result = self.session.ftp_abor(), None
+            print("Output closed, transfer stopped")
+        #Check for errors and display them
+        if not resp[0] == '226':
+            print(resp[1])
+        return (resp[0] == '226' and result is not None, resp[0], resp[1])
 
     #DO STORE
-    elif choice == 'put':
-        #Check for data connection
-        if not DATA_SOCKET:
-            print("Need to establish data connection. Use pasv, port, eprt, or epsv first")
+    def do_put(self, args):
+        #What file are we sending? - reads it from stdin
+        filename = self.ask(args, 0, "Enter name of your file: ")
+        if filename == '-':
+            remotename = self.ask(args, 1, "Save on server as: ")
+            resp, result = self.session.put(binary_stream(sys.stdin, 'rb'), remotename)
         else:
-            #What file are we sending?
-            filename = raw_input("Enter name of your file: ")
-            #Make sure that file exists and send the command
-            if os.path.isfile(filename):
-                resp = ftp_stor(filename)
-                #Are we good to send the file?
-                if resp[0] == '150' or resp[0] == '125':
-                    #Do we need to accept a connection from the server?
-                    if ACTIVE_MODE:
-                        DATA_SOCKET, address = DATA_SOCKET.accept()
-                        log("Accepted data connection from Server")
-                    #Send all the data in the file
-                    sendFile(DATA_SOCKET, filename)
-                    resp = parse_response(readSocket(CONTROL_SOCKET))
-                    #Check for errors and display them
-                    if not resp[0] == '226':
-                        print(resp[1])
-                    #Close the data connection
-                    DATA_SOCKET.close()
-                    DATA_SOCKET = None
-                else:
-                    print(resp[1])
-            else:
+            #Make sure that file exists and send the file
+            if not os.path.isfile(filename):
                 print("File not Found")
+                return (False, None, "File not Found")
+            resp, result = self.session.put(filename, args[1] if len(args) > 1 else None)
+        #Check for errors and display them
+        if not resp[0] == '226':
+            print(resp[1])
+        return (resp[0] == '226' and result is not None, resp[0], resp[1])
+
+    #DO MULTIPLE RETRIEVE / MULTIPLE STORE
+    #Each file gets its own data connection on a pooled control connection
+    def do_mget(self, args):
+        return self.multiple(args, False)
+
+    def do_mput(self, args):
+        return self.multiple(args, True)
+
+    def multiple(self, args, upload):
+        arguments = args or self.ask(args, 0, "Enter file names, patterns, or @manifest: ").split()
+        results = run_transfers(self.get_pool(), self.session, arguments, upload)
+        failed = len([result for result in results if not result[1] == '226'])
+        message = str(len(results) - failed) + " of " + str(len(results)) + " files transferred"
+        return (bool(results) and not failed, None, message)
+
+    #DO MIRROR
+    #Copy only the files that changed since the last run, in either direction
+    def do_mirror(self, args):
+        delete = '-d' in args or '--delete' in args
+        args = [arg for arg in args if arg not in ('-d', '--delete')]
+        direction = self.ask(args, 0, "Mirror direction (pull or push): ")
+        if direction == 'pull':
+            source = self.ask(args, 1, "Enter remote directory: ")
+            destination = self.ask(args, 2, "Enter local directory: ")
+            outcome = mirror_pull(self.get_pool(), self.session, source, destination, delete)
+        elif direction == 'push':
+            source = self.ask(args, 1, "Enter local directory: ")
+            destination = self.ask(args, 2, "Enter remote directory: ")
+            outcome = mirror_push(self.get_pool(), self.session, source, destination, delete)
+        else:
+            print("Direction must be pull or push")
+            return (False, None, "Direction must be pull or push")
+        message = "%d files transferred, %d deleted, %d failed" % outcome
+        print(message)
+        return (outcome[2] == 0, None, message)
+
+    #DO SEGMENTED RETRIEVE
+    #Split one file into byte ranges and fetch them in parallel
+    def do_pget(self, args):
+        filename = self.ask(args, 0, "Enter name of desired file: ")
+        savename = self.ask(args, 1, "Save file as: ")
+        complete, written, elapsed = segmented_get(self.get_pool(), filename, savename)
+        if complete:
+            print("%d bytes in %.2f seconds (%s)" % (written, elapsed, format_rate(written, elapsed)))
+            return (True, '226', str(written) + " bytes")
+        print("Segmented download failed, see log for details")
+        return (False, None, "Segmented download failed")
+
+    #DO RESUMABLE RETRIEVE
+    #Progress is journaled so the download can continue after a dropped connection or restart
+    def do_reget(self, args):
+        filename = self.ask(args, 0, "Enter name of desired file: ")
+        savename = self.ask(args, 1, "Save file as: ")
+        return self.show_result(resumable_get(self.session, filename, savename, self.journal))
+
+    #DO RESUMABLE STORE
+    def do_reput(self, args):
+        filename = self.ask(args, 0, "Enter name of your file: ")
+        if not os.path.isfile(filename):
+            print("File not Found")
+            return (False, None, "File not Found")
+        return self.show_result(resumable_put(self.session, filename, filename, self.journal))
+
+    #DO RESUME
+    #Continue every unfinished transfer from the journal
+    def do_resume(self, args):
+        results = resume_all(self.session, self.journal)
+        if not results:
+            print("No unfinished transfers")
+        outcomes = [self.show_result(result) for result in results]
+        return (all([outcome[0] for outcome in outcomes]), None, str(len(outcomes)) + " transfers resumed")
+
+    """
+    Prints the outcome of a resumable transfer
+    Input:
+        result: What resumable_get or resumable_put returned
+    Output:
+        tuple : (Succeeded, Response Code, Message)
+    """
+    def show_result(self, result):
+        if not result:
+            print("Transfer failed, run resume to try again")
+            return (False, None, "Transfer failed")
+        if not result[0][0] == '226':
+            print(result[0][1])
+            return (False, result[0][0], result[0][1])
+        print("%d bytes in %.2f seconds (%s)" % (result[1][0], result[1][1], format_rate(result[1][0], result[1][1])))
+        return (True, result[0][0], result[0][1])
+
+    #DO STATISTICS
+    #Print the command, data connection and transfer histograms
+    def do_stats(self, args):
+        view = self.ask(args, 0, "Enter optional format (json, prometheus or reset): ", optional = True)
+        if view == 'json':
+            print(METRICS.to_json())
+        elif view == 'prometheus':
+            print(METRICS.to_prometheus())
+        elif view == 'reset':
+            METRICS.reset()
+            print("Statistics cleared")
+        else:
+            print(METRICS.summary())
+        return (True, None, view or "summary")
+
+    #DO ASCII TYPE
+    #Line endings are converted as the data moves; the TYPE command goes out with the next transfer
+    def do_ascii(self, args):
+        self.session.transfer_type = 'A'
+        print("Transfers are now ASCII")
+        return (True, None, "ASCII")
+
+    #DO BINARY TYPE
+    def do_binary(self, args):
+        self.session.transfer_type = 'I'
+        print("Transfers are now binary")
+        return (True, None, "Binary")
+
+    #DO COMPRESSION
+    #MODE Z is sent with the next transfer, if the server offers it
+    def do_compress(self, args):
+        setting = self.ask(args, 0, "Enter optional setting (on, off or a level 1-9): ", optional = True)
+        if setting == 'on':
+            self.session.compress = True
+        elif setting == 'off':
+            self.session.compress = False
+        elif setting.isdigit() and 1 <= int(setting) <= 9:
+            self.session.compress = True
+            self.session.compress_level = int(setting)
+        elif setting:
+            raise UsageError("Unknown setting: " + setting)
+        offered = self.session.mode_switch() == 'Z' or self.session.transfer_mode == 'Z'
+        if not self.session.compress:
+            message = "Compression off"
+        elif offered:
+            message = "Compression on, level " + str(self.session.compress_level)
+        else:
+            message = "Compression on, but the server does not support MODE Z"
+        print(message)
+        return (True, None, message)
+
+    #DO VERIFICATION
+    #Checksum transfers as they happen and compare them with the server's
+    def do_verify(self, args):
+        setting = self.ask(args, 0, "Enter optional setting (on, off, crc32, md5 or sha256): ", optional = True)
+        if setting == 'on':
+            self.session.verify = 'auto'
+        elif setting == 'off':
+            self.session.verify = None
+        elif setting in HASH_NAMES:
+            self.session.verify = setting
+        elif setting:
+            raise UsageError("Unknown setting: " + setting)
+        if not self.session.verify:
+            message = "Verification off"
+        else:
+            algorithm, command = self.session.verify_plan()
+            message = "Verification with " + (algorithm + " (" + command + ")" if algorithm else "SIZE only")
+        print(message)
+        return (True, None, message)
+
+    #DO BANDWIDTH LIMIT
+    #limit RATE for every transfer together, limit transfer RATE for each one
+    def do_limit(self, args):
+        if args and args[0] == 'transfer':
+            target = 'transfer'
+            args = args[1:]
+        else:
+            target = 'global'
+        value = self.ask(args, 0, "Enter optional rate (e.g. 2M, off): ", optional = True)
+        if not value:
+            print(SCHEDULER.summary())
+            limit = self.session.rate_limit
+            print("Transfer limit: " + (format_rate(limit, 1) if limit else "none"))
+            return (True, None, "limits")
+        try:
+            rate = parse_rate(value)
+        except ValueError as e:
+            raise UsageError(str(e))
+        if target == 'transfer':
+            self.session.rate_limit = rate
+        else:
+            SCHEDULER.set_rate(rate)
+        message = target.capitalize() + " limit " + (format_rate(rate, 1) if rate else "removed")
+        print(message)
+        return (True, None, message)
+
+    #DO PRIORITY
+    def do_priority(self, args):
+        priority = self.ask(args, 0, "Enter priority (high, normal or low): ")
+        if priority not in PRIORITY_WEIGHTS:
+            raise UsageError("Unknown priority: " + priority)
+        self.session.priority = priority
+        return (True, None, "Priority " + priority)
+
+    #DO TUNING
+    #tune buffer SIZE and tune chunk SIZE fix a size, auto goes back to measuring
+    def do_tune(self, args):
+        if args and args[0] in ('buffer', 'chunk'):
+            value = self.ask(args, 1, "Enter size (e.g. 4M, auto): ")
+            try:
+                size = 0 if value == 'auto' else parse_rate(value)
+            except ValueError as e:
+                raise UsageError(str(e))
+            if args[0] == 'buffer':
+                self.session.socket_buffer = size
+            else:
+                self.session.chunk_size = size
+        elif args and not args[0] == 'auto':
+            raise UsageError("Unknown setting: " + args[0])
+        elif args:
+            self.session.socket_buffer = self.session.chunk_size = 0
+        session = self.session
+        buffer_size, chunk_size = session.tuning()
+        if session.rtt and session.rate:
+            print("Round trip " + str(round(session.rtt * 1000, 2)) + " ms, throughput " + format_rate(session.rate, 1))
+        else:
+            print("Nothing measured yet")
+        buffers = str(buffer_size) + " bytes" if buffer_size else "kernel default"
+        reads = str(chunk_size) + " bytes" + ("" if session.chunk_size else ", growing to " + str(CHUNK_SIZE_MAX))
+        message = ("Socket buffers " + buffers + (" (set)" if session.socket_buffer else "") +
+                   ", reads " + reads + (" (set)" if session.chunk_size else ""))
+        print(message)
+        return (True, None, message)
 
     #DO SYSTEM
-    elif choice == 'about':
-        resp = ftp_syst()
+    def do_about(self, args):
+        resp = self.session.ftp_syst()
         print(resp[1])          #Display the response from the server
+        return (resp[0] == '215', resp[0], resp[1])
 
     #DO QUIT
     #Send quit command and close sockets. Exit program
-    elif choice == 'quit':
-        ftp_quit()
-        if CONTROL_SOCKET:
-            CONTROL_SOCKET.close()
-        if DATA_SOCKET:
-            DATA_SOCKET.close()
-        exit()
-
-    #INVALID COMMAND
-    else:
-        print("Unknown Command")
-        print(SUPPORTED_COMMANDS)
+    def do_quit(self, args):
+        self.close()
+        if self.interactive:
+            stop_logging()
+            exit()
+        return (True, '221', "Goodbye")
+
+
+"""
+Entry point for the command line client
+Reads the command line arguments, connects, logs the user in and runs the command loop.
+Input:
+    argv : Optional. The command line arguments (default sys.argv[1:])
+"""
+def main(argv = None):
+    global LOG_FILE, VERBOSE, LOG_FLUSH_INTERVAL, LOG_MAX_BYTES, POOL_SIZE, JOURNAL_FILE, LISTING_TTL, METRICS_FILE, METRICS_FORMAT
+    global TRANSFER_LIMIT, COMPRESSION, COMPRESSION_LEVEL, VERIFY, TRANSFER_TYPE, SOCKET_BUFFER, CHUNK_SIZE
+
+    #
+    #   Read command line arguments.
+    #
+
+    parser = argparse.ArgumentParser(description = "FTP client written by Alex M Brown.", epilog = "Have a nice day <3")
+    parser.add_argument('-v','--verbose', action='store_true', help="Print notes to cmdline. Useful for debugging")
+    parser.add_argument('--log-flush', type = float, default = LOG_FLUSH_INTERVAL, help="Seconds between writes to the log file. [Default = 1.0]")
+    parser.add_argument('--log-max-bytes', type = int, default = LOG_MAX_BYTES, help="Rotate the log file once it reaches this size, 0 to disable. [Default = 10 MiB]")
+    parser.add_argument('-c','--connections', type = int, default = POOL_SIZE, help="Number of control connections used by mget/mput/pget. With --serve, the daemon holds one more. [Default = 4]")
+    parser.add_argument('--journal', default = JOURNAL_FILE, help="File that records unfinished reget/reput transfers. [Default = .ftp_journal]")
+    parser.add_argument('--cache-ttl', type = float, default = LISTING_TTL, help="Seconds a directory listing is cached for, 0 to disable. [Default = 30]")
+    parser.add_argument('--metrics', metavar = 'FILE', help="Write the session's statistics to FILE when the client exits")
+    parser.add_argument('--metrics-format', choices = ['json', 'prometheus'], default = METRICS_FORMAT, help="Format of the --metrics file. [Default = json]")
+    parser.add_argument('--limit', type = parse_rate, default = BANDWIDTH_LIMIT, help="Most bytes per second for all transfers together, e.g. 10M. [Default = no limit]")
+    parser.add_argument('--transfer-limit', type = parse_rate, default = TRANSFER_LIMIT, help="Most bytes per second for each transfer. [Default = no limit]")
+    parser.add_argument('--priority', choices = sorted(PRIORITY_WEIGHTS), default = 'normal', help="Share of the --limit given to this session's transfers. [Default = normal]")
+    parser.add_argument('-z','--compress', action='store_true', help="Send data in MODE Z (deflate) when the server supports it")
+    parser.add_argument('--compress-level', type = int, choices = range(1, 10), default = COMPRESSION_LEVEL, metavar = 'LEVEL', help="zlib level for compressed uploads, 1 (fast) to 9 (small). [Default = 6]")
+    parser.add_argument('--socket-buffer', type = parse_rate, default = SOCKET_BUFFER, metavar = 'SIZE', help="Size of the data connection's socket buffers, e.g. 8M. [Default = sized from the measured bandwidth-delay product]")
+    parser.add_argument('--chunk-size', type = parse_rate, default = CHUNK_SIZE, metavar = 'SIZE', help="Size of each read and write on the data connection, e.g. 1M. [Default = sized from measurements and grown]")
+    parser.add_argument('-a','--ascii', action='store_true', help="Transfer files as text (TYPE A), converting line endings. [Default = binary]")
+    parser.add_argument('--verify', nargs = '?', const = 'auto', choices = ['auto'] + list(HASH_NAMES), help="Checksum each get and put and compare it with the server's, repeating transfers that do not match. [Default = off, auto = strongest the server offers]")
+    parser.add_argument('-b','--batch', metavar = 'FILE', help="Run the commands in FILE instead of prompting, - for stdin")
+    parser.add_argument('-e','--execute', metavar = 'COMMANDS', help="Run these commands instead of prompting, separated by ;")
+    parser.add_argument('-k','--keep-going', action='store_true', help="In batch mode, carry on after a command fails")
+    parser.add_argument('--results', metavar = 'FILE', help="In batch mode, write the outcome of each command to FILE as JSON lines")
+    parser.add_argument('--serve', metavar = 'SOCKET', help="Stay logged in and serve thin clients on the Unix socket SOCKET until interrupted")
+    parser.add_argument('--via', metavar = 'SOCKET', help="Run commands over a session held by the daemon on SOCKET instead of connecting and logging in")
+    parser.add_argument('-u','--user', help="Username. In batch mode the password is read from FTP_PASSWORD if set")
+    parser.add_argument('IP_ADDR', help="The IP Address or Name of the FTP server")
+    parser.add_argument('LOG_FILE', help="The name of the file for the client logs")
+    parser.add_argument('PORT_NUM', nargs='?', default = 21, type = int, help="The port number of the FTP server. [Default = 21]")
+    args = vars(parser.parse_args(sys.argv[1:] if argv is None else argv))
+
+    LOG_FILE = args['LOG_FILE']
+    VERBOSE = args['verbose']
+    LOG_FLUSH_INTERVAL = args['log_flush']
+    LOG_MAX_BYTES = args['log_max_bytes']
+    POOL_SIZE = args['connections']
+    JOURNAL_FILE = args['journal']
+    LISTING_TTL = args['cache_ttl']
+    METRICS_FILE = args['metrics']
+    METRICS_FORMAT = args['metrics_format']
+    TRANSFER_LIMIT = args['transfer_limit']
+    COMPRESSION = args['compress']
+    COMPRESSION_LEVEL = args['compress_level']
+    VERIFY = args['verify']
+    TRANSFER_TYPE = 'A' if args['ascii'] else 'I'
+    SOCKET_BUFFER = args['socket_buffer']
+    CHUNK_SIZE = args['chunk_size']
+    SCHEDULER.set_rate(args['limit'])
+
+    #
+    #   Esablish control connection and run the client
+    #
+
+    log("-----------------------------------New Session-----------------------------------")
+    if args['serve'] and (args['via'] or args['batch'] or args['execute']):
+        print("--serve cannot be combined with --via, -b or -e")
+        exit(2)
+    session = FTPSession(args['IP_ADDR'], args['PORT_NUM'])
+    session.priority = args['priority']
+    session.via = args['via']
+    try:
+        session.connect()
+    except FTPError as e:
+        print(e)
+        log("Connection Failed")
+        exit(2)
+
+    #Collect the batch script, if there is one
+    commands = None
+    if args['batch'] or args['execute']:
+        script = ""
+        if args['batch'] == '-':
+            script = sys.stdin.read()
+        elif args['batch']:
+            try:
+                with open(args['batch']) as script_file:
+                    script = script_file.read()
+            except IOError as e:
+                print(e)
+                session.close()
+                exit(2)
+        if args['execute']:
+            script += "\n" + args['execute']
+        try:
+            commands = parse_script(script)
+        except ValueError as e:
+            print("Error in script: " + str(e))
+            session.close()
+            exit(2)
+        if args['batch'] == '-' and any([words[:2] == ['put', '-'] for words in commands]):
+            print("put - cannot read stdin when the script is read from it")
+            session.close()
+            exit(2)
+        #get - writes the file to stdout, so everything else is printed to stderr
+        if any([words[0] == 'get' and words[2:3] == ['-'] for words in commands]):
+            sys.stdout = sys.stderr
+
+    password = os.environ.get('FTP_PASSWORD') if commands is not None or args['serve'] else None
+    try:
+        #Log the user in
+        if not ftp_login(session, args['user'], password):
+            log("Failed to authenticate user")
+            session.close()
+            exit(2 if commands is not None else 0)
+
+        if args['serve']:
+            signal.signal(signal.SIGTERM, lambda signum, frame: exit(0))    #Clean up the socket on kill too
+            print("Serving " + session.host + " on " + args['serve'])
+            try:
+                SessionDaemon(session, args['serve'], POOL_SIZE + 1).serve()
+            except KeyboardInterrupt:
+                pass
+            stop_logging()
+            exit(0)
+
+        loop = CommandLoop(session, interactive = commands is None)
+        if commands is None:
+            loop.interact()
+        results = open(args['results'], 'w') if args['results'] else None
+        try:
+            status = loop.run_batch(commands, args['keep_going'], results)
+        finally:
+            if results:
+                results.close()
+        loop.close()
+    except FTPError as e:
+        terminate(str(e), session)
+    stop_logging()
+    exit(status)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+# Unit tests for the parsers and state machines in FTPClient.py
+# Run with: python -m unittest discover tests
+
+import calendar
+import os
+import sys
+import unittest
+from socket import AF_UNIX
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import FTPClient
+from FTPClient import (BandwidthScheduler, DirEntry, Histogram, NewlineConverter, ReplyReader,
+                       parse_list_line, parse_mlsd_line, parse_response)
+
+
+"""
+Stands in for the control connection, handing out one prepared chunk per recv()
+"""
+class FakeSocket(object):
+    family = AF_UNIX                                #Keeps ReplyReader from setting TCP_QUICKACK
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def recv(self, size):
+        return self.chunks.pop(0) if self.chunks else b""
+
+
+def utc(year, month, day, hour = 0, minute = 0):
+    return calendar.timegm((year, month, day, hour, minute, 0, 0, 0, 0))
+
+
+class ParseListLineTest(unittest.TestCase):
+    NOW = utc(2024, 6, 15, 12, 0)
+
+    def test_unix_file_with_year(self):
+        entry = parse_list_line("-rw-r--r--    1 ftp      ftp          1024 Jan 05  2023 report.csv", self.NOW)
+        self.assertEqual(entry, DirEntry('report.csv', 'file', 1024, utc(2023, 1, 5)))
+
+    def test_unix_without_group_column(self):
+        entry = parse_list_line("drwxr-xr-x  2 owner 4096 Mar 01 09:30 docs", self.NOW)
+        self.assertEqual(entry, DirEntry('docs', 'dir', 4096, utc(2024, 3, 1, 9, 30)))
+
+    def test_unix_name_with_spaces(self):
+        entry = parse_list_line("-rw-r--r--  1 a b  7 Jun 10 08:00 my file.txt", self.NOW)
+        self.assertEqual(entry.name, 'my file.txt')
+
+    def test_recent_file_from_last_year(self):
+        #Without a year, a date later than today belongs to the year before
+        now = utc(2024, 1, 2, 10, 0)
+        entry = parse_list_line("-rw-r--r--  1 a b  7 Dec 31 23:59 old.txt", now)
+        self.assertEqual(entry.mtime, utc(2023, 12, 31, 23, 59))
+
+    def test_recent_file_tomorrow_allows_clock_skew(self):
+        entry = parse_list_line("-rw-r--r--  1 a b  7 Jun 16 01:00 new.txt", self.NOW)
+        self.assertEqual(entry.mtime, utc(2024, 6, 16, 1, 0))
+
+    def test_symlink_drops_target(self):
+        entry = parse_list_line("lrwxrwxrwx  1 a b  11 Jun 10 08:00 latest -> data/v2.csv", self.NOW)
+        self.assertEqual((entry.name, entry.type), ('latest', 'link'))
+
+    def test_dot_entries_and_totals_are_skipped(self):
+        self.assertIsNone(parse_list_line("total 12", self.NOW))
+        self.assertIsNone(parse_list_line("drwxr-xr-x  2 a b 4096 Jun 10 08:00 .", self.NOW))
+        self.assertIsNone(parse_list_line("drwxr-xr-x  2 a b 4096 Jun 10 08:00 ..", self.NOW))
+
+    def test_dos_file_and_directory(self):
+        self.assertEqual(parse_list_line("01-31-24  03:15PM             2048 data.bin"),
+                         DirEntry('data.bin', 'file', 2048, utc(2024, 1, 31, 15, 15)))
+        self.assertEqual(parse_list_line("12-01-99  12:05AM       <DIR>          archive"),
+                         DirEntry('archive', 'dir', None, utc(1999, 12, 1, 0, 5)))
+
+
+class ParseMlsdLineTest(unittest.TestCase):
+    def test_file(self):
+        entry = parse_mlsd_line("type=file;size=1000;modify=20240101120000; a.txt")
+        self.assertEqual(entry, DirEntry('a.txt', 'file', 1000, utc(2024, 1, 1, 12, 0)))
+
+    def test_fractional_modify_and_case(self):
+        entry = parse_mlsd_line("Type=dir;Modify=20240101120000.123; sub dir")
+        self.assertEqual(entry, DirEntry('sub dir', 'dir', None, utc(2024, 1, 1, 12, 0)))
+
+    def test_current_and_parent_are_skipped(self):
+        self.assertIsNone(parse_mlsd_line("type=cdir;modify=20240101120000; /pub"))
+        self.assertIsNone(parse_mlsd_line("type=pdir;modify=20240101120000; /"))
+
+    def test_unix_symlink(self):
+        self.assertEqual(parse_mlsd_line("type=OS.unix=slink:/etc;size=4; etc").type, 'link')
+
+    def test_bad_facts(self):
+        self.assertEqual(parse_mlsd_line("type=file;size=abc;modify=garbage; x"), DirEntry('x', 'file', None, None))
+        self.assertIsNone(parse_mlsd_line("type=file;size=1;"))
+
+
+class ReplyReaderTest(unittest.TestCase):
+    def test_reply_split_across_reads(self):
+        reader = ReplyReader(FakeSocket([b"220 Wel", b"come\r", b"\n"]))
+        self.assertEqual(reader.read_reply(), b"220 Welcome\r\n")
+
+    def test_several_replies_in_one_read(self):
+        reader = ReplyReader(FakeSocket([b"331 Password\r\n230 Logged in\r\n"]))
+        self.assertEqual(reader.read_reply(), b"331 Password\r\n")
+        self.assertEqual(reader.read_reply(), b"230 Logged in\r\n")
+
+    def test_multi_line_reply(self):
+        #Lines inside a multi-line reply may start with other codes or with the same code and a dash
+        reader = ReplyReader(FakeSocket([b"211-Features:\r\n MDTM\r\n211-still going\r\n", b"200 not the end\r\n211 End\r\n"]))
+        reply = reader.read_reply()
+        self.assertEqual(reply, b"211-Features:\r\n MDTM\r\n211-still going\r\n200 not the end\r\n211 End\r\n")
+        self.assertEqual(parse_response(reply.decode())[0], '211')
+
+    def test_closed_connection(self):
+        reader = ReplyReader(FakeSocket([b"421 Tim"]))
+        self.assertRaises(FTPClient.socket_error, reader.read_reply)
+
+
+class NewlineConverterTest(unittest.TestCase):
+    def convert(self, newline, chunks):
+        converter = NewlineConverter(newline)
+        return b"".join([converter.convert(chunk) for chunk in chunks]) + converter.flush()
+
+    def test_crlf_to_lf(self):
+        self.assertEqual(self.convert("\n", [b"a\r\nb\r\n"]), b"a\nb\n")
+
+    def test_lf_to_crlf(self):
+        self.assertEqual(self.convert("\r\n", [b"a\nb\r\nc"]), b"a\r\nb\r\nc")
+
+    def test_cr_split_across_chunks(self):
+        self.assertEqual(self.convert("\n", [b"a\r", b"\nb"]), b"a\nb")
+        self.assertEqual(self.convert("\r\n", [b"a\r", b"\nb"]), b"a\r\nb")
+
+    def test_lone_cr_is_kept(self):
+        self.assertEqual(self.convert("\n", [b"a\r", b"b"]), b"a\rb")
+        self.assertEqual(self.convert("\n", [b"end\r"]), b"end\r")
+
+    def test_memoryview_chunks(self):
+        self.assertEqual(self.convert("\n", [memoryview(b"x\r\n")]), b"x\n")
+
+
+class HistogramTest(unittest.TestCase):
+    def test_empty(self):
+        self.assertIsNone(Histogram([1, 2]).quantile(0.5))
+
+    def test_buckets_and_totals(self):
+        histogram = Histogram([1, 10, 100])
+        for value in (0.5, 1, 5, 50, 500):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 1, 1, 1])
+        self.assertEqual((histogram.count, histogram.total, histogram.low, histogram.high), (5, 556.5, 0.5, 500))
+
+    def test_quantiles_stay_within_observed_range(self):
+        histogram = Histogram([1, 10, 100])
+        for value in (2, 3, 4, 5):
+            histogram.observe(value)
+        self.assertEqual(histogram.quantile(0), 2)
+        self.assertEqual(histogram.quantile(1), 5)
+        self.assertTrue(2 <= histogram.quantile(0.5) <= 5)
+
+    def test_open_last_bucket(self):
+        histogram = Histogram([1])
+        histogram.observe(7)
+        histogram.observe(9)
+        self.assertEqual(histogram.quantile(1), 9)
+
+
+class BandwidthSchedulerTest(unittest.TestCase):
+    def test_unlimited(self):
+        scheduler = BandwidthScheduler()
+        flow = scheduler.open()
+        self.assertFalse(flow.limited())
+        capped = scheduler.open(cap = 500)
+        self.assertEqual(capped.rate, 500)
+
+    def test_shared_by_priority(self):
+        scheduler = BandwidthScheduler(700)
+        high, normal, low = scheduler.open('high'), scheduler.open('normal'), scheduler.open('low')
+        self.assertEqual((high.rate, normal.rate, low.rate), (400, 200, 100))
+
+    def test_cap_below_share_is_given_to_the_rest(self):
+        scheduler = BandwidthScheduler(1000)
+        capped, other = scheduler.open(cap = 100), scheduler.open()
+        self.assertEqual((capped.rate, other.rate), (100, 900))
+
+    def test_release_and_set_rate(self):
+        scheduler = BandwidthScheduler(1000)
+        first, second = scheduler.open(), scheduler.open()
+        self.assertEqual(first.rate, 500)
+        second.close()
+        self.assertEqual(first.rate, 1000)
+        scheduler.set_rate(0)
+        self.assertIsNone(first.rate)
+
+    def test_unknown_priority_is_normal(self):
+        self.assertEqual(BandwidthScheduler(10).open('urgent').priority, 'normal')
+
+
+if __name__ == '__main__':
+    unittest.main()